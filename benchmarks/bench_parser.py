@@ -0,0 +1,86 @@
+"""Benchmark how conversation parsing scales with input size.
+
+Run from the repo root:
+
+    python benchmarks/bench_parser.py
+    python benchmarks/bench_parser.py --sizes 1 10 --compare-regex
+
+Each input shape is generated at every size (in MB) and parsed with
+`parse_conversation`. Links are not resolved, so only the parser is timed.
+With --compare-regex the regex parser used before the single-pass
+scanner is timed too. It is quadratic on large user turns with no links
+(about two minutes for 1 MB), so use it with small --sizes.
+"""
+import argparse
+import re
+import time
+from llm_tool.parser import parse_conversation
+
+MB = 1024 * 1024
+
+
+def many_turns(size: int) -> str:
+    turn = "# %User\nWhat does this do?\n\n# %Assistant\nIt adds two numbers together.\n\n"
+    return turn * (size // len(turn) + 1)
+
+
+def dense_links(size: int) -> str:
+    body = "See [this file](notes.txt) and ![a cat](cat.png) too. " * (size // 50 + 1)
+    return "# %User\n" + body
+
+
+def no_links(size: int) -> str:
+    body = "A long pasted log line with (parentheses) and [brackets] but no links\n"
+    return "# %User\n" + body * (size // len(body) + 1)
+
+
+def fenced_code(size: int) -> str:
+    block = "```python\n# %User\nx = [a](b)\n```\nSome text between blocks.\n"
+    return "# %User\n" + block * (size // len(block) + 1)
+
+
+SHAPES = {
+    'many_turns': many_turns,
+    'dense_links': dense_links,
+    'no_links': no_links,
+    'fenced_code': fenced_code,
+}
+
+
+def legacy_regex_parse(file_contents: str) -> list:
+    """The regex implementation replaced by the scanner, kept for comparison"""
+    pruned = re.sub(r'<!--llm.*?llm-->', '', file_contents, flags=re.DOTALL)
+    chunk_pattern = r'(?P<text>.*?)(?:(?P<link>(?<!!)\[.*?\]\((?P<linkpath>.*?)\))|(?P<image>!\[.*?\]\((?P<imagepath>.*?)\))|$)'
+    conversation = []
+    for role, content in re.findall(r'# %(User|Assistant)\n(.*?)(?=# %User|# %Assistant|$)', pruned, re.DOTALL):
+        if role == 'User':
+            content = [match.group('text') for match in re.finditer(chunk_pattern, content, re.DOTALL)]
+        conversation.append((role, content))
+    return conversation
+
+
+def time_call(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 2, 5, 10], help='Input sizes in MB')
+    parser.add_argument('--compare-regex', action='store_true', help='Also time the legacy regex parser')
+    args = parser.parse_args()
+
+    print(f"{'shape':<12} {'MB':>5} {'scanner s':>10} {'MB/s':>8}" + (f" {'regex s':>10}" if args.compare_regex else ''))
+    for name, make_input in SHAPES.items():
+        for size_mb in args.sizes:
+            text = make_input(int(size_mb * MB))
+            elapsed = time_call(parse_conversation, text, ".", True, True)
+            line = f"{name:<12} {size_mb:>5g} {elapsed:>10.3f} {size_mb / elapsed:>8.1f}"
+            if args.compare_regex:
+                line += f" {time_call(legacy_regex_parse, text):>10.3f}"
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Load-test llmd end to end against the offline mock model.
+
+Run from the repo root:
+
+    python benchmarks/load_test.py --files 200 --workers 16
+    python benchmarks/load_test.py --mode watch --files 20 --ttft 0.2
+    python benchmarks/load_test.py --images 2 --error-rate 0.05
+
+Each run writes --files markdown conversations of --turns turns into a
+temporary directory. It then answers them with the 'mock' model through
+the full `read_and_write_response` path: parsing, hydration, the
+backend and writing the file. No network is used and no API keys are
+needed. Conversations with --images go through the Anthropic backend
+with the stand-in client, and the rest go through `llm`.
+
+Modes:
+    single  answer the files one after another
+    batch   answer them concurrently, as `llmd <directory>` does
+    watch   run the watch loop and save the files into the watched
+            directory; throughput includes the debounce, latency
+            doesn't
+
+The report gives throughput, latency and time-to-first-token
+percentiles, and the number of failures (from --error-rate).
+"""
+from pathlib import Path
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import synthetic
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """The nearest-rank percentile of values, e.g. fraction=0.99 for p99"""
+    ordered = sorted(values)
+    rank = max(1, round(fraction * len(ordered) + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def make_conversation(args: argparse.Namespace, i: int, image_names: list[str]) -> str:
+    header = "\n".join([
+        '---',
+        'model: mock',
+        f"stream: {'true' if args.stream else 'false'}",
+        'options:',
+        f"  ttft: {args.ttft}",
+        f"  chunks_per_second: {args.chunks_per_second}",
+        f"  chunk_bytes: {args.chunk_bytes}",
+        f"  response_bytes: {args.response_bytes}",
+        f"  error_rate: {args.error_rate}",
+        '---',
+        '',
+    ])
+    images = ' '.join(f"![image]({name})" for name in image_names)
+    return header + synthetic.long_conversation(args.turns) + f"Conversation {i} {images}\n"
+
+
+def timed(respond, latencies: list, ttfts: list, failures: list):
+    """Wrap respond to record each call's latency, time to first token and failure"""
+    from llm_tool.profiling import profiling
+
+    lock = threading.Lock()
+
+    def timed_respond(filepath):
+        start = time.perf_counter()
+        try:
+            with profiling(str(filepath), table=False) as profile:
+                respond(filepath)
+        except Exception as e:
+            with lock:
+                failures.append(f"{filepath}: {type(e).__name__}: {e}")
+            raise
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            if profile.metrics.get('time_to_first_token') is not None:
+                ttfts.append(profile.metrics['time_to_first_token'])
+
+    return timed_respond
+
+
+class _StopWatching(Exception):
+    pass
+
+
+class _StoppableWatcher:
+    """A watcher whose poll ends the watch loop once stop is set"""
+
+    def __init__(self, watcher, stop: threading.Event):
+        self._watcher = watcher
+        self._stop = stop
+
+    def poll(self, timeout: float):
+        if self._stop.is_set():
+            raise _StopWatching
+        return self._watcher.poll(timeout)
+
+
+def run_watch(directory: Path, contents: dict[Path, str], base_config: dict, respond, debounce: float) -> None:
+    """Start the watch loop, save the files into the directory and wait for every answer"""
+    from llm_tool.watch import PollingWatcher, watch
+
+    answered = threading.Semaphore(0)
+
+    def respond_and_count(filepath):
+        try:
+            respond(filepath)
+        finally:
+            answered.release()
+
+    watcher = PollingWatcher(directory, interval=debounce / 4)
+    stop = threading.Event()
+
+    def loop():
+        with contextlib.suppress(_StopWatching):
+            watch(_StoppableWatcher(watcher, stop), base_config, respond_and_count, debounce=debounce)
+
+    thread = threading.Thread(target=loop)
+    thread.start()
+    try:
+        for path, content in contents.items():
+            path.write_text(content)
+        for _ in contents:
+            if not answered.acquire(timeout=60):
+                break
+    finally:
+        stop.set()
+        thread.join()
+        watcher.close()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['single', 'batch', 'watch'], default='batch')
+    parser.add_argument('--files', type=int, default=100, help='Number of conversations')
+    parser.add_argument('--turns', type=int, default=20, help='Turns in each conversation')
+    parser.add_argument('--workers', type=int, default=8, help='batch_max_workers for batch mode')
+    parser.add_argument('--images', type=int, default=0, help='Images in each conversation')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='Ask for whole responses')
+    parser.add_argument('--ttft', type=float, default=0.05, help='Mock seconds to first token')
+    parser.add_argument('--chunks-per-second', type=float, default=100.0)
+    parser.add_argument('--chunk-bytes', type=int, default=16)
+    parser.add_argument('--response-bytes', type=int, default=500)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail')
+    parser.add_argument('--debounce', type=float, default=0.2, help='Watch mode debounce in seconds')
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        # Keep configs, caches and llm logs out of the user's own, and
+        # ignore any PROJECT config in the current directory
+        os.environ['llmd_config_dir'] = str(workdir / 'config')
+        os.environ['LLM_USER_PATH'] = str(workdir / 'llm')
+        os.chdir(workdir)
+        chats = workdir / 'chats'
+        chats.mkdir()
+
+        from llm_tool.__main__ import get_base_config, read_and_write_response
+        from llm_tool.batch import run_batch
+
+        image_names = synthetic.write_images(chats, args.images, size=512)
+        contents = {
+            chats / f"chat_{i}.md": make_conversation(args, i, image_names)
+            for i in range(args.files)
+        }
+        base_config = dict(get_base_config(), batch_max_workers=args.workers)
+
+        latencies, ttfts, failures = [], [], []
+        respond = timed(read_and_write_response, latencies, ttfts, failures)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if args.mode == 'watch':
+                run_watch(chats, contents, base_config, respond, args.debounce)
+            else:
+                for path, content in contents.items():
+                    path.write_text(content)
+                start = time.perf_counter()
+                if args.mode == 'batch':
+                    run_batch(list(contents), base_config, respond)
+                else:
+                    for path in contents:
+                        with contextlib.suppress(Exception):
+                            respond(path)
+        elapsed = time.perf_counter() - start
+        os.chdir(cwd)
+
+    print(f"Mode: {args.mode}, {args.files} files of {args.turns} turns, {args.images} images each")
+    print(f"Answered {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} files/s), {len(failures)} failed")
+    for name, values in [('latency', latencies), ('time to first token', ttfts)]:
+        if values:
+            print(
+                f"{name:<20} p50 {percentile(values, 0.5) * 1000:8.1f} ms   p90 {percentile(values, 0.9) * 1000:8.1f} ms"
+                f"   p99 {percentile(values, 0.99) * 1000:8.1f} ms   max {max(values) * 1000:8.1f} ms"
+            )
+    for failure in failures[:5]:
+        print(f"  {failure}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
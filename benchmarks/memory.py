@@ -0,0 +1,138 @@
+"""Measure the peak memory of reading and parsing a very large conversation.
+
+Run from the repo root:
+
+    python benchmarks/memory.py --mb 300
+
+Writes a synthetic transcript of about --mb MB, then reads and parses it
+with each reader in a fresh subprocess, and reports the peak RSS above
+that of a process that only imports llmd:
+
+    read   file.read() and parse, as llmd does for files under mmap_min_mb
+    mmap   the memory-mapped reader (see llm_tool.mapped_reader)
+
+Peak RSS is only available on Unix.
+"""
+from pathlib import Path
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import synthetic
+
+MODES = ('read', 'mmap')
+
+
+def peak_rss_mb() -> float:
+    """This process's peak resident set size in MB"""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def write_transcript(path: Path, mb: float) -> None:
+    """A conversation of about mb MB in 20 KB turns, with a yaml header
+
+    It is written a block of turns at a time: a child process's peak RSS
+    starts from this process's RSS when it is forked, so this process
+    has to stay small.
+    """
+    turn_bytes = 20_000
+    n_blocks = max(1, int(mb * 1024 * 1024 / turn_bytes / 100))
+    final_prompt = "# %User\nAnd finally?\n"
+    block = synthetic.long_conversation(100, turn_bytes).removesuffix(final_prompt)
+    with open(path, 'w') as file:
+        file.write("---\nmodel: mock\n---\n")
+        for _ in range(n_blocks):
+            file.write(block)
+        file.write(final_prompt)
+
+
+def child(mode: str, path: str) -> dict:
+    """Read and parse the transcript the way llmd does in this mode, in this process"""
+    import contextlib
+    import io
+    import llm_tool.__main__ as llmd_main
+
+    start = time.perf_counter()
+    if mode != 'import':
+        from llm_tool.mapped_reader import map_file
+
+        base_path = Path(path).parent
+        with contextlib.redirect_stdout(io.StringIO()):
+            if mode == 'mmap':
+                with map_file(path) as data:
+                    _, parsed, _ = llmd_main._read_mapped_file(path, base_path, data)
+            else:
+                _, parsed, _ = llmd_main._read_file(path, base_path)
+        assert parsed['conversation'][-1]['role'] == 'user'
+    return {'peak_mb': peak_rss_mb(), 'seconds': time.perf_counter() - start}
+
+
+def measure(mode: str, path: Path, env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', mode, str(path)],
+        env=env, capture_output=True, text=True, check=True,
+        )
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def run(mb: float) -> dict[str, dict]:
+    """Peak RSS and time for each mode, relative to a process that only imports llmd"""
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        transcript = workdir / 'transcript.md'
+        write_transcript(transcript, mb)
+        # Parsing doesn't need links, and configs are kept out of the user's own
+        env = dict(os.environ, llmd_config_dir=str(workdir / 'config'))
+        (workdir / 'config').mkdir()
+        (workdir / 'config' / 'config.yaml').write_text("ignore_links: true\n")
+
+        baseline = measure('import', transcript, env)
+        results = {'file_mb': transcript.stat().st_size / 1024 / 1024}
+        for mode in MODES:
+            result = measure(mode, transcript, env)
+            results[mode] = {
+                'peak_mb': result['peak_mb'] - baseline['peak_mb'],
+                'seconds': result['seconds'],
+            }
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mb', type=float, default=300, help='Size of the transcript in MB')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(child(*args.child)))
+        return 0
+
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        print("Peak RSS can't be measured on this platform")
+        return 1
+
+    results = run(args.mb)
+    print(f"Transcript: {results['file_mb']:.0f} MB")
+    for mode in MODES:
+        result = results[mode]
+        print(
+            f"{mode:<6} peak RSS {result['peak_mb']:8.1f} MB"
+            f" ({result['peak_mb'] / results['file_mb']:.2f}x the file)   {result['seconds']:6.2f} s"
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Benchmark the parsing, hydration and config stages on synthetic inputs.
+
+Run from the repo root:
+
+    python benchmarks/run_benchmarks.py run --output baseline.json
+    python benchmarks/run_benchmarks.py run --output current.json
+    python benchmarks/run_benchmarks.py compare baseline.json current.json
+
+`run` times every benchmark (or those matching --filter) and writes the
+results to a JSON file. `compare` prints the change in each benchmark's
+median time, and exits with status 1 if any benchmark is slower than
+the baseline by more than --threshold (default 25%). Benchmarks faster
+than --min-seconds in the baseline are reported but never fail, because
+their timings are mostly noise.
+
+With --quick the inputs are about ten times smaller, for a fast check
+while developing. Results from quick and full runs can't be compared.
+"""
+from collections.abc import Callable
+from pathlib import Path
+import argparse
+import contextlib
+import copy
+import io
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import synthetic
+from llm_tool.config_and_system import get_config, merge_configs
+from llm_tool.image_handlers import add_image_data_to_conversation
+import llm_tool.image_handlers as image_handlers
+from llm_tool.inline_links import replace_links_with_file_contents
+from llm_tool.llm_conversation import chunk_user_assistant_turns
+from llm_tool.parser import parse_conversation, parse_markdown_with_yaml
+
+RESULTS_VERSION = 1
+
+
+def _benchmarks(workdir: Path, scale: float) -> dict[str, tuple[Callable, Callable]]:
+    """Benchmarks by name, as (setup, run) pairs
+
+    setup() is called before every repeat, untimed, and returns the
+    arguments for run(), so that functions which change their input in
+    place time the same work each time.
+    """
+    def n(count):
+        return max(1, int(count * scale))
+
+    def constant(*args):
+        return lambda: args
+
+    links_dir = workdir / 'links'
+    links_dir.mkdir()
+    link_names = synthetic.write_text_files(links_dir, n(200), file_bytes=8192)
+    links_parsed = parse_conversation(synthetic.dense_links(link_names, n(500), 10), links_dir)
+
+    images_dir = workdir / 'images'
+    images_dir.mkdir()
+    image_names = synthetic.write_images(images_dir, n(40), size=512)
+    images_parsed = parse_conversation(synthetic.many_images(image_names), images_dir)
+
+    def fresh_images():
+        # Encodings are cached in memory, which would only time the first repeat
+        with image_handlers._memory_cache_lock:
+            image_handlers._memory_cache.clear()
+            image_handlers._memory_cache_chars = 0
+        return (copy.deepcopy(images_parsed['conversation']), images_dir)
+
+    conversation_10k = parse_conversation(synthetic.long_conversation(n(10_000)), ignore_links=True, ignore_images=True)['conversation']
+    configs = synthetic.snippet_configs(n(2000))
+
+    return {
+        'parse_conversation/1k_turns': (
+            constant(synthetic.long_conversation(n(1000)), '.', True, True), parse_conversation),
+        'parse_conversation/10k_turns': (
+            constant(synthetic.long_conversation(n(10_000)), '.', True, True), parse_conversation),
+        'parse_conversation/huge_turns': (
+            constant(synthetic.huge_turns(4, 5 * scale), '.', True, True), parse_conversation),
+        'parse_conversation/dense_links': (
+            constant(synthetic.dense_links(link_names, n(2000), 20), links_dir), parse_conversation),
+        'parse_conversation/nested_comments': (
+            constant(synthetic.nested_comments(n(500), 50), '.', True, True), parse_conversation),
+        'parse_markdown_with_yaml/snippets': (
+            constant(synthetic.yaml_header(n(2000))), parse_markdown_with_yaml),
+        'replace_links_with_file_contents/dense_links': (
+            lambda: (copy.deepcopy(links_parsed['conversation']),), replace_links_with_file_contents),
+        'add_image_data_to_conversation/many_images': (
+            fresh_images, add_image_data_to_conversation),
+        'chunk_user_assistant_turns/10k_turns': (
+            constant(conversation_10k), chunk_user_assistant_turns),
+        'merge_configs/snippets': (
+            constant(configs), merge_configs),
+        'get_config/snippets': (
+            constant(configs), get_config),
+    }
+
+
+def time_benchmark(setup: Callable, run: Callable, repeat: int) -> list[float]:
+    """Seconds taken by each of `repeat` calls of run(*setup())"""
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        # Some stages print progress, which would swamp the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(repeat: int = 5, quick: bool = False, name_filter: str | None = None) -> dict:
+    """Run the benchmarks and return the results as a JSON-serialisable dict"""
+    scale = 0.1 if quick else 1.0
+    results = dict()
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmarks = _benchmarks(Path(workdir), scale)
+        for name, (setup, run) in benchmarks.items():
+            if name_filter and name_filter not in name:
+                continue
+            times = time_benchmark(setup, run, repeat)
+            results[name] = {'median': statistics.median(times), 'min': min(times), 'repeat': repeat}
+            print(f"{name:<48} {results[name]['median'] * 1000:10.2f} ms", flush=True)
+    return {
+        'version': RESULTS_VERSION,
+        'quick': quick,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = 0.25, min_seconds: float = 0.001) -> tuple[list[str], list[str]]:
+    """
+    Compare two sets of results by median time.
+
+    Returns
+    -------
+    tuple of (list of str, list of str)
+        A line for every benchmark in the current results, and the names of the
+        benchmarks that regressed by more than `threshold`.
+    """
+    if baseline.get('quick') != current.get('quick'):
+        raise ValueError("Can't compare a --quick run with a full run")
+
+    lines = []
+    regressions = []
+    for name, result in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            lines.append(f"{name:<48} {'new':>10}")
+            continue
+        before = baseline['benchmarks'][name]['median']
+        after = result['median']
+        change = after / before - 1 if before else 0.0
+        regressed = change > threshold and before >= min_seconds
+        if regressed:
+            regressions.append(name)
+        lines.append(
+            f"{name:<48} {before * 1000:10.2f} ms {after * 1000:10.2f} ms {change:+8.1%}"
+            + ("  REGRESSION" if regressed else "")
+            )
+    return lines, regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results')
+    run_parser.add_argument('--repeat', type=int, default=5, help='Times to run each benchmark')
+    run_parser.add_argument('--quick', action='store_true', help='Use inputs about ten times smaller')
+    run_parser.add_argument('--filter', help='Only run benchmarks whose name contains this')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results with a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown, as a fraction')
+    compare_parser.add_argument('--min-seconds', type=float, default=0.001, help="Benchmarks faster than this can't fail")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(repeat=args.repeat, quick=args.quick, name_filter=args.filter)
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        print(f"Results written to {args.output}")
+        return 0
+
+    baseline = json.loads(Path(args.baseline).read_text())
+    current = json.loads(Path(args.current).read_text())
+    lines, regressions = compare_results(baseline, current, args.threshold, args.min_seconds)
+    print(f"{'benchmark':<48} {'baseline':>13} {'current':>13} {'change':>8}")
+    print('\n'.join(lines))
+    if regressions:
+        print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Generators of synthetic conversations for the benchmarks.
+
+Every generator is deterministic, so that runs on different commits time
+the same inputs. Generators that need files on disk (linked text files
+and images) write them into a directory passed by the caller.
+"""
+from pathlib import Path
+import zlib
+import struct
+
+USER_TEXT = "What does this function do, and how could it be faster?\n"
+ASSISTANT_TEXT = "It adds two numbers together. Caching the result would help.\n"
+
+
+def long_conversation(n_turns: int, turn_bytes: int = 200) -> str:
+    """A conversation of n_turns alternating user and assistant turns, ending with a user turn"""
+    user_body = USER_TEXT * (turn_bytes // len(USER_TEXT) + 1)
+    assistant_body = ASSISTANT_TEXT * (turn_bytes // len(ASSISTANT_TEXT) + 1)
+    turns = []
+    for i in range(n_turns):
+        if i % 2 == 0:
+            turns.append(f"# %User\nQuestion {i}\n{user_body}\n")
+        else:
+            turns.append(f"# %Assistant\nAnswer {i}\n{assistant_body}\n")
+    if n_turns % 2 == 0:
+        turns.append("# %User\nAnd finally?\n")
+    return ''.join(turns)
+
+
+def huge_turns(n_turns: int, turn_mb: float) -> str:
+    """A few multi-MB turns, like pasted logs, with brackets but no links"""
+    line = "2024-01-01T00:00:00 worker[3] (pid 123) handled request [ok]\n"
+    body = line * (int(turn_mb * 1024 * 1024) // len(line) + 1)
+    return long_conversation(n_turns, turn_bytes=0).replace("Question", body + "Question")
+
+
+def write_text_files(directory: str | Path, n_files: int, file_bytes: int = 4096) -> list[str]:
+    """Write n_files text files to link to, returning their names"""
+    directory = Path(directory)
+    line = "def add(a, b):\n    return a + b\n\n"
+    content = line * (file_bytes // len(line) + 1)
+    names = []
+    for i in range(n_files):
+        name = f"file_{i}.py"
+        (directory / name).write_text(f"# File {i}\n{content}")
+        names.append(name)
+    return names
+
+
+def dense_links(link_names: list[str], n_turns: int, links_per_turn: int) -> str:
+    """User turns that are mostly links to the given files, which are reused across turns"""
+    turns = []
+    for i in range(n_turns):
+        links = ' '.join(
+            f"[file]({link_names[(i * links_per_turn + j) % len(link_names)]})"
+            for j in range(links_per_turn)
+        )
+        turns.append(f"# %User\nCompare these: {links}\n\n# %Assistant\nThey are the same.\n\n")
+    turns.append("# %User\nWhich is best?\n")
+    return ''.join(turns)
+
+
+def _png(width: int, height: int, seed: int) -> bytes:
+    """A valid, uncompressible-ish RGB PNG, written without Pillow"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(
+        b'\x00' + bytes((x * 7 + y * 13 + seed) % 256 for x in range(width * 3))
+        for y in range(height)
+    )
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b'')
+
+
+def write_images(directory: str | Path, n_images: int, size: int = 256) -> list[str]:
+    """Write n_images distinct PNG files, returning their names"""
+    directory = Path(directory)
+    names = []
+    for i in range(n_images):
+        name = f"image_{i}.png"
+        (directory / name).write_bytes(_png(size, size, seed=i))
+        names.append(name)
+    return names
+
+
+def many_images(image_names: list[str], images_per_turn: int = 4) -> str:
+    """User turns that link to the given images, a few per turn"""
+    turns = []
+    for start in range(0, len(image_names), images_per_turn):
+        images = ' '.join(f"![image]({name})" for name in image_names[start:start + images_per_turn])
+        turns.append(f"# %User\nWhat is in these? {images}\n\n# %Assistant\nCats.\n\n")
+    turns.append("# %User\nAnd all together?\n")
+    return ''.join(turns)
+
+
+def nested_comments(n_turns: int, depth: int) -> str:
+    """Turns with comment blocks that contain comment openers, headers and links
+
+    Comments don't nest in llmd: everything up to the first closing marker
+    is commented out. These inputs check that the parser skips them in
+    linear time however many openers they contain.
+    """
+    inner = "<!--llm note\n# %Assistant\n[not a link](gone.txt)\n" * depth
+    comment = inner + "llm-->"
+    return ''.join(
+        f"# %User\nQuestion {i} {comment}\nMore text\n\n# %Assistant\nAnswer {comment}\n\n"
+        for i in range(n_turns)
+    ) + "# %User\nAnd?\n"
+
+
+def yaml_header(n_snippets: int, snippet_bytes: int = 500) -> str:
+    """A YAML header with many sys_ snippets used by the system message, and a short conversation"""
+    snippet = ("Prefer small functions with numpy docstrings. " * (snippet_bytes // 48 + 1)).strip()
+    names = [f"sys_snippet_{i}" for i in range(n_snippets)]
+    lines = ['---', 'model: claude-3-5-sonnet-latest', 'system: "' + ' '.join(f"{{{name}}}" for name in names) + '"']
+    lines += ['options:', '  max_tokens: 1024']
+    lines += [f'{name}: "{snippet}"' for name in names]
+    lines += ['---', '']
+    return '\n'.join(lines) + long_conversation(3)
+
+
+def snippet_configs(n_snippets: int, snippet_bytes: int = 500) -> list[dict]:
+    """DEFAULT, USER, PROJECT and file configs with many sys_ snippets, for get_config"""
+    snippet = "Prefer small functions with numpy docstrings. " * (snippet_bytes // 48 + 1)
+    names = [f"sys_snippet_{i}" for i in range(n_snippets)]
+    default = {'model': 'claude-3-5-sonnet-latest', 'system': ' '.join(f"{{{name}}}" for name in names), 'options': {'max_tokens': 1024}}
+    user = {name: snippet for name in names[: n_snippets // 2]}
+    project = {name: snippet.upper() for name in names[n_snippets // 2:]}
+    header = {'model': 'gpt-4o', 'sys_snippet_0': 'Overridden'}
+    return [default, user, project, header]
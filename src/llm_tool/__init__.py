@@ -2,10 +2,33 @@ import os
 from pathlib import Path
 from llm_tool.config_and_system import load_config_or_empty, get_or_make_user_config_path
 
-llmd_config_dir = Path(get_or_make_user_config_path(shell=False)).parent
+__version__ = "0.0.30"
+
+
+# Configs are loaded on use rather than at import time, so that importing
+# the package has no side effects (such as creating the user config dir)
+# and commands that don't need a config don't pay for one. llmd itself
+# reads them through its compiled config cache (see `compiled_config`).
+
+def get_llmd_config_dir() -> Path:
+    """The user config dir, created if it doesn't exist
+
+    Looked up on every call, so that a change to the llmd_config_dir
+    environment variable is picked up.
+    """
+    return Path(get_or_make_user_config_path(shell=False)).parent
+
+
+def __getattr__(name):
+    # Lazy module attributes kept for backwards compatibility
+    if name == 'llmd_config_dir':
+        return get_llmd_config_dir()
+    if name == 'USER_CONFIG':
+        return load_config_or_empty(get_llmd_config_dir(), 'config.yaml')
+    if name == 'PROJECT_CONFIG':
+        return load_config_or_empty(os.getcwd(), 'llmd_config.yaml')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-USER_CONFIG = load_config_or_empty(llmd_config_dir,'config.yaml')
-PROJECT_CONFIG = load_config_or_empty(os.getcwd(),'llmd_config.yaml')
 
 DEFAULT_CONFIG = {
     "model": 'claude-3-5-sonnet-latest',
@@ -16,6 +39,69 @@ DEFAULT_CONFIG = {
     },
     "ignore_images": False,
     "ignore_links": False,
+    "stream": True,
+    "incremental_parse": False,
+    "mmap_min_mb": 64,
+    "prompt_cache": True,
+    "persist_conversation": False,
+    "on_conflict": "reanchor",
+    "expand_archives": False,
+    "compact": {
+        "keep_turns": 10,
+        "auto_after_turns": None,
+        "summary_prompt": (
+            "Summarise our conversation so far, so that you can carry on from "
+            "the summary instead of the whole conversation. Keep the facts, "
+            "decisions, code and open questions that later turns may need. "
+            "Reply with the summary only."
+        ),
+    },
+    "cache": False,
+    "cache_max_mb": 100,
+    "cache_max_age_days": 30,
+    "image_cache": True,
+    "image_cache_max_mb": 200,
+    "attachments": {
+        "enabled": False,
+        "ttl_days": 30,
+        "min_document_kb": 64,
+    },
+    "image_preprocess": {
+        "max_dimension": 1568,
+        "format": None,
+        "quality": 85,
+    },
+    "context_window": {
+        "max_tokens": None,
+        "strategy": "drop_oldest",
+        "keep_first": 2,
+        "keep_last": None,
+    },
+    "api_client": {
+        "timeout": 600,
+        "connect_timeout": 10,
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "max_retries": 2,
+    },
+    "request_policy": {
+        "max_attempts": 3,
+        "backoff": 0.5,
+        "max_backoff": 30,
+        "deadline": 600,
+        "stall_timeout": 120,
+        "hedge": False,
+        "hedge_percentile": 95,
+        "hedge_min_samples": 20,
+    },
+    "link_budget": {
+        "max_bytes": None,
+        "max_total_bytes": None,
+        "excerpt": "head_tail",
+    },
+    "batch_max_workers": 4,
+    "watch_debounce": 1.0,
+    "watch_poll_interval": 1.0,
     "sys_python_prefs": """
     These are my preferences for python:
     * Public python functions and methods should have numpy docstrings
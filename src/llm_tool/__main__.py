@@ -1,21 +1,74 @@
-from llm_tool.parser import parse_conversation, parse_markdown_with_yaml
-from llm_tool.inline_links import replace_links_with_file_contents
-from llm_tool.llm_conversation import llm_conversation
-from llm_tool.claude_vision import claude_vision_conversation
+from llm_tool.parser import parse_conversation, parse_markdown_with_yaml, set_yaml_header_value, _has_images
+from llm_tool.context_window import fit_conversation
+from llm_tool.attachments import make_attachment_registry
+from llm_tool.fan_out import label_response, model_configs, select_branch
+from llm_tool.hydration import hydrate_conversation
+from llm_tool.image_handlers import make_image_cache, make_preprocess_settings
+from llm_tool.llm_conversation import llm_conversation, llm_conversation_stream
+from llm_tool.claude_vision import claude_vision_conversation, claude_vision_conversation_stream
 from llm_tool.paths import validate_file_path
-from llm_tool import DEFAULT_CONFIG, USER_CONFIG, PROJECT_CONFIG
-from llm_tool.config_and_system import get_config, merge_configs
+from llm_tool.profiling import record, span
+from llm_tool.request_executor import call_with_policy, stream_with_policy
+from llm_tool.safe_write import (
+    FileSnapshot, file_lock, finish_streamed_answer, read_with_snapshot, replace_file, write_answer,
+)
+from llm_tool import DEFAULT_CONFIG, get_llmd_config_dir
+from llm_tool.config_and_system import get_config, get_user_cache_dir
 from pathlib import Path
 from os import PathLike
+import argparse
+import contextvars
+import copy
+import functools
+import hashlib
+import os
 import re
 import sys
 import subprocess
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from glob import has_magic
+
+def _compiled_base_config() -> tuple[dict, dict | None]:
+    """The merged and rendered DEFAULT, USER and PROJECT configs
+
+    The config files are checked on every call, so edits are picked up
+    between the files of a watch or batch run.
+    """
+    from llm_tool.compiled_config import load_compiled_config
+
+    project_dir = os.getcwd()
+    # One compiled config per project dir, so switching projects doesn't invalidate it
+    project_hash = hashlib.sha256(project_dir.encode('utf-8')).hexdigest()[:16]
+    return load_compiled_config(
+        DEFAULT_CONFIG,
+        [get_llmd_config_dir() / 'config.yaml', Path(project_dir) / 'llmd_config.yaml'],
+        get_user_cache_dir('config') / f"{project_hash}.pickle",
+        )
+
+
+def get_base_config() -> dict:
+    """Merge the DEFAULT, USER and PROJECT configs"""
+    return _compiled_base_config()[0]
+
+
+def get_file_config(file_config: dict) -> dict:
+    """get_config for the base configs and a file's yaml header
 
-CONFIGS = merge_configs([DEFAULT_CONFIG,USER_CONFIG,PROJECT_CONFIG])
-EDITOR = CONFIGS.get('editor_cmd',None)
+    Files without a header use the rendered config from the compiled
+    config cache.
+    """
+    rendered = _compiled_base_config()[1]
+    if not file_config and rendered is not None:
+        return copy.deepcopy(rendered)
+    return get_config([get_base_config(), file_config])
 
-md_header = """---
+
+def make_md_header(configs: dict) -> str:
+    """The yaml header and first user turn for a new markdown file"""
+    return """---
 model: {model_name}
 system: "{system_msg}"
 date: {todays_date}
@@ -26,32 +79,50 @@ options:
 # %User
 
 """.format(
-    model_name = CONFIGS.get('model','claude-3-5-sonnet-latest'),
-    system_msg = CONFIGS.get('system',''), 
-    todays_date= date.today().strftime("%d %B %Y"),
-    max_tokens = CONFIGS.get('options').get('max_tokens',1024),
-)
+        model_name = configs.get('model','claude-3-5-sonnet-latest'),
+        system_msg = configs.get('system',''),
+        todays_date= date.today().strftime("%d %B %Y"),
+        max_tokens = configs.get('options').get('max_tokens',1024),
+    )
 
 
-
-def main(markdown_filepath: str | PathLike[str] | None = None):
+def main(markdown_filepath: str | PathLike[str] | None = None, use_cache: bool = True):
 
     if markdown_filepath is None:
-        if len(sys.argv) != 2:
+        if len(sys.argv) < 2:
             print("Usage: llmd <path_to_markdown_file>")
+            print("       llmd <files, directories or glob patterns>...")
+            print("       llmd watch <directory>")
+            print("       llmd compact <path_to_markdown_file>")
             return 1
-        markdown_filepath = sys.argv[1]
+        if sys.argv[1] == 'watch':
+            return watch_main(sys.argv[2:])
+        if sys.argv[1] == 'compact':
+            return compact_main(sys.argv[2:])
+
+        parser = argparse.ArgumentParser(prog='llmd', description='Chat with an LLM in a markdown file.')
+        parser.add_argument('paths', nargs='+', help='Markdown files, directories or glob patterns')
+        add_common_arguments(parser)
+        parsed_args = parser.parse_args(sys.argv[1:])
+        respond = response_writer(parsed_args)
+
+        paths = parsed_args.paths
+        if len(paths) > 1 or Path(paths[0]).is_dir() or has_magic(paths[0]):
+            return batch_main(paths, respond=respond)
+        markdown_filepath = paths[0]
+    else:
+        respond = functools.partial(read_and_write_response, use_cache=use_cache)
     
     path_type = validate_file_path(markdown_filepath)
     if path_type == 'exists':
         print("File exists: writing response in place")
-        read_and_write_response(markdown_filepath)
+        respond(markdown_filepath)
     
     if path_type == 'new':
         with open(markdown_filepath,'x') as f:
-            f.write(md_header)
-        # Open EDITOR at line 2
-        editor_command_list = make_editor_command(markdown_filepath,EDITOR)
+            f.write(make_md_header(get_base_config()))
+        # Open the editor at line 2
+        editor_command_list = make_editor_command(markdown_filepath,get_base_config().get('editor_cmd',None))
         if editor_command_list:
             try:
                 subprocess.run(editor_command_list)
@@ -64,6 +135,115 @@ def main(markdown_filepath: str | PathLike[str] | None = None):
             print(f"editor_cmd not set. File created at {markdown_filepath}")
 
 
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options shared by every way of answering prompts"""
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the response cache")
+    parser.add_argument('--profile', action='store_true', help="Print the time spent in each stage of a run")
+    parser.add_argument(
+        '--profile-json', metavar='FILE',
+        help="Append the profile of each run to FILE as a line of JSON ('-' for stdout)",
+    )
+
+
+def response_writer(parsed_args: argparse.Namespace):
+    """read_and_write_response with the options from add_common_arguments"""
+    return functools.partial(
+        read_and_write_response,
+        use_cache=not parsed_args.no_cache,
+        profile=parsed_args.profile,
+        profile_json=parsed_args.profile_json,
+    )
+
+
+def batch_main(paths: list[str], use_cache: bool = True, respond=None) -> int:
+    """Answer the pending prompts in many markdown files concurrently"""
+    from llm_tool.batch import find_markdown_files, run_batch, format_batch_summary
+
+    filepaths = find_markdown_files(paths)
+    if respond is None:
+        respond = functools.partial(read_and_write_response, use_cache=use_cache)
+    summary = run_batch(filepaths, get_base_config(), respond)
+    print(format_batch_summary(summary))
+    return 1 if summary['failed'] else 0
+
+
+def watch_main(args: list[str]) -> int:
+    """Run a resident process that answers prompts when files are saved"""
+    from llm_tool.watch import make_watcher, watch
+
+    parser = argparse.ArgumentParser(
+        prog='llmd watch',
+        description='Answer new prompts in markdown files as they are saved.',
+    )
+    parser.add_argument('directory', help='Directory to watch (recursively)')
+    parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify')
+    add_common_arguments(parser)
+    parsed_args = parser.parse_args(args)
+
+    if not Path(parsed_args.directory).is_dir():
+        print(f"Not a directory: {parsed_args.directory}")
+        return 1
+
+    configs = get_base_config()
+    watcher = make_watcher(
+        parsed_args.directory,
+        poll=parsed_args.poll,
+        poll_interval=configs.get('watch_poll_interval', 1.0),
+    )
+    print(f"Watching {parsed_args.directory} for new prompts. Press Ctrl+C to stop.")
+    try:
+        watch(
+            watcher,
+            configs,
+            response_writer(parsed_args),
+            debounce=configs.get('watch_debounce', 1.0),
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+def compact_main(args: list[str]) -> int:
+    """Archive the old turns of a conversation and replace them with a summary"""
+    from llm_tool.compaction import compact_file
+    from llm_tool.mapped_reader import map_file, parse_mapped_header
+
+    parser = argparse.ArgumentParser(
+        prog='llmd compact',
+        description='Move the old turns of a conversation to a compressed archive, and replace them with a summary.',
+    )
+    parser.add_argument('path', help='The markdown file')
+    parser.add_argument('--keep-turns', type=int, help='The number of recent turns to keep (default from the compact config)')
+    summary = parser.add_mutually_exclusive_group()
+    summary.add_argument('--summary', help="The summary to use, instead of asking the file's model for one")
+    summary.add_argument('--summary-file', help='A file holding the summary to use')
+    parsed_args = parser.parse_args(args)
+
+    if validate_file_path(parsed_args.path) != 'exists':
+        print(f"No such file: {parsed_args.path}")
+        return 1
+    summary_text = parsed_args.summary
+    if parsed_args.summary_file is not None:
+        summary_text = Path(parsed_args.summary_file).read_text(encoding='utf-8')
+
+    with file_lock(parsed_args.path):
+        with map_file(parsed_args.path) as data:
+            config = get_file_config(parse_mapped_header(data)[0])
+        compact_settings = config['compact'] or dict()
+        keep_turns = parsed_args.keep_turns
+        if keep_turns is None:
+            keep_turns = compact_settings.get('keep_turns', 10)
+        compact_file(
+            parsed_args.path,
+            keep_turns,
+            summarise=_summariser(config, Path(parsed_args.path).resolve().parent),
+            summary=summary_text,
+            )
+    return 0
+
+
 def make_editor_command(filepath: str | PathLike[str], editor_command: str | None = None) -> list[str]:
     if editor_command is None:
         return []
@@ -75,48 +255,604 @@ def make_editor_command(filepath: str | PathLike[str], editor_command: str | Non
     return editor_command_list
 
 
-def read_and_write_response(validated_filepath: str | PathLike[str]):
+def read_and_write_response(
+    validated_filepath: str | PathLike[str],
+    use_cache: bool = True,
+    profile: bool = False,
+    profile_json: str | None = None,
+    ):
+    """Answer the new prompt in a markdown file and append the response.
 
-    base_path = Path(validated_filepath).resolve().parent
+    Args:
+        validated_filepath: The markdown file.
+        use_cache: Whether to read and write the response cache.
+        profile: Whether to print a table of the time spent in each stage.
+        profile_json: A file to append the profile to as a line of JSON,
+            or '-' for stdout.
+    """
+    if not profile and profile_json is None:
+        return _read_and_write_response(validated_filepath, use_cache)
 
-    with open(validated_filepath, 'r') as file:
-        content = file.read()
+    from llm_tool.profiling import profiling
 
-    file_config, content_body = parse_markdown_with_yaml(content)
+    with profiling(str(validated_filepath), table=profile, json_path=profile_json):
+        return _read_and_write_response(validated_filepath, use_cache)
 
 
-    config = get_config(
-            [
-                DEFAULT_CONFIG,
-                USER_CONFIG,
-                PROJECT_CONFIG,
-                file_config,
-            ]
-        )
+def _read_and_write_response(validated_filepath: str | PathLike[str], use_cache: bool = True):
+    # Another llmd answering the same file waits here, then finds no new prompt
+    with file_lock(validated_filepath):
+        return _answer_file(validated_filepath, use_cache)
+
+
+def _answer_file(validated_filepath: str | PathLike[str], use_cache: bool = True):
+    mmap_min_mb = get_base_config().get('mmap_min_mb')
+    if mmap_min_mb is not None and os.path.getsize(validated_filepath) >= mmap_min_mb * 1024 * 1024:
+        from llm_tool.mapped_reader import map_file
+
+        # The map stays open until the turns that are sent have been read
+        with map_file(validated_filepath) as data:
+            return _answer_conversation(validated_filepath, use_cache, data)
+    return _answer_conversation(validated_filepath, use_cache)
+
+
+def _answer_conversation(validated_filepath: str | PathLike[str], use_cache: bool = True, data: bytes | None = None):
+
+    base_path = Path(validated_filepath).resolve().parent
+
+    if data is not None:
+        config, parsed_conversation, snapshot = _read_mapped_file(validated_filepath, base_path, data)
+    else:
+        config, parsed_conversation, snapshot = _read_file(validated_filepath, base_path)
+
+    if _auto_compact(validated_filepath, config, parsed_conversation, base_path):
+        data = None
+        config, parsed_conversation, snapshot = _read_file(validated_filepath, base_path)
     
-    parsed_conversation = parse_conversation(
-        content_body,
+    # Mapped turns are hydrated once they have been read
+    if data is None:
+        _hydrate(parsed_conversation, config, base_path)
+
+    models = model_configs(config)
+    if len(models) > 1:
+        return _answer_with_models(validated_filepath, parsed_conversation, models, base_path, snapshot, use_cache, data)
+
+    # Recorded in the header once the answer is logged and written
+    new_conversation_ids = []
+    on_new_conversation = new_conversation_ids.append
+    parsed_conversation = _conversation_for_model(parsed_conversation, config, base_path, data)
+    cache, cache_key, cached_response = _cached_response(parsed_conversation, config, use_cache)
+    if cached_response is not None:
+        write_answer(validated_filepath, '\n' + cached_response, snapshot, config['on_conflict'])
+        return
+
+    if config['stream']:
+        parsed_conversation = _upload_attachments(parsed_conversation, config, base_path)
+        if parsed_conversation['metadata']['has_images']:
+            print('Handling images by using Anthropic API')
+            start = functools.partial(
+                claude_vision_conversation_stream,
+                parsed_file_contents=parsed_conversation,
+                base_path=base_path,
+                config=config,
+                )
+        else:
+            start = functools.partial(
+                llm_conversation_stream,
+                parsed_conversation,
+                config,
+                on_new_conversation=on_new_conversation,
+                )
+        chunks = stream_with_policy(start, config)
+
+        if cache is not None:
+            from llm_tool.response_cache import store_streamed_response
+            chunks = store_streamed_response(chunks, cache, cache_key)
+
+        time_to_first_token = write_streamed_response(validated_filepath, chunks, snapshot, config['on_conflict'])
+        for conversation_id in new_conversation_ids:
+            record_conversation_id(validated_filepath, conversation_id, snapshot)
+        record(time_to_first_token=time_to_first_token)
+        if time_to_first_token is not None:
+            print(f"Time to first token: {time_to_first_token:.2f}s")
+        return
+
+    response = _request_response(parsed_conversation, config, base_path, on_new_conversation)
+
+    if cache is not None and response:
+        cache.put(cache_key, str(response))
+
+    write_answer(validated_filepath, '\n' + str(response), snapshot, config['on_conflict'])
+    for conversation_id in new_conversation_ids:
+        record_conversation_id(validated_filepath, conversation_id, snapshot)
+
+
+def _hydrate(parsed_conversation: dict, config: dict, base_path: Path) -> None:
+    """Read linked files, and images if the conversation has any, in one concurrent pass
+
+    With attachments on, images and linked files big enough to become
+    documents are left for `_upload_attachments`, so that nothing is
+    uploaded for a cached response.
+    """
+    has_images = parsed_conversation['metadata']['has_images']
+    # Only requests to the Anthropic API can refer to uploads
+    uploads = has_images and (config['attachments'] or dict()).get('enabled')
+    if uploads:
+        min_document_kb = config['attachments'].get('min_document_kb', 64)
+        if not config['ignore_links']:
+            with span('hydrate'):
+                hydrate_conversation(
+                    parsed_conversation['conversation'],
+                    base_path,
+                    images=False,
+                    link_budget=config['link_budget'],
+                    defer_links_from=int(min_document_kb * 1024),
+                    )
+    elif not config['ignore_links'] or has_images:
+        with span('hydrate'):
+            hydrate_conversation(
+                parsed_conversation['conversation'],
+                base_path,
+                links=not config['ignore_links'],
+                images=has_images,
+                image_cache=make_image_cache(config) if has_images else None,
+                preprocess=make_preprocess_settings(config) if has_images else None,
+                link_budget=config['link_budget'],
+                )
+
+
+def _upload_attachments(parsed_conversation: dict, config: dict, base_path: Path) -> dict:
+    """The conversation with the images and linked files `_hydrate` left, uploaded
+
+    Called once the response cache has missed. The chunks are copied, as
+    each model asked works on its own copy of the conversation.
+    """
+    if not (config['attachments'] or dict()).get('enabled'):
+        return parsed_conversation
+    # Images may have been dropped to fit the context window, leaving
+    # the big linked files to be read in full
+    has_images = parsed_conversation['metadata']['has_images']
+    conversation = [
+        dict(turn, content=[dict(chunk) for chunk in turn['content']])
+        if isinstance(turn['content'], list) else turn
+        for turn in parsed_conversation['conversation']
+    ]
+    with span('upload_attachments'):
+        hydrate_conversation(
+            conversation,
+            base_path,
+            links=not config['ignore_links'],
+            images=has_images,
+            image_cache=make_image_cache(config) if has_images else None,
+            preprocess=make_preprocess_settings(config) if has_images else None,
+            link_budget=config['link_budget'],
+            attachments=make_attachment_registry(config) if has_images else None,
+            )
+    return dict(parsed_conversation, conversation=conversation)
+
+
+def _summariser(config: dict, base_path: Path):
+    """A function asking the model for a summary of some turns, for `compaction.compact_file`"""
+    summary_prompt = (config['compact'] or dict()).get('summary_prompt', DEFAULT_CONFIG['compact']['summary_prompt'])
+
+    def summarise(markdown: str) -> str:
+        with span('summarise'):
+            parsed_conversation = parse_conversation(
+                markdown,
+                base_path=base_path,
+                ignore_images=config['ignore_images'],
+                ignore_links=config['ignore_links'],
+                )
+            parsed_conversation['conversation'].append(
+                {'role': 'user', 'content': [{'type': 'text', 'text': summary_prompt}]}
+                )
+            _hydrate(parsed_conversation, config, base_path)
+            # The summary isn't part of the logged conversation
+            summary_config = dict(config, persist_conversation=False, models=None)
+            parsed_conversation = _conversation_for_model(parsed_conversation, summary_config)
+            response = _request_response(parsed_conversation, summary_config, base_path)
+        return str(response).removeprefix('\n# %Assistant\n\n')
+
+    return summarise
+
+
+def _auto_compact(validated_filepath: str | PathLike[str], config: dict, parsed_conversation: dict, base_path: Path) -> bool:
+    """Compact a file with a new prompt and more turns than `compact: auto_after_turns`.
+
+    Returns:
+        bool: Whether the file was compacted, and so has to be read again.
+    """
+    from llm_tool.compaction import compact_file
+
+    compact_settings = config['compact'] or dict()
+    auto_after_turns = compact_settings.get('auto_after_turns')
+    if auto_after_turns is None:
+        return False
+    keep_turns = compact_settings.get('keep_turns', 10)
+    if auto_after_turns <= keep_turns + 2:
+        # A compacted file has the kept turns and the summary's two, and
+        # would be compacted again on every prompt
+        raise ValueError(
+            f"compact: auto_after_turns must be more than keep_turns + 2 ({keep_turns + 2}), not {auto_after_turns}"
+            )
+    conversation = parsed_conversation['conversation']
+    # Expanded archives aren't turns of the file
+    file_turns = parsed_conversation['metadata'].get('file_turns', len(conversation))
+    if file_turns <= auto_after_turns or conversation[-1]['role'] != 'user':
+        return False
+    with span('compact'):
+        archive = compact_file(
+            validated_filepath,
+            keep_turns,
+            summarise=_summariser(config, base_path),
+            min_turns=auto_after_turns,
+            )
+    return archive is not None
+
+
+def _expand_archives(parsed_conversation: dict, config: dict, base_path: Path) -> dict:
+    """The parsed conversation with the turns of its archives, if expand_archives is set"""
+    if not config['expand_archives']:
+        return parsed_conversation
+    from llm_tool.compaction import expand_archived_turns
+
+    conversation = expand_archived_turns(
+        parsed_conversation['conversation'],
         base_path=base_path,
         ignore_images=config['ignore_images'],
         ignore_links=config['ignore_links'],
         )
+    metadata = {'has_images': _has_images(conversation), 'file_turns': len(parsed_conversation['conversation'])}
+    return {'conversation': conversation, 'metadata': metadata}
+
+
+def _read_file(validated_filepath: str | PathLike[str], base_path: Path) -> tuple[dict, dict, FileSnapshot]:
+    """Read and parse a markdown file.
+
+    Returns:
+        tuple: (config, parsed_conversation, snapshot) where snapshot is
+        used to check for edits before the answer is written.
+    """
+    with span('read_file'):
+        content, snapshot = read_with_snapshot(validated_filepath)
+
+    with span('config'):
+        file_config, content_body = parse_markdown_with_yaml(content)
+        config = get_file_config(file_config)
     
-    if not config['ignore_links']:
-        parsed_conversation['conversation'] = replace_links_with_file_contents(parsed_conversation['conversation'])
+    with span('parse'):
+        if config['incremental_parse']:
+            from llm_tool.incremental_parser import parse_conversation_incremental, sidecar_index_path
+
+            parsed_conversation = parse_conversation_incremental(
+                content_body,
+                index_path=sidecar_index_path(validated_filepath),
+                base_path=base_path,
+                ignore_images=config['ignore_images'],
+                ignore_links=config['ignore_links'],
+                )
+        else:
+            parsed_conversation = parse_conversation(
+                content_body,
+                base_path=base_path,
+                ignore_images=config['ignore_images'],
+                ignore_links=config['ignore_links'],
+                )
+        parsed_conversation = _expand_archives(parsed_conversation, config, base_path)
+
+    return config, parsed_conversation, snapshot
+
+
+def _read_mapped_file(validated_filepath: str | PathLike[str], base_path: Path, data: bytes) -> tuple[dict, dict, FileSnapshot]:
+    """Read and parse a large markdown file through a memory map.
+
+    Like `_read_file`, but the file is never read into memory as a
+    whole, and the turns are left unread (see `mapped_reader`) for
+    `_conversation_for_model` to read those that are sent.
+    incremental_parse isn't used.
+    """
+    from llm_tool.mapped_reader import parse_mapped_conversation, parse_mapped_header
+
+    with span('read_file'):
+        snapshot = FileSnapshot(data, os.stat(validated_filepath))
+
+    with span('config'):
+        file_config, body_start = parse_mapped_header(data)
+        config = get_file_config(file_config)
+
+    with span('parse'):
+        parsed_conversation = parse_mapped_conversation(
+            data,
+            body_start,
+            base_path=base_path,
+            ignore_images=config['ignore_images'],
+            ignore_links=config['ignore_links'],
+            )
+    parsed_conversation = _expand_archives(parsed_conversation, config, base_path)
+
+    return config, parsed_conversation, snapshot
+
+
+def _conversation_for_model(parsed_conversation: dict, config: dict, base_path: Path | None = None, data: bytes | None = None) -> dict:
+    """The parsed conversation as one model sees it.
+
+    One answer is kept wherever a user turn has several (see
+    `fan_out.select_branch`), and the conversation is fitted to the
+    context window if one is set. For a mapped file (data), the turns
+    that are left are then read from the map and hydrated.
+    """
+    conversation = select_branch(parsed_conversation['conversation'], config['model_name'])
+    metadata = dict(parsed_conversation['metadata'])
+
+    context_window = config['context_window'] or dict()
+    if context_window.get('max_tokens') is not None:
+        with span('fit_context'):
+            conversation = fit_conversation(
+                conversation,
+                context_window['max_tokens'],
+                strategy=context_window.get('strategy', 'drop_oldest'),
+                system_msg=config['system_msg'],
+                options=context_window,
+                )
+            metadata['has_images'] = _has_images(conversation)
+
+    if data is not None:
+        from llm_tool.mapped_reader import read_mapped_turns
+
+        with span('read_mapped_turns'):
+            conversation = read_mapped_turns(
+                data,
+                conversation,
+                base_path=base_path,
+                ignore_images=config['ignore_images'],
+                ignore_links=config['ignore_links'],
+                )
+        metadata['has_images'] = _has_images(conversation)
+        _hydrate({'conversation': conversation, 'metadata': metadata}, config, base_path)
+
+    return {'conversation': conversation, 'metadata': metadata}
+
+
+def _cached_response(parsed_conversation: dict, config: dict, use_cache: bool = True) -> tuple:
+    """Look up the response to a conversation in the response cache.
 
+    Returns:
+        tuple: (cache, cache_key, cached_response), where cache and
+        cache_key are None if the cache isn't used, and cached_response
+        is None on a miss.
+    """
+    conversation = parsed_conversation['conversation']
+    if not (use_cache and config['cache'] and conversation and conversation[-1]['role'] == 'user'):
+        return None, None, None
+
+    from llm_tool.response_cache import make_cache_key, make_response_cache
+
+    with span('response_cache'):
+        cache = make_response_cache(config)
+        cache_key = make_cache_key(parsed_conversation, config)
+        cached_response = cache.get(cache_key)
+    if cached_response is not None:
+        print('Using cached response')
+    return cache, cache_key, cached_response
+
+
+def _request_response(parsed_conversation: dict, config: dict, base_path: Path, on_new_conversation=None) -> str:
+    """Ask the model for the whole response, formatted as an assistant turn
+
+    The request is retried, and hedged, by the config's request_policy
+    (see `request_executor`).
+    """
+    parsed_conversation = _upload_attachments(parsed_conversation, config, base_path)
     if parsed_conversation['metadata']['has_images']:
         print('Handling images by using Anthropic API')
-        response = claude_vision_conversation(
+        call = functools.partial(
+            claude_vision_conversation,
             parsed_file_contents=parsed_conversation,
             base_path=base_path,
             config=config,
             )
     else:
-        response = llm_conversation(parsed_conversation,config)
+        call = functools.partial(
+            llm_conversation,
+            parsed_conversation,
+            config,
+            on_new_conversation=on_new_conversation,
+            )
+    with span('request'):
+        return call_with_policy(call, config)
+
+
+def _answer_with_models(
+    validated_filepath: str | PathLike[str],
+    parsed_conversation: dict,
+    configs: list[dict],
+    base_path: Path,
+    snapshot: FileSnapshot | None = None,
+    use_cache: bool = True,
+    data: bytes | None = None,
+    ):
+    """Ask several models the new prompt concurrently and append every answer.
+
+    Each answer is labelled with its model and written when it arrives,
+    in the order the models are listed. Answers are requested whole, not
+    streamed. A model that fails doesn't stop the others: their answers
+    are written and then the failures are raised.
+
+    Args:
+        validated_filepath: The markdown file.
+        parsed_conversation: The parsed conversation, hydrated unless
+            data is given.
+        configs: The config for each model, from `fan_out.model_configs`.
+        base_path: The directory of the markdown file.
+        snapshot: The file as it was read, to check for edits before
+            each answer is written (see `safe_write.write_answer`).
+        use_cache: Whether to read and write the response cache.
+        data: The mapped file, if the conversation's turns are still to
+            be read from it (see `_read_mapped_file`).
+
+    Raises:
+        RuntimeError: If any model failed.
+    """
+    conversation = parsed_conversation['conversation']
+    if not conversation or conversation[-1]['role'] != 'user':
+        print('No new prompts.')
+        return
+
+    print(f"Asking {len(configs)} models: {', '.join(config['model_name'] for config in configs)}")
+    if configs[0].get('persist_conversation'):
+        print("persist_conversation is ignored when asking several models")
+
+    def answer(config):
+        # One header can't record a logged conversation for each model
+        config = dict(config, persist_conversation=False)
+        parsed = _conversation_for_model(parsed_conversation, config, base_path, data)
+        cache, cache_key, cached_response = _cached_response(parsed, config, use_cache)
+        if cached_response is not None:
+            return cached_response
+        response = _request_response(parsed, config, base_path)
+        if cache is not None and response:
+            cache.put(cache_key, response)
+        return response
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        # Each thread runs in a copy of this context, so spans and metrics
+        # are recorded in the profile of this run
+        futures = [executor.submit(contextvars.copy_context().run, answer, config) for config in configs]
+        for config, future in zip(configs, futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"{config['model_name']} failed: {type(e).__name__}: {e}")
+                failures.append(f"{config['model_name']}: {type(e).__name__}: {e}")
+                continue
+            write_answer(
+                validated_filepath,
+                '\n' + label_response(response, config['model_name']),
+                snapshot,
+                config['on_conflict'],
+                )
+
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(configs)} models failed: {'; '.join(failures)}")
+
+
+def record_conversation_id(
+    filepath: str | PathLike[str],
+    conversation_id: str,
+    snapshot: FileSnapshot | None = None,
+    ) -> None:
+    """Record the id of the llm conversation in the file's YAML header.
+
+    Called once the response is logged and written, so the header never
+    refers to a conversation that isn't in the logs. The file is
+    replaced atomically.
+
+    Args:
+        filepath: The markdown file.
+        conversation_id: The id of the conversation in the llm logs.
+        snapshot: The file as it was read, which is updated with the
+            new header if the file hasn't been edited since.
+    """
+    from llm_tool.mapped_reader import header_end, map_file
+
+    unchanged = snapshot is not None and snapshot.unchanged(filepath)
+    # Only the header is copied out of the file, which may be very large
+    with map_file(filepath) as data, memoryview(data) as view:
+        body_start = header_end(data)
+        header = str(view[:body_start], 'utf-8')
+        updated = set_yaml_header_value(header, 'llm_conversation_id', conversation_id)
+        replace_file(filepath, [updated.encode('utf-8'), view[body_start:]])
+        if unchanged:
+            # The header is before the conversation, so the answer moves with it
+            snapshot.header_replaced(header, updated, view[body_start:], os.stat(filepath))
+
+
+def _remove_partial_answer(file, answer_start: int) -> None:
+    """Truncate a file back to where a failed answer started, unless something else has written to it"""
+    try:
+        file.flush()
+        if os.fstat(file.fileno()).st_size == file.tell():
+            os.ftruncate(file.fileno(), answer_start)
+            print("The response failed: the partial answer was removed")
+    except OSError as e:
+        print(f"Couldn't remove the partial answer: {e}")
+
+
+def write_streamed_response(
+    filepath: str | PathLike[str],
+    chunks: Iterable[str],
+    snapshot: FileSnapshot | None = None,
+    on_conflict: str = 'reanchor',
+    ) -> float | None:
+    """Append a streamed response to a file, flushing as chunks arrive.
+
+    The first chunk is the assistant header, which is written as soon
+    as it is yielded. Each following chunk is appended and flushed so
+    that editors which auto-reload the file show progress. If the
+    response fails, what was written of it is removed again, so that
+    the prompt is still unanswered and can be asked again.
+
+    With a snapshot, the file is checked for edits first. If it has
+    changed, the response is collected and written with
+    `safe_write.write_answer` when it is complete. If the file is
+    changed while the response streams in, the whole response is also
+    written to a side file.
+
+    Args:
+        filepath: The markdown file to append to.
+        chunks: The streamed response, header first.
+        snapshot: The file as it was read.
+        on_conflict: 'reanchor', 'side_file' or 'append'.
+
+    Returns:
+        float | None: Seconds from the start of the request to the first
+        chunk of response text, or None if no text was received.
+    """
+    chunks = iter(chunks)
+    start = time.perf_counter()
+
+    # The backends do their setup before yielding the header
+    with span('prepare_request'):
+        header = next(chunks, None)
+    if header is None:
+        return None
+
+    check = snapshot is not None and on_conflict != 'append'
+    streamed = ['\n' + header]
+    time_to_first_token = None
+
+    if check and not snapshot.unchanged(filepath):
+        with span('stream_response'):
+            for chunk in chunks:
+                if time_to_first_token is None and chunk:
+                    time_to_first_token = time.perf_counter() - start
+                streamed.append(chunk)
+        write_answer(filepath, ''.join(streamed), snapshot, on_conflict)
+        return time_to_first_token
+
+    # Written as UTF-8 without newline translation, to match the snapshot's hashes
+    with span('stream_response'), open(filepath, 'a', encoding='utf-8', newline='') as file:
+        answer_start = file.tell()
+        try:
+            file.write(streamed[0])
+            file.flush()
+            for chunk in chunks:
+                if time_to_first_token is None and chunk:
+                    time_to_first_token = time.perf_counter() - start
+                streamed.append(chunk)
+                with span('write_file'):
+                    file.write(chunk)
+                    file.flush()
+        except BaseException:
+            _remove_partial_answer(file, answer_start)
+            raise
+        stat = os.fstat(file.fileno())
 
-    with open(validated_filepath,'a') as file:
-        file.write('\n' + str(response))
+    if check:
+        finish_streamed_answer(filepath, ''.join(streamed), snapshot, stat)
 
+    return time_to_first_token
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
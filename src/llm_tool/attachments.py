@@ -0,0 +1,284 @@
+"""Uploading images and large linked files once, with the Anthropic Files API.
+
+Without attachments, every request sends every image in the conversation
+as base64, and every linked file as text, however many times they have
+been sent before. With `attachments: enabled: true`, conversations that
+go to the Anthropic API (those with images) upload each image, and each
+linked file of `min_document_kb` or more, once. Later requests refer to
+the upload by its file id.
+
+Uploads are recorded in an index keyed on a hash of the file's content,
+in the user cache dir, with one index per API key. An upload is asked to
+expire after `ttl_days`, and the index entry expires with it, after
+which the file is uploaded again. If the API says that a file id in a
+request doesn't exist (it was deleted, say), the files in the request
+are uploaded again and the request is retried once.
+"""
+from os import PathLike
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from llm_tool.image_preprocessing import media_type_for
+from llm_tool.response_cache import _file_sha256
+
+FILES_API_BETA = 'files-api-2025-04-14'
+
+# The expiry the Files API accepts, in seconds
+_MIN_TTL = 3600
+_MAX_TTL = 90 * 24 * 3600
+
+# An upload this close to expiring is uploaded again rather than reused
+_EXPIRY_MARGIN = 3600
+
+# Media types the Files API takes as documents
+DOCUMENT_MEDIA_TYPES = {'.pdf': 'application/pdf'}
+
+# The size of each file id this process has uploaded or reused, for
+# estimating the tokens of document chunks (see `uploaded_file_size`)
+_file_sizes = dict()
+
+
+def client_namespace(client) -> str:
+    """A name for the account a client uploads to, without its API key
+
+    File ids from one API key can't be used with another, so each has
+    its own index.
+    """
+    identity = f"{getattr(client, 'base_url', '')}|{getattr(client, 'api_key', '') or ''}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def file_ids(request_kwargs: dict) -> list[str]:
+    """
+    The file ids referred to by the messages of a request.
+
+    Examples
+    --------
+    >>> file_ids({'messages': [{'role': 'user', 'content': [
+    ...     {'type': 'image', 'source': {'type': 'file', 'file_id': 'file_1'}},
+    ...     {'type': 'text', 'text': 'What is this?'}]}]})
+    ['file_1']
+    """
+    ids = []
+    for message in request_kwargs.get('messages', []):
+        if not isinstance(message['content'], list):
+            continue
+        for block in message['content']:
+            source = block.get('source')
+            if isinstance(source, dict) and source.get('type') == 'file':
+                ids.append(source['file_id'])
+    return ids
+
+
+def uploaded_file_size(file_id: str) -> int | None:
+    """The size in bytes of an upload this process used, or None if it didn't use it"""
+    return _file_sizes.get(file_id)
+
+
+def is_missing_file_error(error: Exception, ids: list[str]) -> bool:
+    """
+    Whether an API error says that one of the file ids of a request doesn't exist.
+
+    The API answers with a not_found_error, as it does for a model that
+    doesn't exist, so the error must also name one of the file ids.
+
+    Examples
+    --------
+    >>> from llm_tool.mock_models import MockNotFoundError
+    >>> is_missing_file_error(MockNotFoundError("File not found: file_1"), ['file_1'])
+    True
+    >>> is_missing_file_error(MockNotFoundError("Model not found"), ['file_1'])
+    False
+    """
+    # anthropic's APIStatusError.body, {'type': 'error', 'error': {'type': ..., 'message': ...}}
+    body = getattr(error, 'body', None)
+    detail = body.get('error') if isinstance(body, dict) else None
+    if isinstance(detail, dict):
+        if detail.get('type') != 'not_found_error':
+            return False
+        message = str(detail.get('message', ''))
+    elif getattr(error, 'status_code', None) == 404:
+        message = str(error)
+    else:
+        return False
+    return any(file_id in message for file_id in ids)
+
+
+class AttachmentRegistry:
+    """
+    Files uploaded with the Files API, keyed on a hash of their content.
+
+    Safe to use from several threads. The index is saved after each
+    upload, merged with any changes other processes made to it.
+
+    Parameters
+    ----------
+    index_dir : str or PathLike
+        Where to keep the index.
+    client : anthropic.Anthropic or MockAnthropicClient
+        The client to upload with.
+    ttl_days : float
+        How long uploads are kept, between an hour and 90 days.
+    min_document_kb : float
+        The size from which linked files are uploaded as documents
+        instead of being sent as text.
+    """
+
+    def __init__(
+        self,
+        index_dir: str | PathLike[str],
+        client,
+        ttl_days: float = 30,
+        min_document_kb: float = 64,
+        ):
+        self.client = client
+        self.index_path = Path(index_dir) / f"{client_namespace(client)}.json"
+        self.ttl_seconds = int(min(max(ttl_days * 24 * 3600, _MIN_TTL), _MAX_TTL))
+        self.min_document_bytes = int(min_document_kb * 1024)
+        self.uploaded = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._index = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return index if isinstance(index, dict) else dict()
+
+    def _save(self) -> None:
+        now = time.time()
+        index = {**self._load(), **self._index}
+        self._index = {key: entry for key, entry in index.items() if entry['expires_at'] > now}
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_path.parent, prefix=self.index_path.name, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Couldn't save the attachment index: {e}")
+
+    def _upload(self, path: Path, media_type: str) -> dict:
+        with open(path, 'rb') as f:
+            metadata = self.client.beta.files.upload(
+                file=(path.name, f, media_type),
+                expires_in_seconds=self.ttl_seconds,
+                betas=[FILES_API_BETA],
+                )
+        expires_at = getattr(metadata, 'expires_at', None)
+        return {
+            'file_id': metadata.id,
+            # The API gives a datetime, if anything
+            'expires_at': expires_at.timestamp() if expires_at is not None else time.time() + self.ttl_seconds,
+            'path': str(path),
+            'media_type': media_type,
+        }
+
+    def file_id(self, path: str | PathLike[str], media_type: str, force: bool = False) -> str:
+        """
+        The file id of an upload of this file's content, uploading it if needed.
+
+        Parameters
+        ----------
+        path : str or PathLike
+            The file.
+        media_type : str
+            Its media type, such as 'image/png'.
+        force : bool
+            Upload the file even if it has an unexpired upload.
+
+        Returns
+        -------
+        str
+        """
+        path = Path(path).resolve()
+        key = _file_sha256(path)
+        with self._lock:
+            entry = self._index.get(key)
+        if not force and entry is not None and entry['expires_at'] > time.time() + _EXPIRY_MARGIN:
+            with self._lock:
+                self.reused += 1
+            _file_sizes[entry['file_id']] = os.path.getsize(path)
+            return entry['file_id']
+
+        entry = self._upload(path, media_type)
+        with self._lock:
+            self._index[key] = entry
+            self.uploaded += 1
+            self._save()
+        _file_sizes[entry['file_id']] = os.path.getsize(path)
+        return entry['file_id']
+
+    def image_source(self, path: str | PathLike[str], media_type: str | None = None) -> dict:
+        """An image source referring to an upload of the image"""
+        media_type = media_type or media_type_for(path)
+        return {'type': 'file', 'file_id': self.file_id(path, media_type)}
+
+    def wants_document(self, path: str | PathLike[str]) -> bool:
+        """Whether a linked file is big enough to upload as a document"""
+        return os.path.getsize(path) >= self.min_document_bytes
+
+    def document_block(self, path: str | PathLike[str]) -> dict:
+        """A document content block referring to an upload of a linked file"""
+        path = Path(path)
+        media_type = DOCUMENT_MEDIA_TYPES.get(path.suffix.lower(), 'text/plain')
+        return {
+            'type': 'document',
+            'source': {'type': 'file', 'file_id': self.file_id(path, media_type)},
+            'title': path.name,
+        }
+
+    def reupload(self, request_kwargs: dict) -> dict:
+        """
+        Upload the files in a request again, after the API didn't find one.
+
+        Returns
+        -------
+        dict
+            A copy of request_kwargs with the new file ids.
+        """
+        with self._lock:
+            by_id = {entry['file_id']: entry for entry in self._index.values()}
+        new_ids = dict()
+        for file_id in dict.fromkeys(file_ids(request_kwargs)):
+            entry = by_id.get(file_id)
+            if entry is None or not os.path.exists(entry['path']):
+                continue
+            new_ids[file_id] = self.file_id(entry['path'], entry['media_type'], force=True)
+
+        messages = []
+        for message in request_kwargs['messages']:
+            if isinstance(message['content'], list):
+                message = dict(message, content=[
+                    dict(block, source=dict(block['source'], file_id=new_ids[block['source']['file_id']]))
+                    if isinstance(block.get('source'), dict) and block['source'].get('file_id') in new_ids
+                    else block
+                    for block in message['content']
+                ])
+            messages.append(message)
+        return dict(request_kwargs, messages=messages)
+
+
+def make_attachment_registry(config: dict, client=None) -> AttachmentRegistry | None:
+    """The attachment registry for the attachments config, or None if it is off"""
+    settings = config.get('attachments') or dict()
+    if not settings.get('enabled'):
+        return None
+    from llm_tool.config_and_system import get_user_cache_dir
+
+    if client is None:
+        from llm_tool.claude_vision import get_client
+
+        client = get_client(config)
+    return AttachmentRegistry(
+        get_user_cache_dir('attachments'),
+        client,
+        ttl_days=settings.get('ttl_days', 30),
+        min_document_kb=settings.get('min_document_kb', 64),
+    )
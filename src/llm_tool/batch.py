@@ -0,0 +1,206 @@
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob, has_magic
+from os import PathLike
+from pathlib import Path
+import time
+from llm_tool.parser import parse_conversation, parse_markdown_with_yaml
+from llm_tool.llm_conversation import chunk_user_assistant_turns
+from llm_tool.config_and_system import merge_configs
+from llm_tool.fan_out import model_names
+
+
+def find_markdown_files(paths: Iterable[str | PathLike[str]]) -> list[Path]:
+    """
+    Expand files, directories and glob patterns into a list of markdown files.
+
+    Directories are searched recursively for `*.md` files. Duplicates are
+    removed and the order of first appearance is kept.
+
+    Parameters
+    ----------
+    paths : iterable of str or PathLike
+        Markdown file paths, directories or glob patterns.
+
+    Returns
+    -------
+    list of Path
+        The resolved markdown file paths.
+
+    Examples
+    --------
+    >>> find_markdown_files(["notes/", "chats/*.md"])
+    [PosixPath('/vault/notes/a.md'), PosixPath('/vault/chats/b.md')]
+    """
+    found = dict()
+    for path in paths:
+        path = str(path)
+        if has_magic(path):
+            candidates = [Path(p) for p in sorted(glob(path, recursive=True))]
+        elif Path(path).is_dir():
+            candidates = sorted(Path(path).rglob('*.md'))
+        else:
+            candidates = [Path(path)]
+        for candidate in candidates:
+            if candidate.is_file() and candidate.suffix == '.md':
+                found.setdefault(candidate.resolve(), None)
+    return list(found)
+
+
+def pending_model(filepath: str | PathLike[str], base_config: dict) -> str | None:
+    """
+    Return the model that should answer a file, or None if nothing is pending.
+
+    A file is pending when its last turn is a `# %User` turn with no
+    `# %Assistant` response. Links and images are not resolved, so this
+    is cheap enough to run over a whole vault.
+
+    Parameters
+    ----------
+    filepath : str or PathLike
+        Path to the markdown file.
+    base_config : dict
+        The merged DEFAULT, USER and PROJECT configs.
+
+    Returns
+    -------
+    str or None
+        The model name from the merged config and yaml header, or None.
+        A list of models is joined with commas.
+    """
+    models = _pending_models(filepath, base_config)
+    return None if models is None else ', '.join(models)
+
+
+def _pending_models(filepath: str | PathLike[str], base_config: dict) -> tuple[str, ...] | None:
+    """`pending_model`, with each of a list of models"""
+    content = Path(filepath).read_text()
+    file_config, content_body = parse_markdown_with_yaml(content)
+    parsed = parse_conversation(content_body, ignore_images=True, ignore_links=True)
+    chunked_conversation = chunk_user_assistant_turns(parsed['conversation'])
+    if not chunked_conversation or 'assistant' in chunked_conversation[-1]:
+        return None
+    return tuple(model_names(merge_configs([base_config, file_config]).get('model')))
+
+
+def run_batch(
+    filepaths: Iterable[str | PathLike[str]],
+    base_config: dict,
+    respond: Callable[[str | PathLike[str]], None],
+    ) -> dict:
+    """
+    Answer every pending file concurrently with a bounded worker pool.
+
+    The pool size is set by `batch_max_workers` in the config. Each model
+    can be limited further with `model_concurrency`, a mapping of model
+    name to the maximum number of requests in flight for that model. A
+    file is only handed to the pool once its model is below its limit,
+    in the order the files were given. A file asking several models
+    takes a permit for each of them.
+
+    Parameters
+    ----------
+    filepaths : iterable of str or PathLike
+        Markdown files to check, usually from `find_markdown_files`.
+    base_config : dict
+        The merged DEFAULT, USER and PROJECT configs.
+    respond : callable
+        Called with each pending filepath to write the response in place,
+        normally `read_and_write_response`.
+
+    Returns
+    -------
+    dict
+        A summary with the keys 'checked', 'pending', 'answered',
+        'failed' (a dict of filepath to error message) and 'elapsed'
+        (seconds).
+    """
+    start = time.perf_counter()
+    filepaths = list(filepaths)
+
+    pending = dict()
+    failed = dict()
+    for filepath in filepaths:
+        try:
+            models = _pending_models(filepath, base_config)
+        except Exception as e:
+            failed[str(filepath)] = f"{type(e).__name__}: {e}"
+            continue
+        if models is not None:
+            pending[filepath] = models
+
+    max_workers = base_config.get('batch_max_workers', 4)
+    model_limits = base_config.get('model_concurrency') or dict()
+    limits = {
+        model_name: model_limits.get(model_name, max_workers)
+        for models in pending.values() for model_name in models
+    }
+    # Files wait here, not in the pool, until each of their models has a
+    # free permit, so files for a busy model don't hold workers other
+    # models could use. Files asking the same models share a queue.
+    queues = {models: deque() for models in set(pending.values())}
+    for i, (filepath, models) in enumerate(pending.items()):
+        queues[models].append((i, filepath))
+    in_flight = dict.fromkeys(limits, 0)
+
+    def next_file():
+        """The first waiting file whose models all have a free permit, or None"""
+        ready = [
+            models for models, queue in queues.items()
+            if queue and all(in_flight[model_name] < limits[model_name] for model_name in models)
+        ]
+        if not ready:
+            return None
+        models = min(ready, key=lambda models: queues[models][0][0])
+        return queues[models].popleft()[1], models
+
+    def answer(filepath, models):
+        print(f"Answering {filepath} with {', '.join(models)}")
+        respond(filepath)
+
+    answered = 0
+    if pending:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = dict()
+            while True:
+                while len(running) < max_workers and (item := next_file()) is not None:
+                    filepath, models = item
+                    # A permit for each model, always taken in sorted order
+                    for model_name in sorted(set(models)):
+                        in_flight[model_name] += 1
+                    running[executor.submit(answer, filepath, models)] = (filepath, models)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepath, models = running.pop(future)
+                    for model_name in sorted(set(models)):
+                        in_flight[model_name] -= 1
+                    try:
+                        future.result()
+                        answered += 1
+                    except Exception as e:
+                        failed[str(filepath)] = f"{type(e).__name__}: {e}"
+
+    return {
+        'checked': len(filepaths),
+        'pending': len(pending),
+        'answered': answered,
+        'failed': failed,
+        'elapsed': time.perf_counter() - start,
+    }
+
+
+def format_batch_summary(summary: dict) -> str:
+    """Format the summary returned by `run_batch` for printing"""
+    elapsed = summary['elapsed']
+    throughput = summary['answered'] / elapsed if elapsed > 0 else 0.0
+    lines = [
+        f"Checked {summary['checked']} files, {summary['pending']} pending.",
+        f"Answered {summary['answered']} in {elapsed:.1f}s ({throughput:.2f} files/s).",
+    ]
+    if summary['failed']:
+        lines.append(f"{len(summary['failed'])} failed:")
+        lines.extend(f"  {path}: {error}" for path, error in summary['failed'].items())
+    return '\n'.join(lines)
@@ -1,30 +1,259 @@
-import anthropic
-from dotenv import load_dotenv, find_dotenv
-from llm_tool.image_handlers import add_image_data_to_conversation
+from collections.abc import Iterator
+import asyncio
+import contextlib
+import json
+import threading
+import time
+import weakref
+from llm_tool.attachments import FILES_API_BETA, file_ids, is_missing_file_error, make_attachment_registry
+from llm_tool.config_and_system import load_env_file
+from llm_tool.image_handlers import add_image_data_to_conversation, make_image_cache, make_preprocess_settings
+from llm_tool.mock_models import MockAnthropicClient, MockAsyncAnthropicClient, is_mock_model
+from llm_tool.profiling import is_profiling, record, span
+from llm_tool.prompt_cache import add_cache_breakpoints, format_cache_usage
 
-load_dotenv(find_dotenv()) # Loads ANTHROPIC_API_KEY from .env
+# Clients are shared, so that requests reuse keep-alive connections from
+# one pool instead of each doing a new TLS handshake. They are keyed on
+# their settings, and async clients also on their event loop, because
+# their connections can't be used from another loop.
+_clients = dict()
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
 
-def claude_vision_conversation(
-    parsed_file_contents: dict, 
-    base_path: str,
-    config: dict,
-    ) -> str:
 
-    client = anthropic.Anthropic()
+def _client_settings(config: dict | None) -> tuple:
+    settings = (config or dict()).get('api_client') or dict()
+    return (
+        settings.get('timeout', 600),
+        settings.get('connect_timeout', 10),
+        settings.get('max_connections', 20),
+        settings.get('max_keepalive_connections', 10),
+        settings.get('max_retries', 2),
+    )
+
+
+def _client_kwargs(settings: tuple, http_client_class) -> dict:
+    """Keyword arguments for an Anthropic client with these settings"""
+    try:
+        # Newer SDKs are built on their own fork of httpx
+        import httpx2 as httpx
+    except ImportError:
+        import httpx
+    timeout, connect_timeout, max_connections, max_keepalive_connections, max_retries = settings
+    timeout = httpx.Timeout(timeout, connect=connect_timeout)
+    return dict(
+        timeout=timeout,
+        max_retries=max_retries,
+        http_client=http_client_class(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        ),
+    )
+
+
+def get_client(config: dict | None = None):
+    """
+    The shared Anthropic client, created on first use.
+
+    The SDK is imported, and API keys are loaded from .env, only when the
+    first client is made. The client's connection pool and timeouts come
+    from the `api_client` config. For the 'mock' model, an offline
+    `MockAnthropicClient` is returned instead.
+
+    Args:
+        config (dict | None): The output of `get_config`, or None for the
+            default settings.
+
+    Returns:
+        anthropic.Anthropic: A client shared by every caller with the same
+            settings. It is safe to use from several threads.
+    """
+    if is_mock_model((config or dict()).get('model_name')):
+        return MockAnthropicClient()
+    settings = _client_settings(config)
+    with _clients_lock:
+        client = _clients.get(settings)
+        if client is None:
+            import anthropic
+            load_env_file() # Loads ANTHROPIC_API_KEY from .env
+            client = anthropic.Anthropic(**_client_kwargs(settings, anthropic.DefaultHttpxClient))
+            _clients[settings] = client
+    return client
+
 
+def get_async_client(config: dict | None = None):
+    """
+    The shared AsyncAnthropic client for the running event loop.
+
+    Like `get_client`, but must be called from a coroutine. Each event
+    loop gets its own client.
+
+    Returns:
+        anthropic.AsyncAnthropic
+    """
+    if is_mock_model((config or dict()).get('model_name')):
+        return MockAsyncAnthropicClient()
+    loop = asyncio.get_running_loop()
+    settings = _client_settings(config)
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, dict())
+        client = clients.get(settings)
+        if client is None:
+            import anthropic
+            load_env_file()
+            client = anthropic.AsyncAnthropic(**_client_kwargs(settings, anthropic.DefaultAsyncHttpxClient))
+            clients[settings] = client
+    return client
+
+
+def _make_request_kwargs(parsed_file_contents: dict, base_path: str, config: dict) -> dict:
+    """Build the keyword arguments for a messages API request"""
     conversation = parsed_file_contents['conversation']
-    rehydrated_conversation = add_image_data_to_conversation(conversation,base_path)
+    rehydrated_conversation = add_image_data_to_conversation(
+        conversation,
+        base_path,
+        cache=make_image_cache(config),
+        preprocess=make_preprocess_settings(config),
+        )
 
-    # return rehydrated_conversation
+    model_options = dict(config['model_options'])
 
-    message = client.messages.create(
+    request_kwargs = dict(
         model=config['model_name'],
         system=config['system_msg'],
-        max_tokens=config['model_options'].pop('max_tokens',4096),
-        messages= rehydrated_conversation,
-        **config['model_options']
+        max_tokens=model_options.pop('max_tokens',4096),
+        # Turns can carry parser metadata such as low_priority
+        messages=[{'role': turn['role'], 'content': turn['content']} for turn in rehydrated_conversation],
+        **model_options
     )
+    if config.get('prompt_cache'):
+        request_kwargs = add_cache_breakpoints(request_kwargs)
+    if file_ids(request_kwargs):
+        request_kwargs['betas'] = [FILES_API_BETA]
+    if is_profiling():
+        record(bytes_sent=len(json.dumps(request_kwargs).encode('utf-8')))
+    return request_kwargs
+
+
+def _messages_api(client, request_kwargs: dict):
+    """client.messages, or client.beta.messages for requests that use beta features"""
+    return client.beta.messages if 'betas' in request_kwargs else client.messages
+
+
+def _reupload_files(error: Exception, request_kwargs: dict, config: dict, client) -> dict:
+    """The request with its files uploaded again, if it failed because one was missing
+
+    Raises:
+        Exception: error, if it wasn't about a missing file.
+    """
+    ids = file_ids(request_kwargs)
+    registry = make_attachment_registry(config, client) if ids else None
+    if registry is None or not is_missing_file_error(error, ids):
+        raise error
+    print(f"Uploading attachments again: {error}")
+    return registry.reupload(request_kwargs)
+
+
+def _create_message(client, request_kwargs: dict, config: dict):
+    try:
+        return _messages_api(client, request_kwargs).create(**request_kwargs)
+    except Exception as e:
+        request_kwargs = _reupload_files(e, request_kwargs, config, client)
+    return _messages_api(client, request_kwargs).create(**request_kwargs)
+
+
+def _stream_message(client, request_kwargs: dict, config: dict) -> Iterator[str]:
+    """Yield the text of a streamed message, and return the final message"""
+    with contextlib.ExitStack() as stack:
+        try:
+            stream = stack.enter_context(_messages_api(client, request_kwargs).stream(**request_kwargs))
+        except Exception as e:
+            request_kwargs = _reupload_files(e, request_kwargs, config, client)
+            stream = stack.enter_context(_messages_api(client, request_kwargs).stream(**request_kwargs))
+        yield from stream.text_stream
+        return stream.get_final_message()
+
+
+def _report_usage(message) -> None:
+    usage = getattr(message, 'usage', None)
+    record(
+        input_tokens=getattr(usage, 'input_tokens', None),
+        output_tokens=getattr(usage, 'output_tokens', None),
+        )
+    cache_usage = format_cache_usage(usage)
+    if cache_usage is not None:
+        print(cache_usage)
+
+
+def claude_vision_conversation(
+    parsed_file_contents: dict,
+    base_path: str,
+    config: dict,
+    ) -> str:
+
+    client = get_client(config)
+
+    with span('build_request'):
+        request_kwargs = _make_request_kwargs(parsed_file_contents, base_path, config)
+    start = time.perf_counter()
+    message = _create_message(client, request_kwargs, config)
+    print(f"Request latency: {time.perf_counter() - start:.2f}s")
+    _report_usage(message)
+
+    response = message.content[0].text
+    formatted_response = "\n# %Assistant\n\n" + response
+    return formatted_response
+
+
+def claude_vision_conversation_stream(
+    parsed_file_contents: dict,
+    base_path: str,
+    config: dict,
+    ) -> Iterator[str]:
+    """Stream a response from the Anthropic API.
+
+    The first chunk yielded is the "\\n# %Assistant\\n\\n" header, followed
+    by chunks of response text as they arrive.
+    """
+    client = get_client(config)
+
+    with span('build_request'):
+        request_kwargs = _make_request_kwargs(parsed_file_contents, base_path, config)
+
+    yield "\n# %Assistant\n\n"
+
+    start = time.perf_counter()
+    message = yield from _stream_message(client, request_kwargs, config)
+    print(f"Request latency: {time.perf_counter() - start:.2f}s")
+    _report_usage(message)
+
+
+async def async_claude_vision_conversation(
+    parsed_file_contents: dict,
+    base_path: str,
+    config: dict,
+    ) -> str:
+    """The async version of `claude_vision_conversation`.
+
+    Uses the shared AsyncAnthropic client for the running event loop, so
+    many conversations can be answered concurrently over a few keep-alive
+    connections. Images are read and encoded in a worker thread.
+    """
+    client = get_async_client(config)
+
+    request_kwargs = await asyncio.to_thread(_make_request_kwargs, parsed_file_contents, base_path, config)
+    start = time.perf_counter()
+    try:
+        message = await _messages_api(client, request_kwargs).create(**request_kwargs)
+    except Exception as e:
+        request_kwargs = await asyncio.to_thread(_reupload_files, e, request_kwargs, config, get_client(config))
+        message = await _messages_api(client, request_kwargs).create(**request_kwargs)
+    print(f"Request latency: {time.perf_counter() - start:.2f}s")
+    _report_usage(message)
 
     response = message.content[0].text
     formatted_response = "\n# %Assistant\n\n" + response
-    return formatted_response
\ No newline at end of file
+    return formatted_response
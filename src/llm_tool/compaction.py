@@ -0,0 +1,246 @@
+"""Archiving the old turns of a long conversation.
+
+`llmd compact <file>` moves all but the last `keep_turns` turns of a
+conversation into a gzipped archive next to the markdown file,
+`<name>.llmd-archive-<n>.md.gz`, and puts a summary in their place:
+
+    # %User
+    <!--llm archive: chat.llmd-archive-1.md.gz llm-->
+    A summary of our conversation so far...
+
+    # %Assistant
+
+    OK.
+
+The summary is written by the model, or given on the command line. The
+file, and so the time to parse it and the size of each prompt, then
+stays bounded however long the conversation goes on. With
+`compact: auto_after_turns` set, a file with more turns than that is
+compacted before its new prompt is answered.
+
+The archived turns are kept exactly as they were written, so compacting
+again archives the previous summary with them, and archives nest. With
+`expand_archives: true` the summary is replaced by the turns it archives
+when the file is parsed (`expand_archived_turns`).
+"""
+from collections.abc import Callable
+from os import PathLike
+from pathlib import Path
+import gzip
+import os
+from llm_tool.parser import parse_conversation, _YAML_HEADER
+from llm_tool.safe_write import read_with_snapshot, replace_file
+from llm_tool.scanner import scan_conversation
+
+SUMMARY_ACKNOWLEDGEMENT = "OK."
+
+
+def new_archive_path(markdown_filepath: str | PathLike[str]) -> Path:
+    """The first unused archive path next to a markdown file
+
+    >>> new_archive_path('/notes/chat.md')
+    PosixPath('/notes/chat.llmd-archive-1.md.gz')
+    """
+    path = Path(markdown_filepath)
+    n = 1
+    while (archive := path.with_name(f"{path.stem}.llmd-archive-{n}{path.suffix}.gz")).exists():
+        n += 1
+    return archive
+
+
+def read_archive(archive_path: str | PathLike[str]) -> str:
+    """The markdown of the turns in an archive"""
+    with gzip.open(archive_path, 'rt', encoding='utf-8', newline='') as file:
+        return file.read()
+
+
+def write_archive(archive_path: str | PathLike[str], markdown: str) -> None:
+    """Write the markdown of some turns to a new archive"""
+    with gzip.open(archive_path, 'xt', encoding='utf-8', newline='') as file:
+        file.write(markdown)
+
+
+def summary_turns(archive_name: str, summary: str) -> str:
+    """
+    The turns that take the place of archived turns.
+
+    The summary is a user turn, answered so that the conversation still
+    alternates between user and assistant.
+
+    Examples
+    --------
+    >>> print(summary_turns('chat.llmd-archive-1.md.gz', 'We said hello.'))
+    # %User
+    <!--llm archive: chat.llmd-archive-1.md.gz llm-->
+    A summary of our conversation so far:
+    <BLANKLINE>
+    We said hello.
+    <BLANKLINE>
+    # %Assistant
+    <BLANKLINE>
+    OK.
+    <BLANKLINE>
+    <BLANKLINE>
+    """
+    return (
+        f"# %User\n<!--llm archive: {archive_name} llm-->\n"
+        f"A summary of our conversation so far:\n\n{summary.strip()}\n\n"
+        f"# %Assistant\n\n{SUMMARY_ACKNOWLEDGEMENT}\n\n"
+    )
+
+
+def compaction_point(turns: list[dict], keep_turns: int) -> int | None:
+    """
+    The index of the first turn to keep, so that at least keep_turns are kept.
+
+    Turns are only archived up to a user turn, so that every answer kept
+    stays with its prompt.
+
+    Returns
+    -------
+    int or None
+        None if there is nothing to archive.
+
+    Raises
+    ------
+    ValueError
+        If keep_turns is less than 1: the last prompt is always kept.
+
+    Examples
+    --------
+    >>> turns = [{'role': role} for role in ['user', 'assistant'] * 3]
+    >>> compaction_point(turns, 2)
+    4
+    >>> compaction_point(turns, 3)
+    2
+    >>> compaction_point(turns, 6) is None
+    True
+    """
+    if keep_turns < 1:
+        raise ValueError(f"keep_turns must be at least 1, not {keep_turns}")
+    for index in range(len(turns) - keep_turns, 0, -1):
+        if turns[index]['role'] == 'user':
+            return index
+    return None
+
+
+def compact_file(
+    markdown_filepath: str | PathLike[str],
+    keep_turns: int,
+    summarise: Callable[[str], str] | None = None,
+    summary: str | None = None,
+    min_turns: int = 0,
+    ) -> Path | None:
+    """
+    Archive the old turns of a markdown file and replace them with a summary.
+
+    The caller should hold the file's lock (`safe_write.file_lock`). The
+    archive is written before the file is replaced, and the file is left
+    alone if it changed while the summary was written.
+
+    Parameters
+    ----------
+    markdown_filepath : str or PathLike
+        The markdown file.
+    keep_turns : int
+        The number of recent turns to keep (see `compaction_point`).
+    summarise : callable or None
+        Called with the markdown of the turns to archive, to write their
+        summary, if summary isn't given.
+    summary : str or None
+        The summary to use.
+    min_turns : int
+        Leave the file alone unless it has more turns than this.
+
+    Returns
+    -------
+    Path or None
+        The archive, or None if nothing was archived.
+    """
+    content, snapshot = read_with_snapshot(markdown_filepath)
+    match = _YAML_HEADER.match(content)
+    body_start = match.end() if match else 0
+    turns = scan_conversation(content[body_start:])['turns']
+    if len(turns) <= min_turns:
+        return None
+    keep_from = compaction_point(turns, keep_turns)
+    if keep_from is None:
+        print(f"Nothing to compact in {markdown_filepath}")
+        return None
+
+    archive_start = body_start + turns[0]['start']
+    archive_end = body_start + turns[keep_from]['start']
+    archived = content[archive_start:archive_end]
+    if summary is None:
+        summary = summarise(archived)
+
+    archive = new_archive_path(markdown_filepath)
+    write_archive(archive, archived)
+    if not snapshot.unchanged(markdown_filepath):
+        os.unlink(archive)
+        print(f"{markdown_filepath} changed while it was being compacted: it was left as it was")
+        return None
+    compacted = content[:archive_start] + summary_turns(archive.name, summary) + content[archive_end:]
+    replace_file(markdown_filepath, [compacted.encode('utf-8')])
+    print(f"Archived {keep_from} turns of {markdown_filepath} to {archive}")
+    return archive
+
+
+def expand_archived_turns(
+    conversation: list[dict],
+    base_path: str | PathLike[str] = '.',
+    ignore_images: bool = False,
+    ignore_links: bool = False,
+    ) -> list[dict]:
+    """
+    Replace each summary of archived turns with the turns themselves.
+
+    The answer to the summary goes with it. Nested archives are
+    expanded too. A summary whose archive is missing, or outside
+    base_path, is kept.
+
+    Parameters
+    ----------
+    conversation : list of dict
+        A parsed conversation, whose summary turns have an 'archive'.
+    base_path : str or PathLike
+        The directory of the markdown file, which archives are next to.
+    ignore_images, ignore_links
+        As for `parse_conversation`.
+
+    Returns
+    -------
+    list of dict
+        The conversation with the archived turns.
+    """
+    expanded = []
+    skip_answer = False
+    for turn in conversation:
+        if skip_answer and turn['role'] == 'assistant':
+            skip_answer = False
+            continue
+        skip_answer = False
+        archive = turn.get('archive')
+        if archive is None:
+            expanded.append(turn)
+            continue
+        archive_path = (Path(base_path) / archive).resolve()
+        if not archive_path.is_relative_to(Path(base_path).resolve()):
+            print(f"Archive {archive} is outside {base_path}: using its summary")
+            expanded.append(turn)
+            continue
+        try:
+            markdown = read_archive(archive_path)
+        except FileNotFoundError:
+            print(f"Archive {archive} not found: using its summary")
+            expanded.append(turn)
+            continue
+        expanded += parse_conversation(
+            markdown,
+            base_path=base_path,
+            ignore_images=ignore_images,
+            ignore_links=ignore_links,
+            expand_archives=True,
+            )['conversation']
+        skip_answer = True
+    return expanded
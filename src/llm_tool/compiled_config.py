@@ -0,0 +1,124 @@
+"""A cache of the merged DEFAULT, USER and PROJECT configs.
+
+Loading the YAML configs, merging them and rendering the system message
+from the `sys_` snippets happens on every run, and with a large snippet
+library the YAML parsing dominates startup. The result is pickled in the
+user cache dir and reused for as long as the config files are unchanged,
+which is checked from their modification times and sizes.
+"""
+from os import PathLike
+from pathlib import Path
+import copy
+import os
+import pickle
+import tempfile
+from llm_tool import __version__
+from llm_tool.config_and_system import get_config, load_config_or_empty, merge_configs
+
+# Bump when the layout of the compiled blob changes
+COMPILED_CONFIG_VERSION = 1
+
+# The blob last loaded from each cache path, so that later loads in the
+# same process (watch and batch runs) only stat the sources
+_loaded_blobs = dict()
+
+
+def _source_stamp(path: Path) -> tuple:
+    try:
+        stat = path.stat()
+    except OSError:
+        return (str(path), None, None)
+    return (str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _cache_key(sources: list[Path]) -> tuple:
+    # DEFAULT_CONFIG only changes when llmd is upgraded
+    return (COMPILED_CONFIG_VERSION, __version__, tuple(_source_stamp(path) for path in sources))
+
+
+def _render(merged: dict) -> dict | None:
+    """get_config for the merged config alone, or None if it can't be rendered without a file header"""
+    try:
+        return get_config([merged])
+    except KeyError:
+        # A `sys_` snippet in the system message that isn't defined
+        return None
+
+
+def _load_blob(cache_path: Path, key: tuple) -> dict | None:
+    try:
+        with open(cache_path, 'rb') as f:
+            blob = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if not isinstance(blob, dict) or blob.get('key') != key:
+        return None
+    return blob
+
+
+def _save_blob(cache_path: Path, blob: dict) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(blob, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # The cache is only an optimisation
+        pass
+
+
+def load_compiled_config(
+    defaults: dict,
+    sources: list[str | PathLike[str]],
+    cache_path: str | PathLike[str],
+    ) -> tuple[dict, dict | None]:
+    """
+    Merge the default config with YAML config files, using a compiled cache.
+
+    The sources are checked on every call. The merged config, and the
+    output of `get_config` for it, are read from `cache_path`, or from
+    memory if this process has read it already, if neither the llmd
+    version nor any of the source files (including whether they exist)
+    have changed since it was written. Otherwise the files are loaded and
+    merged, and the cache is rewritten.
+
+    Parameters
+    ----------
+    defaults : dict
+        The lowest priority config, usually DEFAULT_CONFIG. It is taken
+        to change only with the llmd version.
+    sources : list of str or PathLike
+        YAML config files in increasing order of priority. Missing files
+        count as empty configs.
+    cache_path : str or PathLike
+        Where to keep the compiled config.
+
+    Returns
+    -------
+    tuple of (dict, dict or None)
+        The merged config, and the rendered config from `get_config`, or
+        None if the merged config can't be rendered on its own (e.g. a
+        `sys_` snippet is only defined in file headers). Both are copies,
+        so they can be modified.
+
+    Examples
+    --------
+    >>> merged, rendered = load_compiled_config(
+    ...     DEFAULT_CONFIG, ['~/.config/llmd/config.yaml', 'llmd_config.yaml'], 'compiled.pickle')
+    >>> rendered['model_name']
+    'claude-3-5-sonnet-latest'
+    """
+    sources = [Path(source) for source in sources]
+    cache_path = Path(cache_path)
+    key = _cache_key(sources)
+
+    blob = _loaded_blobs.get(cache_path)
+    if blob is None or blob['key'] != key:
+        blob = _load_blob(cache_path, key)
+        if blob is None:
+            merged = merge_configs([defaults] + [load_config_or_empty(path.parent, path.name) for path in sources])
+            blob = {'key': key, 'merged': merged, 'rendered': _render(merged)}
+            _save_blob(cache_path, blob)
+        _loaded_blobs[cache_path] = blob
+
+    return copy.deepcopy(blob['merged']), copy.deepcopy(blob['rendered'])
@@ -1,9 +1,27 @@
 from collections.abc import Iterable
+import functools
 import yaml
 from pathlib import Path
 import os
 from platformdirs import user_config_dir
 
+# The C loader (when PyYAML is built with libyaml) is much faster than
+# the pure-Python one, and loads the same safe subset of YAML
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    """Load a YAML document safely, with the C loader if it is available.
+
+    Args:
+        stream (str | file): The YAML document, or an open file.
+
+    Returns:
+        The loaded document.
+    """
+    return yaml.load(stream, Loader=_SafeLoader)
+
+
 def merge_configs(configs: Iterable[dict]):
     """Create config dict from list of configs.
 
@@ -48,16 +66,47 @@ def get_config(configs: Iterable[dict]) -> dict:
     Returns:
         dict: A dict containing the model name,
         the reconstituted system message including snippets,
-        a dictionary containing model options, ignore_images,
-        ignore_links
+        a dictionary containing model options, models (the name and
+        options of each model when the model setting is a list, or
+        None), ignore_images,
+        ignore_links, stream, incremental_parse, prompt_cache,
+        persist_conversation, llm_conversation_id, on_conflict,
+        expand_archives, compact, the response and image cache settings,
+        image_preprocess, attachments, link_budget, api_client,
+        request_policy and context_window
     """
 
     merged_config = merge_configs(configs)
     model_name = merged_config.get('model')
     template_system_msg = merged_config.get('system')
     model_options = merged_config.get('options')
+    models = None
+    if isinstance(model_name, list):
+        from llm_tool.fan_out import parse_model_list
+
+        models = parse_model_list(model_name, model_options)
+        model_name = models[0]['model_name'] if models else None
     ignore_links = merged_config.pop('ignore_links',False)
     ignore_images = merged_config.pop('ignore_images',False)
+    stream = merged_config.pop('stream',True)
+    incremental_parse = merged_config.pop('incremental_parse',False)
+    prompt_cache = merged_config.pop('prompt_cache',True)
+    persist_conversation = merged_config.pop('persist_conversation',False)
+    llm_conversation_id = merged_config.pop('llm_conversation_id',None)
+    on_conflict = merged_config.pop('on_conflict','reanchor')
+    expand_archives = merged_config.pop('expand_archives',False)
+    compact = merged_config.pop('compact',None)
+    cache = merged_config.pop('cache',False)
+    cache_max_mb = merged_config.pop('cache_max_mb',100)
+    cache_max_age_days = merged_config.pop('cache_max_age_days',30)
+    image_cache = merged_config.pop('image_cache',True)
+    image_cache_max_mb = merged_config.pop('image_cache_max_mb',200)
+    image_preprocess = merged_config.pop('image_preprocess',None)
+    attachments = merged_config.pop('attachments',None)
+    link_budget = merged_config.pop('link_budget',None)
+    api_client = merged_config.pop('api_client',None)
+    request_policy = merged_config.pop('request_policy',None)
+    context_window = merged_config.pop('context_window',None)
 
     sys_snippets = {
         k: v for k, v in merged_config.items() 
@@ -68,11 +117,36 @@ def get_config(configs: Iterable[dict]) -> dict:
 
     return {
         "model_name": model_name, "system_msg": system_msg, 
-        "model_options": model_options, 
-        "ignore_links": ignore_links, "ignore_images": ignore_images
+        "model_options": model_options, "models": models,
+        "ignore_links": ignore_links, "ignore_images": ignore_images,
+        "stream": stream, "incremental_parse": incremental_parse,
+        "prompt_cache": prompt_cache,
+        "persist_conversation": persist_conversation,
+        "llm_conversation_id": llm_conversation_id,
+        "on_conflict": on_conflict,
+        "expand_archives": expand_archives, "compact": compact,
+        "cache": cache, "cache_max_mb": cache_max_mb,
+        "cache_max_age_days": cache_max_age_days,
+        "image_cache": image_cache, "image_cache_max_mb": image_cache_max_mb,
+        "image_preprocess": image_preprocess, "attachments": attachments,
+        "link_budget": link_budget,
+        "api_client": api_client, "request_policy": request_policy,
+        "context_window": context_window,
         }
 
 
+@functools.cache
+def load_env_file() -> None:
+    """Load any API key env variables set in a .env file.
+
+    Searching for the .env file walks up the directory tree, so it is
+    only done once per process, and only by the code paths that make
+    API calls.
+    """
+    from dotenv import load_dotenv, find_dotenv
+    load_dotenv(find_dotenv())
+
+
 def get_or_make_user_config_path(shell=True) -> None:
     """Prints user config path
 
@@ -95,6 +169,24 @@ def get_or_make_user_config_path(shell=True) -> None:
     else:
         return config_path
 
+def get_user_cache_dir(name: str) -> Path:
+    """Return a named cache dir inside the user config dir, creating it if needed
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache, e.g. 'responses'.
+
+    Returns
+    -------
+    Path
+        The cache dir, e.g. ~/.config/llmd/cache/responses on Linux.
+    """
+    cache_dir = Path(get_or_make_user_config_path(shell=False)).parent / 'cache' / name
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
 def load_config_or_empty(path: str, filename: str) -> dict:
     """
     Load a YAML file into a dict if it exists, otherwise return an empty dict.
@@ -122,7 +214,7 @@ def load_config_or_empty(path: str, filename: str) -> dict:
 
     if file_path.is_file() and file_path.suffix in {'.yaml', '.yml'}:
         with file_path.open('r') as f:
-            config = yaml.safe_load(f)
+            config = load_yaml(f)
     else:
         config = dict()
     if not isinstance(config,dict):
@@ -0,0 +1,284 @@
+"""Fit a conversation into a token budget before it is sent.
+
+Tokens are estimated rather than counted, from the length of the text
+(about four characters to a token) and a fixed cost per image, so the
+budget should leave some headroom below the model's real context window.
+
+Which turns are dropped is decided by a strategy. Strategies are
+registered by name with `register_strategy`; the built-in ones are
+'drop_oldest', 'keep_ends' and 'skip_low_priority'.
+"""
+from collections.abc import Callable
+import math
+import os
+
+CHARS_PER_TOKEN = 4
+
+# Roughly the cost of an image scaled to fit 1568 pixels, the size images
+# are preprocessed to by default
+IMAGE_TOKENS = 1600
+
+# Role markers and message framing
+TURN_OVERHEAD_TOKENS = 4
+
+STRATEGIES = dict()
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text.
+
+    Examples
+    --------
+    >>> estimate_text_tokens('Hello there')
+    3
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _estimate_chunk_tokens(chunk: dict) -> int:
+    if chunk['type'] == 'text':
+        return estimate_text_tokens(chunk['text'])
+    if chunk['type'] == 'image':
+        return IMAGE_TOKENS
+    if chunk['type'] == 'link':
+        # A link that hasn't been replaced by the file's contents yet, or
+        # is left to be uploaded as a document
+        return math.ceil(os.path.getsize(chunk['link']) / CHARS_PER_TOKEN)
+    if chunk['type'] == 'document':
+        return math.ceil(_document_bytes(chunk) / CHARS_PER_TOKEN)
+    return 0
+
+
+def _document_bytes(chunk: dict) -> int:
+    source = chunk.get('source') or dict()
+    if source.get('type') == 'file':
+        from llm_tool.attachments import uploaded_file_size
+
+        return uploaded_file_size(source['file_id']) or 0
+    return len(source.get('data') or '')
+
+
+def estimate_turn_tokens(turn: dict) -> int:
+    """
+    Estimate the tokens in one turn, with hydrated links and images.
+
+    Parameters
+    ----------
+    turn : dict
+        A turn from `parse_conversation`, after `hydrate_conversation`,
+        or one from `mapped_reader.parse_mapped_conversation` that hasn't
+        been read yet, which carries its estimate.
+
+    Returns
+    -------
+    int
+        The estimated number of tokens.
+
+    Examples
+    --------
+    >>> estimate_turn_tokens({'role': 'assistant', 'content': 'Hi there'})
+    6
+    """
+    if 'span' in turn:
+        return turn['tokens']
+    content = turn['content']
+    if isinstance(content, str):
+        tokens = estimate_text_tokens(content)
+    else:
+        tokens = sum(_estimate_chunk_tokens(chunk) for chunk in content)
+    return tokens + TURN_OVERHEAD_TOKENS
+
+
+def register_strategy(name: str) -> Callable:
+    """
+    Register a strategy for `fit_conversation` under a name.
+
+    A strategy is called with the conversation, the estimated tokens of
+    each turn, the token budget for the turns and the context_window
+    config. It returns the indices of the turns to keep, in order. It
+    should always keep the last turn, which holds the new prompt.
+
+    Examples
+    --------
+    >>> @register_strategy('last_only')
+    ... def last_only(conversation, tokens, budget, options):
+    ...     return [len(conversation) - 1]
+    """
+    def register(strategy):
+        STRATEGIES[name] = strategy
+        return strategy
+    return register
+
+
+def _exchanges(conversation: list[dict]) -> list[list[int]]:
+    """Group turn indices into exchanges: a user turn and the turns after it up to the next user turn"""
+    exchanges = []
+    for i, turn in enumerate(conversation):
+        if turn['role'] == 'user' or not exchanges:
+            exchanges.append([])
+        exchanges[-1].append(i)
+    return exchanges
+
+
+def _drop_oldest(conversation: list[dict], tokens: list[int], budget: int, keep: list[int]) -> list[int]:
+    """Drop the oldest exchanges among `keep` until it fits, always keeping the last"""
+    kept = set(keep)
+    total = sum(tokens[i] for i in kept)
+    exchanges = [
+        [i for i in exchange if i in kept]
+        for exchange in _exchanges(conversation)
+    ]
+    for exchange in exchanges[:-1]:
+        if total <= budget:
+            break
+        for i in exchange:
+            kept.discard(i)
+            total -= tokens[i]
+    return sorted(kept)
+
+
+@register_strategy('drop_oldest')
+def drop_oldest(conversation, tokens, budget, options):
+    """Drop whole exchanges, oldest first, until the conversation fits"""
+    return _drop_oldest(conversation, tokens, budget, list(range(len(conversation))))
+
+
+@register_strategy('keep_ends')
+def keep_ends(conversation, tokens, budget, options):
+    """Keep the first exchanges, up to `keep_first` turns, and as many recent exchanges as fit, up to `keep_last` turns
+
+    Whole exchanges are kept, so an exchange that would take the first
+    turns past `keep_first` is kept whole, and the last exchange is kept
+    whatever its size.
+    """
+    keep_first = options.get('keep_first', 2) or 0
+    keep_last = options.get('keep_last')
+    exchanges = _exchanges(conversation)
+
+    first = []
+    n_first = 0
+    for exchange in exchanges[:-1]:
+        if len(first) >= keep_first:
+            break
+        first += exchange
+        n_first += 1
+    total = sum(tokens[i] for i in first)
+    last = []
+    for exchange in reversed(exchanges[n_first:]):
+        exchange_tokens = sum(tokens[i] for i in exchange)
+        if last and (
+            total + exchange_tokens > budget
+            or (keep_last is not None and len(last) + len(exchange) > keep_last)
+        ):
+            break
+        last = exchange + last
+        total += exchange_tokens
+    return first + last
+
+
+@register_strategy('skip_low_priority')
+def skip_low_priority(conversation, tokens, budget, options):
+    """Drop exchanges with a turn marked low priority, oldest first, then the oldest exchanges if still too long"""
+    exchanges = _exchanges(conversation)
+    keep = list(range(len(conversation)))
+    total = sum(tokens)
+    for exchange in exchanges[:-1]:
+        if total <= budget:
+            break
+        if any(conversation[i].get('low_priority') for i in exchange):
+            for i in exchange:
+                keep.remove(i)
+                total -= tokens[i]
+    if total > budget:
+        keep = _drop_oldest(conversation, tokens, budget, keep)
+    return keep
+
+
+def _describe_turns(indices: list[int]) -> str:
+    """Turn numbers, counting from 1, as ranges: '1-4, 7'"""
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i:
+            ranges[-1][1] = i + 1
+        else:
+            ranges.append([i + 1, i + 1])
+    return ', '.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+def fit_conversation(
+    conversation: list[dict],
+    max_tokens: int | None,
+    strategy: str = 'drop_oldest',
+    system_msg: str = '',
+    options: dict | None = None,
+    log: Callable[[str], None] = print,
+    ) -> list[dict]:
+    """
+    Drop turns from a conversation until its estimated size fits a budget.
+
+    The system message counts against the budget. Turns are only dropped
+    if the whole conversation is over budget, and the last turn is always
+    kept. After the strategy has chosen, leading assistant turns are
+    dropped too, so that the conversation still starts with a user turn.
+    What was dropped is reported through `log`.
+
+    Parameters
+    ----------
+    conversation : list of dict
+        The parsed and hydrated conversation.
+    max_tokens : int or None
+        The token budget for the system message and the turns. None
+        keeps every turn.
+    strategy : str
+        The name of a registered strategy.
+    system_msg : str
+        The system message.
+    options : dict or None
+        The context_window config, passed on to the strategy.
+    log : callable
+        Called with a line describing the dropped turns.
+
+    Returns
+    -------
+    list of dict
+        The turns to send, in their original order.
+
+    Raises
+    ------
+    ValueError
+        If the strategy isn't registered.
+
+    Examples
+    --------
+    >>> conversation = [
+    ...     {'role': 'user', 'content': [{'type': 'text', 'text': 'x' * 4000}]},
+    ...     {'role': 'assistant', 'content': 'y' * 4000},
+    ...     {'role': 'user', 'content': [{'type': 'text', 'text': 'And now?'}]}]
+    >>> fitted = fit_conversation(conversation, max_tokens=500)
+    Context window: dropped turns 1-2 (~2008 tokens) to fit 500 tokens
+    >>> len(fitted)
+    1
+    """
+    if max_tokens is None or not conversation:
+        return conversation
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown context window strategy {strategy!r}: choose from {', '.join(STRATEGIES)}")
+
+    tokens = [estimate_turn_tokens(turn) for turn in conversation]
+    budget = max_tokens - estimate_text_tokens(system_msg or '')
+    if sum(tokens) <= budget:
+        return conversation
+
+    keep = STRATEGIES[strategy](conversation, tokens, budget, options or dict())
+    while len(keep) > 1 and conversation[keep[0]]['role'] != 'user':
+        keep = keep[1:]
+
+    kept = set(keep)
+    dropped = [i for i in range(len(conversation)) if i not in kept]
+    if dropped:
+        dropped_tokens = sum(tokens[i] for i in dropped)
+        log(f"Context window: dropped turns {_describe_turns(dropped)} (~{dropped_tokens} tokens) to fit {max_tokens} tokens")
+    if sum(tokens[i] for i in keep) > budget:
+        log(f"Context window: the conversation is still about {sum(tokens[i] for i in keep)} tokens, over the budget of {budget}")
+    return [conversation[i] for i in keep]
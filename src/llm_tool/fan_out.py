@@ -0,0 +1,162 @@
+"""Asking several models the same prompt.
+
+The `model` setting can be a list, with optional options for each model:
+
+    model:
+      - gpt-4o
+      - model: claude-3-5-sonnet-latest
+        options:
+          temperature: 0.2
+
+Every model is asked concurrently, and each answer is appended under its
+own `# %Assistant` section, labelled with a `<!--llm model: ... llm-->`
+comment. A user turn followed by several answers is a branch point, and
+`select_branch` decides which answer each model sees as history.
+"""
+import re
+
+MODEL_LABEL = re.compile(r'^model:\s*(?P<model>\S+)$')
+
+# An answer marked <!--llm keep llm--> is the history for every model
+KEEP_MARKER = 'keep'
+
+_ASSISTANT_HEADER = '# %Assistant\n'
+
+
+def model_names(model_setting) -> list[str]:
+    """
+    The names of the models in a `model` setting.
+
+    Examples
+    --------
+    >>> model_names('gpt-4o')
+    ['gpt-4o']
+    >>> model_names(['gpt-4o', {'model': 'claude-3-5-sonnet-latest', 'options': {'temperature': 0.2}}])
+    ['gpt-4o', 'claude-3-5-sonnet-latest']
+    """
+    if model_setting is None:
+        return []
+    if not isinstance(model_setting, list):
+        return [model_setting]
+    return [entry['model'] if isinstance(entry, dict) else entry for entry in model_setting]
+
+
+def parse_model_list(model_setting: list, model_options: dict | None) -> list[dict]:
+    """
+    The name and options of each model in a list `model` setting.
+
+    A model's own options are merged over the shared `options`.
+
+    Raises
+    ------
+    ValueError
+        If an entry has no model name, or a model is listed twice.
+
+    Examples
+    --------
+    >>> parse_model_list(['gpt-4o', {'model': 'mock', 'options': {'ttft': 0}}], {'max_tokens': 100})
+    [{'model_name': 'gpt-4o', 'model_options': {'max_tokens': 100}}, {'model_name': 'mock', 'model_options': {'max_tokens': 100, 'ttft': 0}}]
+    """
+    models = []
+    for entry in model_setting:
+        if isinstance(entry, dict):
+            name, options = entry.get('model'), entry.get('options')
+        else:
+            name, options = entry, None
+        if not name:
+            raise ValueError(f"Each entry in the model list needs a model name: {entry!r}")
+        models.append({'model_name': name, 'model_options': {**(model_options or dict()), **(options or dict())}})
+    names = [model['model_name'] for model in models]
+    if len(set(names)) < len(names):
+        raise ValueError(f"A model is listed more than once: {names}")
+    return models
+
+
+def model_configs(config: dict) -> list[dict]:
+    """The config for each model to ask: one config, unless the model setting is a list"""
+    if not config.get('models'):
+        return [config]
+    return [dict(config, **model, models=None) for model in config['models']]
+
+
+def answer_label(comments: list[str]) -> str | None:
+    """The model named by a `model: ...` comment of an assistant turn, if any"""
+    for comment in comments:
+        match = MODEL_LABEL.match(comment)
+        if match:
+            return match.group('model')
+    return None
+
+
+def label_response(response: str, model_name: str) -> str:
+    """
+    Label a formatted response with the model that wrote it.
+
+    Examples
+    --------
+    >>> label_response('\\n# %Assistant\\n\\nHi', 'gpt-4o')
+    '\\n# %Assistant\\n<!--llm model: gpt-4o llm-->\\n\\nHi'
+    """
+    return response.replace(_ASSISTANT_HEADER, f"{_ASSISTANT_HEADER}<!--llm model: {model_name} llm-->\n", 1)
+
+
+def select_branch(conversation: list[dict], model_name: str | None) -> list[dict]:
+    """
+    Keep one answer wherever a user turn has several.
+
+    The answer kept is, in order of preference:
+
+    1. the answer marked with a `<!--llm keep llm-->` comment,
+    2. the answer labelled with `model_name`, so that each model carries
+       on its own branch of the conversation,
+    3. the last answer.
+
+    Deleting or commenting out the other answers also picks a branch.
+    Answers in a row are only branches if one of them has a model label
+    or a keep marker; otherwise they are all kept, as written.
+
+    Parameters
+    ----------
+    conversation : list of dict
+        Parsed turns, where assistant turns can have 'model' and 'keep'
+        keys from their comments (see `parse_conversation`).
+    model_name : str or None
+        The model being asked.
+
+    Returns
+    -------
+    list of dict
+        The conversation with one answer to each user turn that has branches.
+
+    Examples
+    --------
+    >>> select_branch([
+    ...     {'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]},
+    ...     {'role': 'assistant', 'content': 'Hello', 'model': 'gpt-4o'},
+    ...     {'role': 'assistant', 'content': 'Hey', 'model': 'mock'},
+    ... ], 'gpt-4o')[1]['content']
+    'Hello'
+    """
+    selected = []
+    answers = []
+
+    def choose():
+        if not answers:
+            return
+        if not any(turn.get('keep') or turn.get('model') for turn in answers):
+            selected.extend(answers)
+            answers.clear()
+            return
+        kept = [turn for turn in answers if turn.get('keep')]
+        labelled = [turn for turn in answers if turn.get('model') == model_name]
+        selected.append((kept or labelled or answers)[-1])
+        answers.clear()
+
+    for turn in conversation:
+        if turn['role'] == 'assistant':
+            answers.append(turn)
+            continue
+        choose()
+        selected.append(turn)
+    choose()
+    return selected
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+from llm_tool.inline_links import _convert_link_to_full_text, link_byte_limits
+from llm_tool.image_handlers import EncodedImageCache, get_base64
+from llm_tool.image_preprocessing import media_type_for, preprocess_images
+from llm_tool.profiling import span
+
+# Reads are I/O bound, so more threads than CPUs helps on network filesystems
+_MAX_WORKERS = 16
+
+
+def _format_bytes(n_bytes: int) -> str:
+    if n_bytes < 1024:
+        return f"{n_bytes} B"
+    if n_bytes < 1024 * 1024:
+        return f"{n_bytes / 1024:.1f} KB"
+    return f"{n_bytes / (1024 * 1024):.1f} MB"
+
+
+def _read_link(path: str, max_bytes: int | None = None, excerpt: str = 'head_tail') -> str:
+    return _convert_link_to_full_text({'type': 'link', 'link': path}, max_bytes=max_bytes, excerpt=excerpt)['text']
+
+
+def _allocate_link_bytes(sizes: dict[str, int], max_bytes: int | None, max_total_bytes: int | None) -> dict[str, int | None]:
+    """Share the conversation's link budget between files, in the order of `sizes`
+
+    Each file gets at most max_bytes, and no more than is left of
+    max_total_bytes after the files before it. A file that gets 0 is left
+    out of the prompt.
+    """
+    limits = dict()
+    remaining = max_total_bytes
+    for path, size in sizes.items():
+        limit = max_bytes
+        if remaining is not None:
+            limit = remaining if limit is None else min(limit, remaining)
+            remaining -= min(size, limit)
+        limits[path] = limit
+    return limits
+
+
+def _encode_image(path: str, processed: dict, cache: EncodedImageCache | None, attachments=None) -> dict:
+    upload_path, media_type = processed.get(path, (path, None))
+    if attachments is not None:
+        return attachments.image_source(upload_path, media_type)
+    return {
+        "type": "base64",
+        "media_type": media_type or media_type_for(upload_path),
+        "data": get_base64(upload_path, cache=cache),
+    }
+
+
+def hydrate_conversation(
+    conversation: list[dict],
+    base_path: str | os.PathLike = ".",
+    links: bool = True,
+    images: bool = True,
+    image_cache: EncodedImageCache | None = None,
+    preprocess: dict | None = None,
+    link_budget: dict | None = None,
+    attachments=None,
+    defer_links_from: int | None = None,
+    max_workers: int = _MAX_WORKERS,
+    ) -> list[dict]:
+    """
+    Read linked files and encode images in a conversation, concurrently.
+
+    Every link and image chunk in the user turns is collected first, and
+    each distinct file is read or encoded once, on a thread pool. The
+    results are then put back in place: link chunks become text chunks
+    holding the file contents, and image chunks get a base64 source.
+    Image chunks that already have a base64 source are left alone.
+
+    Parameters
+    ----------
+    conversation : list of dict
+        The parsed conversation. It is updated in place.
+    base_path : str or PathLike
+        The path that relative links and image paths are relative to.
+    links : bool
+        Whether to replace link chunks with the linked files' contents.
+    images : bool
+        Whether to encode image chunks.
+    image_cache : EncodedImageCache or None
+        Optional on-disk cache of image encodings.
+    preprocess : dict or None
+        Keyword arguments for `preprocess_images`, from
+        `make_preprocess_settings`, or None to send images unchanged.
+    link_budget : dict or None
+        The link_budget config: per-link and per-conversation limits on
+        the bytes (or estimated tokens) of linked files to include, and
+        which excerpt of a file to keep when it is too big. The
+        conversation's budget goes to the most recent links first.
+    attachments : AttachmentRegistry or None
+        If given, images are uploaded once with the Files API and get a
+        file source instead of a base64 one, and linked files big enough
+        (see `AttachmentRegistry.wants_document`) become document chunks.
+        Uploaded documents aren't trimmed to the link budget.
+    defer_links_from : int or None
+        Leave links to files of this many bytes or more as they are, to
+        be uploaded as documents by a later call with attachments, once
+        the response cache has been checked. They don't count against
+        the link budget.
+    max_workers : int
+        Size of the thread pool.
+
+    Returns
+    -------
+    list of dict
+        The conversation.
+
+    Examples
+    --------
+    >>> conversation = [{'role': 'user', 'content': [{'type': 'link', 'link': 'notes.txt'}]}]
+    >>> hydrate_conversation(conversation, images=False)
+    [{'role': 'user', 'content': [{'type': 'text', 'text': 'Notes here'}]}]
+    """
+    link_chunks = []
+    image_chunks = []
+    for turn in conversation:
+        if turn['role'] != 'user' or not isinstance(turn['content'], list):
+            continue
+        for i, chunk in enumerate(turn['content']):
+            if links and chunk['type'] == 'link':
+                path = str(Path(base_path, chunk['link']).resolve())
+                link_chunks.append((turn['content'], i, path))
+            elif images and chunk['type'] == 'image' and isinstance(chunk['source'], str):
+                path = str(Path(base_path, chunk['source']).resolve())
+                image_chunks.append((chunk, path))
+
+    if not link_chunks and not image_chunks:
+        return conversation
+
+    # Most recent first, so they get the conversation's link budget first
+    link_paths = list(dict.fromkeys(path for _, _, path in reversed(link_chunks)))
+    image_paths = list(dict.fromkeys(path for _, path in image_chunks))
+
+    # Preprocessing is CPU bound and has its own process pool
+    processed = dict()
+    if preprocess and image_paths:
+        with span('preprocess_images'):
+            processed = preprocess_images(image_paths, **preprocess)
+
+    max_bytes, max_total_bytes = link_byte_limits(link_budget)
+    excerpt = (link_budget or dict()).get('excerpt', 'head_tail')
+
+    with span('read_and_encode'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        deferred = set()
+        if defer_links_from is not None:
+            sizes = dict(zip(link_paths, executor.map(os.path.getsize, link_paths)))
+            deferred = {path for path, size in sizes.items() if size >= defer_links_from}
+            link_paths = [path for path in link_paths if path not in deferred]
+        documents = dict()
+        if attachments is not None:
+            wanted = dict(zip(link_paths, executor.map(attachments.wants_document, link_paths)))
+            documents = {
+                path: executor.submit(attachments.document_block, path)
+                for path in link_paths if wanted[path]
+            }
+            link_paths = [path for path in link_paths if path not in documents]
+        if max_total_bytes is not None:
+            sizes = dict(zip(link_paths, executor.map(os.path.getsize, link_paths)))
+            limits = _allocate_link_bytes(sizes, max_bytes, max_total_bytes)
+        else:
+            limits = dict.fromkeys(link_paths, max_bytes)
+        link_futures = {
+            path: executor.submit(_read_link, path, limits[path], excerpt)
+            for path in link_paths
+        }
+        image_futures = {
+            path: executor.submit(_encode_image, path, processed, image_cache, attachments)
+            for path in image_paths
+        }
+        link_texts = {path: future.result() for path, future in link_futures.items()}
+        documents = {path: future.result() for path, future in documents.items()}
+        sources = {path: future.result() for path, future in image_futures.items()}
+
+    for content, i, path in link_chunks:
+        if path in deferred:
+            continue
+        if path in documents:
+            content[i] = dict(documents[path])
+        else:
+            content[i] = {'type': 'text', 'text': link_texts[path]}
+
+    if attachments is not None:
+        for chunk, path in image_chunks:
+            chunk['source'] = dict(sources[path])
+        print(f"Attachments: {attachments.uploaded} uploaded, {attachments.reused} reused")
+    elif image_chunks:
+        original_bytes = uploaded_bytes = 0
+        for chunk, path in image_chunks:
+            chunk['source'] = dict(sources[path])
+            data = sources[path]['data']
+            original_bytes += os.path.getsize(path)
+            # Decoded size of the base64 data
+            uploaded_bytes += len(data) * 3 // 4 - data[-2:].count('=')
+        print(
+            f"Images: {len(image_chunks)}, {_format_bytes(uploaded_bytes)} uploaded "
+            f"({_format_bytes(original_bytes)} before preprocessing)"
+            )
+
+    return conversation
@@ -1,35 +1,201 @@
 import os
+from collections import OrderedDict
 from pathlib import Path
 import base64
+import functools
+import hashlib
+import mmap
+import tempfile
+import threading
+from llm_tool.response_cache import ResponseCache
+from llm_tool.image_preprocessing import media_type_for, pillow_available
 
+# Raw bytes read per step when encoding. A multiple of 3, so each step's
+# base64 output can be concatenated without padding in the middle.
+_ENCODE_CHUNK_BYTES = 3 * 256 * 1024
 
-def get_base64(filepath: str | os.PathLike):
+# Encoded images kept in memory, keyed on (path, mtime_ns, size). Bounded
+# so that a long-running process (llmd watch) doesn't grow without limit.
+_MEMORY_CACHE_MAX_CHARS = 256 * 1024 * 1024
+_memory_cache = OrderedDict()
+_memory_cache_chars = 0
+_memory_cache_lock = threading.Lock()
+
+
+class EncodedImageCache(ResponseCache):
+    """Base64-encoded images on disk, with the same LRU eviction as responses"""
+
+    suffix = '.b64'
+
+    def path_for(self, key: str) -> Path:
+        return self._path(key)
+
+
+def _file_key(filepath: str | os.PathLike) -> tuple[str, int, int]:
+    resolved = Path(filepath).resolve()
+    stat = resolved.stat()
+    return (str(resolved), stat.st_mtime_ns, stat.st_size)
+
+
+def _remember(key: tuple, encoded: str) -> None:
+    global _memory_cache_chars
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            return
+        _memory_cache[key] = encoded
+        _memory_cache_chars += len(encoded)
+        while _memory_cache_chars > _MEMORY_CACHE_MAX_CHARS and len(_memory_cache) > 1:
+            _, evicted = _memory_cache.popitem(last=False)
+            _memory_cache_chars -= len(evicted)
+
+
+def _recall(key: tuple) -> str | None:
+    with _memory_cache_lock:
+        encoded = _memory_cache.get(key)
+        if encoded is not None:
+            _memory_cache.move_to_end(key)
+        return encoded
+
+
+def _encode_in_chunks(filepath: str | os.PathLike, sink) -> None:
+    """Base64-encode a file a chunk at a time, writing the output to a binary sink"""
     with open(filepath, 'rb') as f:
-        img_bin = f.read()
-    img_base64 = base64.b64encode(img_bin).decode('utf-8')
-    return img_base64
+        for raw_chunk in iter(lambda: f.read(_ENCODE_CHUNK_BYTES), b''):
+            sink.write(base64.b64encode(raw_chunk))
+
+
+def _read_encoded(sink) -> str:
+    """The contents of a written sink file as one str.
+
+    The file is decoded straight from a memory map, so the str is the
+    only copy of the encoding held in memory.
+    """
+    sink.flush()
+    if os.fstat(sink.fileno()).st_size == 0:
+        return ''
+    with mmap.mmap(sink.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return str(mapped, 'ascii')
+
+
+def get_base64(filepath: str | os.PathLike, cache: EncodedImageCache | None = None) -> str:
+    """Base64-encode an image file, using cached encodings where possible.
+
+    Encodings are cached in memory for the life of the process, keyed on
+    the resolved path, mtime and size, so an image linked from several
+    turns is only encoded once. If `cache` is given, encodings are also
+    kept on disk between runs.
+
+    Args:
+        filepath (str | os.PathLike): Path to the image file
+        cache (EncodedImageCache | None): Optional on-disk cache
 
-def rehydrate_image(rel_path: str | os.PathLike, base_path: str | os.PathLike):
+    Returns:
+        str: The base64-encoded file contents
+    """
+    key = _file_key(filepath)
+    encoded = _recall(key)
+    if encoded is not None:
+        return encoded
+
+    disk_key = hashlib.sha256(repr(key).encode('utf-8')).hexdigest() if cache else None
+    if cache is not None:
+        encoded = cache.get(disk_key)
+
+    if encoded is None:
+        # The encoding goes to a file, then into memory in one piece
+        if cache is None:
+            with tempfile.TemporaryFile() as sink:
+                _encode_in_chunks(filepath, sink)
+                encoded = _read_encoded(sink)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=cache.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w+b') as sink:
+                _encode_in_chunks(filepath, sink)
+                encoded = _read_encoded(sink)
+            os.replace(tmp_path, cache.path_for(disk_key))
+            cache.evict()
+
+    _remember(key, encoded)
+    return encoded
+
+
+def make_image_cache(config: dict) -> EncodedImageCache | None:
+    """Create the on-disk image cache in the user config dir, if enabled"""
+    if not config.get('image_cache'):
+        return None
+    from llm_tool.config_and_system import get_user_cache_dir
+
+    return EncodedImageCache(
+        get_user_cache_dir('images'),
+        max_bytes=int(config.get('image_cache_max_mb', 200) * 1024 * 1024),
+        max_age_days=config.get('cache_max_age_days', 30),
+    )
+
+
+@functools.cache
+def _warn_pillow_missing() -> None:
+    print("Image preprocessing needs Pillow (pip install 'llmd[images]'), sending images unchanged")
+
+
+def make_preprocess_settings(config: dict) -> dict | None:
+    """Settings for `preprocess_images` from the image_preprocess config, or None if disabled"""
+    settings = config.get('image_preprocess')
+    if not settings:
+        return None
+    if not pillow_available():
+        _warn_pillow_missing()
+        return None
+    from llm_tool.config_and_system import get_user_cache_dir
+
+    return {
+        'cache_dir': get_user_cache_dir('preprocessed_images'),
+        'max_dimension': settings.get('max_dimension'),
+        'image_format': settings.get('format'),
+        'quality': settings.get('quality', 85),
+        'max_cache_mb': config.get('image_cache_max_mb', 200),
+        'max_age_days': config.get('cache_max_age_days', 30),
+    }
+
+
+def rehydrate_image(rel_path: str | os.PathLike, base_path: str | os.PathLike, cache: EncodedImageCache | None = None):
     """Convert rel_path into full base64-encoded image
 
+    The media type is detected from the file's bytes, falling back to
+    the file suffix.
+
     Args:
         rel_path (str): A relative path to an image file
         base_path (str): An absolute path from which the rel path is relative
+        cache (EncodedImageCache | None): Optional on-disk cache of encodings
     """
     absolute_path = Path(base_path / rel_path).resolve()
-    mtype = Path(rel_path).suffix[1:]
-    if mtype == 'jpg':
-        mtype = 'jpeg'
     return {
             "type": "base64",
-            "media_type": f"image/{mtype}",
-            "data": get_base64(absolute_path)
+            "media_type": media_type_for(absolute_path),
+            "data": get_base64(absolute_path, cache=cache)
         }
 
-def add_image_data_to_conversation(conversation,base_path):
-    for turn in conversation:
-        if turn['role'] == 'user':
-            for chunk in turn['content']:
-                if chunk['type'] == 'image':
-                    chunk['source'] = rehydrate_image(chunk['source'],base_path)
-    return conversation
+def add_image_data_to_conversation(conversation,base_path,cache=None,preprocess=None):
+    """Replace image paths in user turns with base64-encoded image sources
+
+    Images are encoded concurrently by `hydrate_conversation`; images
+    that already have a base64 source are left alone.
+
+    Args:
+        conversation (list[dict]): The parsed conversation
+        base_path (Path): The path image paths are relative to
+        cache (EncodedImageCache | None): Optional on-disk cache of encodings
+        preprocess (dict | None): Keyword arguments for `preprocess_images`,
+            from `make_preprocess_settings`. If given, images are downscaled
+            and recompressed (in parallel) before they are encoded.
+    """
+    from llm_tool.hydration import hydrate_conversation
+
+    return hydrate_conversation(
+        conversation,
+        base_path,
+        links=False,
+        images=True,
+        image_cache=cache,
+        preprocess=preprocess,
+        )
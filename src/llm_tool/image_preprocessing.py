@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor
+from os import PathLike
+from pathlib import Path
+import hashlib
+import io
+import os
+import tempfile
+from llm_tool.response_cache import ResponseCache
+
+# Leading bytes of each image format the vision API accepts
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'jpg': ('JPEG', 'image/jpeg', '.jpg'),
+    'png': ('PNG', 'image/png', '.png'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'gif': ('GIF', 'image/gif', '.gif'),
+    # Most phone cameras' JPEGs, which Pillow opens as multi-picture files
+    'mpo': ('JPEG', 'image/jpeg', '.jpg'),
+}
+
+# Part of the cache key, so that outputs of earlier versions of
+# `_preprocess_one` (which didn't apply EXIF orientation) aren't reused
+_PREPROCESS_VERSION = 2
+
+
+class PreprocessedImageCache(ResponseCache):
+    """Preprocessed images on disk, with the same LRU eviction as responses
+
+    Paths in `in_use`, such as the outputs about to be sent, are never evicted.
+    """
+
+    in_use = frozenset()
+
+    def _entry_paths(self):
+        # Outputs have the suffix of their format
+        return (
+            path for path in self.cache_dir.iterdir()
+            if path.suffix != '.tmp' and str(path) not in self.in_use
+        )
+
+
+def sniff_media_type(filepath: str | PathLike[str]) -> str | None:
+    """
+    Detect an image's media type from its first bytes.
+
+    Parameters
+    ----------
+    filepath : str or PathLike
+        Path to the image file.
+
+    Returns
+    -------
+    str or None
+        'image/png', 'image/jpeg', 'image/gif' or 'image/webp', or None
+        if the file isn't one of these.
+
+    Examples
+    --------
+    >>> sniff_media_type('photo_saved_as.png')
+    'image/jpeg'
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(12)
+    for signature, media_type in _SIGNATURES:
+        if header.startswith(signature):
+            return media_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def pillow_available() -> bool:
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _preprocess_one(filepath: str, output_path: str, max_dimension: int | None, image_format: str | None, quality: int) -> str:
+    """Downscale and recompress one image into output_path, returning its media type.
+
+    Runs in a worker process. Images with an EXIF orientation, such as
+    portrait photos from phones, are rotated upright, as the orientation
+    isn't kept when they are saved. If the image is already upright and
+    small enough, and recompressing doesn't make it smaller, the
+    original bytes are kept.
+    """
+    from PIL import ExifTags, Image, ImageOps
+
+    original_size = os.path.getsize(filepath)
+    with Image.open(filepath) as image:
+        source_format = (image.format or 'png').lower()
+        target = image_format or source_format
+        if target not in _FORMATS:
+            target = 'png'
+        pil_format, media_type, _ = _FORMATS[target]
+
+        transposed = image.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        if transposed:
+            image = ImageOps.exif_transpose(image)
+        resized = max_dimension is not None and max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension))
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        buffer = io.BytesIO()
+        save_options = {'quality': quality} if pil_format in ('JPEG', 'WEBP') else {'optimize': True}
+        image.save(buffer, format=pil_format, **save_options)
+
+    data = buffer.getvalue()
+    if not resized and not transposed and len(data) >= original_size and source_format in _FORMATS:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        media_type = _FORMATS[source_format][1]
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    return media_type
+
+
+def _input_key(filepath: Path, settings: tuple) -> str:
+    digest = hashlib.sha256(repr(settings).encode('utf-8'))
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def preprocess_images(
+    filepaths: list[str | PathLike[str]],
+    cache_dir: str | PathLike[str],
+    max_dimension: int | None = 1568,
+    image_format: str | None = None,
+    quality: int = 85,
+    max_workers: int | None = None,
+    max_cache_mb: float | None = None,
+    max_age_days: float = 30,
+    ) -> dict[str, tuple[str, str]]:
+    """
+    Downscale and recompress images before upload, in parallel.
+
+    Outputs are cached in `cache_dir` keyed on a hash of the input bytes
+    and the settings, so each image is only processed once. Images that
+    aren't cached are processed in a pool of worker processes.
+
+    Parameters
+    ----------
+    filepaths : list of str or PathLike
+        Paths to the images.
+    cache_dir : str or PathLike
+        Directory for the processed images.
+    max_dimension : int or None
+        Longest edge in pixels. Larger images are scaled down, keeping
+        their aspect ratio. None keeps the original size.
+    image_format : str or None
+        'jpeg', 'png', 'webp' or 'gif'. None keeps the original format.
+    quality : int
+        Compression quality for JPEG and WEBP.
+    max_workers : int or None
+        Size of the process pool. None uses the number of CPUs.
+    max_cache_mb : float or None
+        The size of `cache_dir` above which the least recently used
+        outputs are removed, after new images are processed. None
+        doesn't limit it.
+    max_age_days : float
+        With max_cache_mb, outputs unused for longer than this are
+        removed too.
+
+    Returns
+    -------
+    dict
+        Maps each input path (as a str) to a tuple of (path of the
+        processed image, media type).
+    """
+    cache_dir = Path(cache_dir)
+    settings = (max_dimension, image_format, quality, _PREPROCESS_VERSION)
+
+    results = dict()
+    to_process = dict()
+    for filepath in dict.fromkeys(str(path) for path in filepaths):
+        key = _input_key(Path(filepath), settings)
+        matches = list(cache_dir.glob(key + '.*'))
+        cached = [path for path in matches if path.suffix != '.tmp']
+        if cached:
+            output_path = cached[0]
+            os.utime(output_path)
+            results[filepath] = (str(output_path), sniff_media_type(output_path))
+        else:
+            to_process[filepath] = key
+
+    def output_path_for(key):
+        extension = _FORMATS[image_format][2] if image_format in _FORMATS else '.img'
+        return str(cache_dir / (key + extension))
+
+    if len(to_process) == 1:
+        [(filepath, key)] = to_process.items()
+        output_path = output_path_for(key)
+        media_type = _preprocess_one(filepath, output_path, max_dimension, image_format, quality)
+        results[filepath] = (output_path, media_type)
+    elif to_process:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                filepath: (executor.submit(
+                    _preprocess_one, filepath, output_path_for(key), max_dimension, image_format, quality,
+                ), output_path_for(key))
+                for filepath, key in to_process.items()
+            }
+            for filepath, (future, output_path) in futures.items():
+                results[filepath] = (output_path, future.result())
+
+    if to_process and max_cache_mb is not None:
+        cache = PreprocessedImageCache(cache_dir, max_bytes=int(max_cache_mb * 1024 * 1024), max_age_days=max_age_days)
+        cache.in_use = frozenset(output_path for output_path, _ in results.values())
+        cache.evict()
+
+    return results
+
+
+def media_type_for(filepath: str | PathLike[str]) -> str:
+    """The media type of an image, from its bytes or else its suffix"""
+    media_type = sniff_media_type(filepath)
+    if media_type is not None:
+        return media_type
+    suffix = Path(filepath).suffix[1:].lower()
+    return f"image/{'jpeg' if suffix == 'jpg' else suffix}"
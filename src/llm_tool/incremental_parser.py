@@ -0,0 +1,238 @@
+from os import PathLike
+from pathlib import Path
+import copy
+import hashlib
+import json
+import os
+import tempfile
+from llm_tool.parser import parse_conversation, _has_images, _parse_scanned_turn
+from llm_tool.scanner import scan_conversation
+
+# Bump when parsing, the index or the turn file changes, so that old ones are rebuilt
+INDEX_VERSION = 6
+
+
+def sidecar_index_path(markdown_filepath: str | PathLike[str]) -> Path:
+    """The path of the index kept next to a markdown file
+
+    >>> sidecar_index_path('/notes/chat.md')
+    PosixPath('/notes/.chat.md.llmd-index.json')
+    """
+    path = Path(markdown_filepath)
+    return path.with_name(f".{path.name}.llmd-index.json")
+
+
+def _turns_path(index_path: Path) -> Path:
+    """The file of parsed turns kept with an index
+
+    >>> _turns_path(Path('/notes/.chat.md.llmd-index.json'))
+    PosixPath('/notes/.chat.md.llmd-index.turns.jsonl')
+    """
+    return index_path.with_suffix('.turns.jsonl')
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _load_turns(turns_path: Path, options: dict) -> tuple[dict, bool]:
+    """The parsed turns of each segment hash in a turn file, and whether it can be appended to
+
+    The first line of the file records the version and parse options, and
+    each line after it holds the turns parsed from one segment. A line
+    cut short by an interrupted append ends the file early.
+    """
+    turns = dict()
+    try:
+        with open(turns_path, encoding='utf-8') as f:
+            if json.loads(f.readline() or 'null') != {'version': INDEX_VERSION, 'options': options}:
+                return dict(), False
+            for line in f:
+                entry = json.loads(line)
+                turns[entry['hash']] = entry['turns']
+    except (OSError, ValueError, KeyError, TypeError):
+        return turns, False
+    return turns, True
+
+
+def _turn_line(segment_hash: str, turns: list[dict]) -> str:
+    return json.dumps({'hash': segment_hash, 'turns': turns}, ensure_ascii=False) + '\n'
+
+
+def _save_turns(turns_path: Path, options: dict, turns: dict, append: bool) -> None:
+    """Append the turns of new segments to a turn file, or rewrite it with just these turns"""
+    try:
+        if append:
+            with open(turns_path, 'a', encoding='utf-8') as f:
+                f.writelines(_turn_line(segment_hash, parsed) for segment_hash, parsed in turns.items())
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=turns_path.parent, prefix=turns_path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'version': INDEX_VERSION, 'options': options}) + '\n')
+                f.writelines(_turn_line(segment_hash, parsed) for segment_hash, parsed in turns.items())
+            os.replace(tmp_path, turns_path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        print(f"Couldn't save the parsed turns: {e}")
+
+
+def _load_index(index_path: Path, options: dict) -> dict | None:
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or index.get('options') != options:
+        return None
+    return index
+
+
+def _save_index(index_path: Path, index: dict) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=index_path.parent, prefix=index_path.name, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Couldn't save the parse index: {e}")
+
+
+def parse_conversation_incremental(
+    file_contents: str,
+    index_path: str | PathLike[str],
+    base_path: str | os.PathLike = ".",
+    ignore_images=False,
+    ignore_links=False,
+    ) -> dict:
+    """Parse a conversation, re-parsing only turns that changed since the last run
+
+    Gives the same result as `parse_conversation`, but keeps an index of
+    each turn's offset in `file_contents` and a hash of its text, so the
+    index stays small however long the conversation. On the next run:
+
+    * If the text up to the start of the last indexed turn is unchanged
+      (checked with a single hash), the indexed boundaries and hashes are
+      reused and only the last turn and anything appended after it are
+      scanned.
+    * Otherwise the whole body is split into turns and hashed. Edits
+      anywhere in the file are detected.
+
+    The parsed turns are kept next to the index, in a file of JSON lines
+    keyed on the hash of each turn's text (see `_turns_path`). Turns
+    parsed since the last run are appended to it, and it is rewritten
+    when more than half of it is for turns no longer in the file. So a
+    run only parses the turns that are new or were edited.
+
+    Offsets are character offsets into `file_contents`. Links are resolved
+    when a turn is first parsed; a reused turn doesn't check again that its
+    linked files still exist.
+
+    Args:
+        file_contents (str): The contents of the markdown file after removal
+           of the YAML header.
+        index_path (str | os.PathLike): Where the index is kept, usually
+           from `sidecar_index_path`.
+        base_path (str | os.PathLike): The base path to resolve relative links.
+        ignore_images (bool)
+        ignore_links (bool)
+
+    Returns:
+        dict: {'conversation': [...], 'metadata': {...}}, as from
+           `parse_conversation`.
+    """
+    index_path = Path(index_path)
+    options = {
+        'base_path': str(Path(base_path).resolve()),
+        'ignore_images': bool(ignore_images),
+        'ignore_links': bool(ignore_links),
+    }
+    index = _load_index(index_path, options)
+
+    reused_segments = []
+    scan_from = 0
+    if index and index.get('prefix_end') is not None:
+        prefix_end = index['prefix_end']
+        if len(file_contents) >= prefix_end and _hash(file_contents[:prefix_end]) == index['prefix_hash']:
+            reused_segments = index['segments'][:-1]
+            scan_from = prefix_end
+
+    scanned = scan_conversation(file_contents[scan_from:])
+    if scan_from and scanned['boundaries'][:1] != [0]:
+        # The header of the last indexed turn was edited away, so its
+        # text now belongs to the turn before: scan everything
+        reused_segments = []
+        scan_from = 0
+        scanned = scan_conversation(file_contents)
+    boundaries = [scan_from + boundary for boundary in scanned['boundaries']] + [len(file_contents)]
+    scanned_turns = {scan_from + turn['start']: turn for turn in scanned['turns']}
+    new_segments = [
+        [start, _hash(file_contents[start:end])]
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
+
+    segments = reused_segments + new_segments
+    # Segments are contiguous, so each ends where the next starts
+    ends = [start for start, _ in segments[1:]] + [len(file_contents)]
+    turns_path = _turns_path(index_path)
+    stored, appendable = _load_turns(turns_path, options)
+
+    conversation = []
+    parsed_turns = dict()
+    added = dict()
+    resolved_paths = dict()
+    for (start, segment_hash), end in zip(segments, ends):
+        if segment_hash in parsed_turns:
+            # The same text again, e.g. a repeated prompt
+            conversation.extend(copy.deepcopy(parsed_turns[segment_hash]))
+            continue
+        parsed = stored.get(segment_hash)
+        if parsed is None:
+            if start >= scan_from:
+                # One segment holds at most one turn, none if its header only ends a turn
+                parsed = [
+                    _parse_scanned_turn(
+                        scanned_turns[start],
+                        base_path=base_path,
+                        ignore_images=ignore_images,
+                        ignore_links=ignore_links,
+                        resolved_paths=resolved_paths,
+                        )
+                ] if start in scanned_turns else []
+            else:
+                # An indexed turn that isn't in the turn file
+                parsed = parse_conversation(
+                    file_contents[start:end],
+                    base_path=base_path,
+                    ignore_images=ignore_images,
+                    ignore_links=ignore_links,
+                    )['conversation']
+            added[segment_hash] = parsed
+        parsed_turns[segment_hash] = parsed
+        conversation.extend(parsed)
+
+    stale = len(stored) - (len(parsed_turns) - len(added))
+    if not appendable or stale > len(parsed_turns):
+        _save_turns(turns_path, options, parsed_turns, append=False)
+    elif added:
+        _save_turns(turns_path, options, added, append=True)
+
+    if segments and not scanned['has_stray_comment']:
+        prefix_end = segments[-1][0]
+        prefix_hash = _hash(file_contents[:prefix_end])
+    else:
+        prefix_end = prefix_hash = None
+
+    new_index = {
+        'version': INDEX_VERSION,
+        'options': options,
+        'prefix_end': prefix_end,
+        'prefix_hash': prefix_hash,
+        'segments': segments,
+    }
+    if new_index != index:
+        _save_index(index_path, new_index)
+
+    return {'conversation': conversation, 'metadata': {'has_images': _has_images(conversation)}}
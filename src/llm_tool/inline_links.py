@@ -1,8 +1,142 @@
 from pathlib import Path
 from llm_tool.paths import resolve_existing_filepath
+import mmap
 import os
 
-def _convert_link_to_full_text(link_chunk: dict) -> dict:
+# Files with a NUL byte in this many leading bytes are treated as binary
+_BINARY_SNIFF_BYTES = 8192
+
+# Rough size of a token, for turning token budgets into byte budgets
+BYTES_PER_TOKEN = 4
+
+EXCERPTS = ('head', 'tail', 'head_tail')
+
+
+def _format_size(n_bytes: int) -> str:
+    if n_bytes < 1024:
+        return f"{n_bytes} bytes"
+    if n_bytes < 1024 * 1024:
+        return f"{n_bytes / 1024:.1f} KB"
+    return f"{n_bytes / (1024 * 1024):.1f} MB"
+
+
+def _decode(data: bytes, cut_start: bool = False, cut_end: bool = False) -> str:
+    """Decode utf-8, dropping characters split by a cut at either end"""
+    text = data.decode('utf-8', errors='replace')
+    if cut_start:
+        text = text.lstrip('\ufffd')
+    if cut_end:
+        text = text.rstrip('\ufffd')
+    return text
+
+
+def _head(view, n_bytes: int) -> bytes:
+    """The first n_bytes, cut back to the end of a line if there is one in the second half"""
+    data = view[:n_bytes]
+    newline = data.rfind(b'\n', n_bytes // 2)
+    return data[:newline + 1] if newline != -1 else data
+
+
+def _tail(view, size: int, n_bytes: int) -> bytes:
+    """The last n_bytes, cut forward to the start of a line if there is one in the first half"""
+    data = view[size - n_bytes:]
+    newline = data.find(b'\n', 0, n_bytes // 2)
+    return data[newline + 1:] if newline != -1 else data
+
+
+def read_text_capped(filepath: str | os.PathLike, max_bytes: int | None = None, excerpt: str = 'head_tail') -> str | None:
+    """
+    Read a text file, keeping at most max_bytes of it.
+
+    The file is memory-mapped, so only the parts that are kept are read
+    from disk, however big the file is. If the file is bigger than
+    max_bytes, an excerpt is kept and a note saying what was cut is added
+    in its place, so the model knows the content is incomplete.
+
+    Parameters
+    ----------
+    filepath : str or PathLike
+        The file to read.
+    max_bytes : int or None
+        The most bytes of the file to keep. None keeps the whole file.
+    excerpt : str
+        Which part of a file that is too big to keep: 'head' (the start),
+        'tail' (the end) or 'head_tail' (half from each end).
+
+    Returns
+    -------
+    str or None
+        The text, stripped of leading and trailing whitespace, or None if
+        the file looks binary.
+
+    Examples
+    --------
+    >>> read_text_capped('huge.log', max_bytes=20, excerpt='tail')
+    '[... first 1.2 MB of huge.log not included ...]\n\nlast line of the log'
+    """
+    if excerpt not in EXCERPTS:
+        raise ValueError(f"excerpt must be one of {', '.join(EXCERPTS)}, not {excerpt!r}")
+    filepath = Path(filepath)
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if b'\x00' in view[:_BINARY_SNIFF_BYTES]:
+                return None
+
+            if max_bytes is None or size <= max_bytes:
+                return _decode(view[:]).strip()
+
+            name = filepath.name
+            if excerpt == 'head':
+                head = _head(view, max_bytes)
+                omitted = size - len(head)
+                return (
+                    _decode(head, cut_end=True).strip()
+                    + f"\n\n[... last {_format_size(omitted)} of {name} not included ...]"
+                )
+            if excerpt == 'tail':
+                tail = _tail(view, size, max_bytes)
+                omitted = size - len(tail)
+                return (
+                    f"[... first {_format_size(omitted)} of {name} not included ...]\n\n"
+                    + _decode(tail, cut_start=True).strip()
+                )
+            head = _head(view, max_bytes - max_bytes // 2)
+            tail = _tail(view, size, max_bytes // 2)
+            omitted = size - len(head) - len(tail)
+            return (
+                _decode(head, cut_end=True).strip()
+                + f"\n\n[... {_format_size(omitted)} from the middle of {name} not included ...]\n\n"
+                + _decode(tail, cut_start=True).strip()
+            )
+
+
+def link_byte_limits(link_budget: dict | None) -> tuple[int | None, int | None]:
+    """
+    The per-link and per-conversation byte limits from a link_budget config.
+
+    Token limits are converted to bytes at BYTES_PER_TOKEN bytes per token,
+    and where both a byte and a token limit are set the smaller one wins.
+
+    Examples
+    --------
+    >>> link_byte_limits({'max_bytes': 10000, 'max_tokens': 1000, 'max_total_bytes': None})
+    (4000, None)
+    """
+    def smaller(max_bytes, max_tokens):
+        limits = [limit for limit in (max_bytes, max_tokens and max_tokens * BYTES_PER_TOKEN) if limit]
+        return min(limits) if limits else None
+
+    link_budget = link_budget or dict()
+    return (
+        smaller(link_budget.get('max_bytes'), link_budget.get('max_tokens')),
+        smaller(link_budget.get('max_total_bytes'), link_budget.get('max_total_tokens')),
+    )
+
+
+def _convert_link_to_full_text(link_chunk: dict, max_bytes: int | None = None, excerpt: str = 'head_tail') -> dict:
     """
     Convert a link chunk to a text chunk by reading the file contents.
 
@@ -10,15 +144,21 @@ def _convert_link_to_full_text(link_chunk: dict) -> dict:
     ----------
     link_chunk : dict
         A dictionary containing the link information.
+    max_bytes : int or None
+        The most bytes of the file to include (see `read_text_capped`).
+        0 leaves the file out, with a note saying so.
+    excerpt : str
+        Which part of a file bigger than max_bytes to include.
 
     Returns
     -------
     dict
-        A dictionary with the file contents as text.
+        A dictionary with the file contents as text. Binary files are
+        replaced by a note saying they were skipped.
 
     Raises
     ------
-    ValueError
+    FileNotFoundError
         If the file does not exist.
 
     Examples
@@ -28,17 +168,26 @@ def _convert_link_to_full_text(link_chunk: dict) -> dict:
     {'type': 'text', 'text': 'File contents here'}
     """
     absolute_path = Path(link_chunk.get("link")).resolve()
-    
-    file_contents = absolute_path.read_text().strip()
+
+    if max_bytes == 0:
+        if not absolute_path.is_file():
+            raise FileNotFoundError(absolute_path)
+        return {"type": "text", "text": f"[... {absolute_path.name} not included: the link budget for this conversation is used up ...]"}
+
+    file_contents = read_text_capped(absolute_path, max_bytes=max_bytes, excerpt=excerpt)
+    if file_contents is None:
+        file_contents = f"[... {absolute_path.name} not included: it is a binary file ...]"
 
     return {"type": "text", "text": file_contents}
-        
 
 
 def replace_links_with_file_contents(conversation: list[dict]) -> list[dict]:
     """
     Replace link chunks in a conversation with the contents of the linked files.
 
+    Each distinct file is read once, and files are read concurrently
+    (see `hydrate_conversation`).
+
     Parameters
     ----------
     conversation : list of dict
@@ -65,14 +214,7 @@ def replace_links_with_file_contents(conversation: list[dict]) -> list[dict]:
     >>> replace_links_with_file_contents(conversation)
     [{'role': 'user', 'content': [{'type': 'text', 'text': 'Hello'}, {'type': 'text', 'text': 'File contents here'}]}]
     """
-    for turn in conversation:
-        if turn['role'] == 'user':
-            turn['content'] = [
-                 _convert_link_to_full_text(chunk)
-                 if chunk['type'] == 'link' 
-                 else chunk 
-                 for chunk in turn['content']
-                 ]
-
-    return conversation
+    from llm_tool.hydration import hydrate_conversation
+
+    return hydrate_conversation(conversation, links=True, images=False)
 
@@ -1,7 +1,15 @@
-import llm
-from dotenv import load_dotenv, find_dotenv
+from collections.abc import Iterator
+import functools
+import hashlib
+import inspect
+import json
+from llm_tool.config_and_system import load_env_file
+from llm_tool.mock_models import is_mock_model
+from llm_tool.profiling import is_profiling, record, span
+from llm_tool.prompt_cache import format_cache_usage, llm_cache_options
 
-load_dotenv(find_dotenv()) # Loads any API key env variables set in .env
+# llm is imported inside the functions that use it: importing it loads
+# every installed plugin, which dominates startup time.
 
 
 def _create_fake_response(model, prompt_text, response_text, system=None):
@@ -20,6 +28,8 @@ def _create_fake_response(model, prompt_text, response_text, system=None):
     Returns:
         llm.Response: A fake response object with the given content
     """
+    import llm
+
     prompt_obj = llm.Prompt(
         prompt_text,
         model=model,
@@ -97,7 +107,213 @@ def chunk_user_assistant_turns(conversation):
     return result
 
 
-def llm_conversation(parsed_file_contents: dict, config: dict) -> str:
+def _report_usage(response) -> None:
+    """Print prompt cache token counts, for models whose plugins report them"""
+    usage = response.usage()
+    record(input_tokens=usage.input, output_tokens=usage.output)
+    cache_usage = format_cache_usage({**(usage.details or dict()), 'input_tokens': usage.input})
+    if cache_usage is not None:
+        print(cache_usage)
+
+
+@functools.cache
+def _supports_message_chains() -> bool:
+    """Whether this version of llm accepts the history as a list of messages"""
+    import llm
+    return 'messages' in inspect.signature(llm.models.Conversation.prompt).parameters
+
+
+def _history_messages(history: list[dict]) -> list:
+    """The user/assistant pairs of a conversation as llm messages"""
+    from llm.parts import assistant, user
+
+    messages = []
+    for turn in history:
+        messages.append(user(turn['user']))
+        if 'assistant' in turn:
+            messages.append(assistant(turn['assistant']))
+    return messages
+
+
+def _pair_hash(user_text: str, assistant_text: str) -> str:
+    serialised = json.dumps([user_text.strip(), assistant_text.strip()], ensure_ascii=False)
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+
+def _message_text(message) -> str:
+    return ''.join(getattr(part, 'text', None) or '' for part in message.parts)
+
+
+def _persisted_pairs(messages: list) -> list[tuple[str, int]]:
+    """Hash each user/assistant pair of a logged message chain
+
+    Returns:
+        list: (hash, index of the pair's user message in `messages`) tuples.
+    """
+    pairs = []
+    for i, message in enumerate(messages):
+        if message.role == 'user':
+            pairs.append([_message_text(message), '', i])
+        elif message.role == 'assistant' and pairs:
+            pairs[-1][1] += _message_text(message)
+    return [(_pair_hash(user_text, assistant_text), start) for user_text, assistant_text, start in pairs]
+
+
+def logs_db():
+    """The llm logs database, migrated to the current schema"""
+    import llm.cli
+    import sqlite_utils
+    from llm.migrations import migrate
+
+    db = sqlite_utils.Database(llm.cli.logs_db_path())
+    migrate(db)
+    return db
+
+
+def _logged_messages(conversation_id: str) -> list | None:
+    """The message chain of a conversation in the llm logs, or None if it isn't there"""
+    from llm.logs import LogStore
+
+    try:
+        return LogStore(logs_db()).thread_messages(conversation_id)
+    except KeyError:
+        return None
+
+
+def _load_persisted_conversation(model, history: list[dict], config: dict):
+    """
+    Load a conversation from the llm logs and re-sync it with the markdown.
+
+    Only the logged message chain is read, not the logged responses, and
+    the conversation is continued with the model in the config, which
+    may not be the one that gave the logged answers.
+
+    The logged message chain is compared with the markdown turn by turn,
+    using a hash of each user/assistant pair. If they match, the logged
+    conversation is used as it is. Otherwise the logged messages before
+    the first difference are kept and the turns from there on are rebuilt
+    from the markdown, to be sent with the new prompt. The next response
+    is logged with the whole chain, so the log is in sync again.
+
+    Returns:
+        tuple: (conversation, messages) where messages is None if the
+            logged history can be used as it is, or else the history to
+            send with the new prompt.
+    """
+    conversation = model.conversation()
+    conversation_id = config.get('llm_conversation_id')
+    loaded_messages = _logged_messages(conversation_id) if conversation_id else None
+    if conversation_id and loaded_messages is None:
+        print(f"llm conversation {conversation_id} isn't in the llm logs, starting a new one")
+    if loaded_messages is None:
+        return conversation, _history_messages(history)
+    conversation.id = conversation_id
+
+    persisted = _persisted_pairs(loaded_messages)
+    markdown = [_pair_hash(turn['user'], turn.get('assistant', '')) for turn in history]
+
+    n_same = 0
+    for (persisted_hash, _), markdown_hash in zip(persisted, markdown):
+        if persisted_hash != markdown_hash:
+            break
+        n_same += 1
+
+    if n_same == len(persisted) == len(markdown):
+        conversation.loaded_messages = loaded_messages
+        return conversation, None
+
+    print(f"Re-syncing {len(markdown) - n_same} turns with the llm log")
+    keep_until = persisted[n_same][1] if n_same < len(persisted) else len(loaded_messages)
+    # The system message is sent separately
+    kept = [message for message in loaded_messages[:keep_until] if message.role != 'system']
+    return conversation, kept + _history_messages(history[n_same:])
+
+
+def _prepare_llm_conversation(parsed_file_contents: dict, config: dict):
+    """
+    Rebuild the llm conversation history and pop the new prompt.
+
+    The history is passed to the model as a list of messages. With the
+    persist_conversation option, it is loaded from the llm logs instead
+    (see `_load_persisted_conversation`). Versions of llm that don't take
+    a list of messages get fake responses instead.
+
+    Returns:
+        tuple: (conversation, new_prompt, messages) where conversation is
+            an llm Conversation and messages is the history to send with
+            the new prompt, or None if the conversation holds the history.
+            None if the last user message has already been answered.
+    """
+    chunked_conversation = chunk_user_assistant_turns(parsed_file_contents['conversation'])
+
+    if not chunked_conversation or 'assistant' in chunked_conversation[-1].keys():
+        return None
+
+    with span('load_model'):
+        import llm
+        load_env_file()
+        if is_mock_model(config['model_name']):
+            from llm_tool.mock_llm_plugin import ensure_registered
+            ensure_registered()
+        model = llm.get_model(config['model_name'])
+
+    new_prompt = chunked_conversation.pop()
+    if is_profiling():
+        record(bytes_sent=sum(
+            len(text.encode('utf-8'))
+            for turn in chunked_conversation + [new_prompt] for text in turn.values()
+            ) + len(config['system_msg'].encode('utf-8')))
+
+    if _supports_message_chains():
+        with span('prepare_history'):
+            if config.get('persist_conversation'):
+                conversation, messages = _load_persisted_conversation(model, chunked_conversation, config)
+            else:
+                conversation, messages = model.conversation(), _history_messages(chunked_conversation)
+        return conversation, new_prompt, messages
+
+    if config.get('persist_conversation'):
+        print("persist_conversation needs a newer version of llm: rebuilding the history")
+
+    conversation = model.conversation()
+    conversation.responses += [
+        _create_fake_response(
+            model=model,
+            prompt_text=turn['user'],
+            response_text=turn['assistant'],
+            system=config['system_msg'],
+        )
+        for turn in chunked_conversation
+    ]
+
+    return conversation, new_prompt, None
+
+
+def _prompt_kwargs(conversation, config: dict, messages) -> dict:
+    prompt_kwargs = dict(
+        system=config['system_msg'],
+        **config['model_options'],
+        **llm_cache_options(conversation.model, config),
+    )
+    if messages is not None:
+        prompt_kwargs['messages'] = messages
+    return prompt_kwargs
+
+
+def _log_response(response, conversation, config: dict, on_new_conversation=None) -> None:
+    """Log a response with persist_conversation, then report the id of a new logged conversation
+
+    The id is only reported once the response is logged, so it always
+    refers to a conversation in the logs.
+    """
+    if config.get('persist_conversation') and _supports_message_chains():
+        with span('log_conversation'):
+            response.log_to_db(logs_db())
+        if on_new_conversation is not None and conversation.id != config.get('llm_conversation_id'):
+            on_new_conversation(conversation.id)
+
+
+def llm_conversation(parsed_file_contents: dict, config: dict, on_new_conversation=None) -> str:
     """
     Process a conversation from a markdown file and get an LLM response to a new prompt.
 
@@ -113,6 +329,11 @@ def llm_conversation(parsed_file_contents: dict, config: dict) -> str:
             - 'model_name': Name of the LLM model to use
             - 'system_msg': System message for the LLM
             - 'model_options': Additional options to pass to the model (e.g., max_tokens)
+            - 'persist_conversation': Whether to keep the history in the llm logs
+            - 'llm_conversation_id': The logged conversation to continue, if any
+        on_new_conversation (callable | None): Called with the id of a new
+            logged conversation once the response is logged, so that it
+            can be recorded in the file.
 
     Returns:
         str: Formatted response from the LLM as markdown (e.g., "\\n# %Assistant\\n\\nResponse text"),
@@ -121,37 +342,57 @@ def llm_conversation(parsed_file_contents: dict, config: dict) -> str:
     Note:
         This function prints "No new prompts." to stdout when there's no new prompt.
     """
-    chunked_conversation = chunk_user_assistant_turns(parsed_file_contents['conversation'])
+    prepared = _prepare_llm_conversation(parsed_file_contents, config)
 
-    model = llm.get_model(config['model_name'])
-    conversation = model.conversation()
+    if prepared is None:
+        print('No new prompts.')
+        return ''
 
-    if 'assistant' not in chunked_conversation[-1].keys():
-        new_prompt = chunked_conversation.pop()
-
-        conversation.responses += [
-            _create_fake_response(
-                model=model,
-                prompt_text=turn['user'],
-                response_text=turn['assistant'],
-                system=config['system_msg'],
-            )
-            for turn in chunked_conversation
-        ]
+    conversation, new_prompt, messages = prepared
+    new_response = conversation.prompt(
+        new_prompt['user'],
+        stream=False,
+        **_prompt_kwargs(conversation, config, messages),
+    )
+    formatted_response = f"\n# %Assistant\n\n{new_response}"
+    _report_usage(new_response)
+    _log_response(new_response, conversation, config, on_new_conversation)
+    return formatted_response
 
-        new_response = conversation.prompt(
-            new_prompt['user'],
-            system=config['system_msg'],
-            **config['model_options'],
-        )
-        new_formatted_response = f"\n# %Assistant\n\n{new_response}"
-    else:
-        print('No new prompts.')
-        new_formatted_response = ''
 
-    return new_formatted_response
+def llm_conversation_stream(parsed_file_contents: dict, config: dict, on_new_conversation=None) -> Iterator[str]:
+    """
+    Stream an LLM response to the new prompt in a conversation.
+
+    The streaming counterpart of `llm_conversation`. The first chunk yielded
+    is the "\\n# %Assistant\\n\\n" header, so that it can be written to
+    the file before the model has produced any text. The following chunks
+    are the response text as it arrives from the model.
 
+    Args:
+        parsed_file_contents (dict): Parsed markdown file (see `llm_conversation`).
+        config (dict): Configuration (see `llm_conversation`).
+        on_new_conversation (callable | None): See `llm_conversation`.
 
+    Yields:
+        str: The assistant header, then chunks of response text. Nothing is
+            yielded if there's no new prompt to respond to.
+    """
+    prepared = _prepare_llm_conversation(parsed_file_contents, config)
 
+    if prepared is None:
+        print('No new prompts.')
+        return
 
+    conversation, new_prompt, messages = prepared
+    yield "\n# %Assistant\n\n"
 
+    response = conversation.prompt(
+        new_prompt['user'],
+        stream=True,
+        **_prompt_kwargs(conversation, config, messages),
+    )
+    for chunk in response:
+        yield chunk
+    _report_usage(response)
+    _log_response(response, conversation, config, on_new_conversation)
@@ -0,0 +1,218 @@
+"""Reading very large conversation files through a memory map.
+
+Reading a file with `file.read()` and parsing it makes several copies of
+the transcript: the file's content, the body after the yaml header and the
+text of every turn. For a transcript of hundreds of MB that is a lot of
+memory. Here the file is memory-mapped instead. The yaml header and the
+turn boundaries are found in the mapped bytes (`scanner.scan_boundaries`),
+and each turn is decoded and parsed on its own. Only what is needed to
+choose the turns to send is kept: the turn's role and markers, its
+estimated tokens and its span in the map. `read_mapped_turns` reads the
+text of the turns that are sent, once the conversation has been fitted
+to the context window. Pages of the map that have been read are
+released as each pass goes (`release`), so they don't add to the
+process's memory either.
+
+llmd reads files of `mmap_min_mb` MB or more (in the USER or PROJECT
+config) this way.
+"""
+from collections.abc import Iterator
+from contextlib import contextmanager
+from os import PathLike
+import hashlib
+import mmap
+import os
+import re
+import yaml
+from llm_tool.config_and_system import load_yaml
+from llm_tool.context_window import estimate_turn_tokens
+from llm_tool.parser import parse_conversation, _has_images
+from llm_tool.scanner import scan_boundaries
+
+# parser._YAML_HEADER, for files with Windows (CRLF) newlines too, which
+# `safe_write.read_with_snapshot` normalises before the header is parsed
+_YAML_HEADER_BYTES = re.compile(rb'^---\s*\n(.*?)\r?\n---\s*\n', re.DOTALL)
+
+_HASH_CHUNK = 16 * 1024 * 1024
+
+
+@contextmanager
+def map_file(path: str | PathLike[str]) -> Iterator[mmap.mmap | bytes]:
+    """
+    Memory-map a file for reading.
+
+    Yields
+    ------
+    mmap.mmap or bytes
+        The mapped file, or b'' for an empty file, which can't be mapped.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def release(data: mmap.mmap | bytes, start: int, end: int) -> None:
+    """
+    Drop the pages of a map between start and end from this process's memory.
+
+    They stay in the page cache, and are mapped again if they are read.
+    Does nothing for bytes, or where madvise isn't available.
+    """
+    if not isinstance(data, mmap.mmap) or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    start -= start % mmap.PAGESIZE
+    end -= end % mmap.PAGESIZE
+    if end > start:
+        data.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def sha256_of(data: mmap.mmap | bytes, end: int | None = None):
+    """The sha256 hash object of data up to end, hashed a chunk at a time"""
+    end = len(data) if end is None else end
+    digest = hashlib.sha256()
+    with memoryview(data) as view:
+        for start in range(0, end, _HASH_CHUNK):
+            digest.update(view[start:min(start + _HASH_CHUNK, end)])
+            release(data, start, start + _HASH_CHUNK)
+    return digest
+
+
+def header_end(data: bytes) -> int:
+    """The offset of the body in a markdown file, after its yaml header if it has one"""
+    match = _YAML_HEADER_BYTES.match(data)
+    return match.end() if match else 0
+
+
+def parse_mapped_header(data: bytes) -> tuple[dict, int]:
+    """
+    Parse the yaml header of a mapped markdown file.
+
+    The mapped version of `parse_markdown_with_yaml`: only the header is
+    copied out of the map.
+
+    Returns
+    -------
+    tuple of (dict, int)
+        The header, or an empty dict, and the offset of the body.
+    """
+    match = _YAML_HEADER_BYTES.match(data)
+    if not match:
+        return dict(), 0
+    from llm_tool.safe_write import normalise_newlines
+
+    try:
+        header = load_yaml(normalise_newlines(match.group(1).decode('utf-8')))
+    except yaml.YAMLError as e:
+        print(f"Error parsing YAML: {e}")
+        return dict(), 0
+    print("Using YAML header options.")
+    return header, match.end()
+
+
+def _parse_span(
+    data: bytes,
+    offset: int,
+    length: int,
+    base_path: str | PathLike[str],
+    ignore_images: bool,
+    ignore_links: bool,
+    ) -> list[dict]:
+    """The turns parsed from length bytes of the map at offset"""
+    from llm_tool.safe_write import normalise_newlines
+
+    # Headers are ASCII, so a turn never splits a UTF-8 character
+    text = normalise_newlines(str(data[offset:offset + length], 'utf-8'))
+    turns = parse_conversation(
+        text,
+        base_path=base_path,
+        ignore_images=ignore_images,
+        ignore_links=ignore_links,
+        )['conversation']
+    release(data, offset, offset + length)
+    return turns
+
+
+def parse_mapped_conversation(
+    data: bytes,
+    body_start: int = 0,
+    base_path: str | PathLike[str] = '.',
+    ignore_images: bool = False,
+    ignore_links: bool = False,
+    ) -> dict:
+    """
+    Parse the conversation in a mapped markdown file, one turn at a time.
+
+    The turns are those of `parse_conversation` on the decoded body, with
+    its newlines normalised as `safe_write.read_with_snapshot` does, but
+    without their text: in place of its 'content', each turn has the
+    (offset, length) of its text in the map as its 'span', and its
+    estimated tokens (see `context_window.estimate_turn_tokens`) as its
+    'tokens'. `read_mapped_turns` reads their content.
+
+    Parameters
+    ----------
+    data : bytes-like
+        The mapped file.
+    body_start : int
+        The offset of the body, from `parse_mapped_header`.
+    base_path, ignore_images, ignore_links
+        As for `parse_conversation`.
+
+    Returns
+    -------
+    dict
+        The parsed conversation, as from `parse_conversation`.
+    """
+    boundaries, _ = scan_boundaries(data, body_start)
+    release(data, 0, len(data))
+    conversation = []
+    has_images = False
+    for start, end in zip(boundaries, boundaries[1:] + [len(data)]):
+        for turn in _parse_span(data, start, end - start, base_path, ignore_images, ignore_links):
+            has_images = has_images or _has_images([turn])
+            turn['tokens'] = estimate_turn_tokens(turn)
+            del turn['content']
+            turn['span'] = (start, end - start)
+            conversation.append(turn)
+    return {'conversation': conversation, 'metadata': {'has_images': has_images}}
+
+
+def read_mapped_turns(
+    data: bytes,
+    conversation: list[dict],
+    base_path: str | PathLike[str] = '.',
+    ignore_images: bool = False,
+    ignore_links: bool = False,
+    ) -> list[dict]:
+    """
+    Read the content of turns from `parse_mapped_conversation`.
+
+    Parameters
+    ----------
+    data : bytes-like
+        The mapped file the turns were parsed from.
+    conversation : list of dict
+        Turns from `parse_mapped_conversation`, such as those left once
+        the conversation has been fitted to the context window. Turns
+        without a 'span', such as the turns of an expanded archive, are
+        kept as they are.
+    base_path, ignore_images, ignore_links
+        As for `parse_mapped_conversation`.
+
+    Returns
+    -------
+    list of dict
+        The turns as `parse_conversation` gives them.
+    """
+    turns = []
+    for turn in conversation:
+        if 'span' not in turn:
+            turns.append(turn)
+            continue
+        offset, length = turn['span']
+        [read] = _parse_span(data, offset, length, base_path, ignore_images, ignore_links)
+        turns.append(read)
+    return turns
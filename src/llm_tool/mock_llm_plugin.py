@@ -0,0 +1,59 @@
+"""An `llm` plugin providing the offline 'mock' model (see `mock_models`).
+
+Installing llmd registers it with `llm` through an entry point, so
+`llm -m mock 'Hello'` works too. llmd also registers it on demand with
+`ensure_registered`, for when it runs from a source checkout.
+"""
+import sys
+import threading
+import llm
+from llm_tool.mock_models import MOCK_MODEL, MockAPIError, estimate_tokens, mock_settings, mock_stream
+
+_register_lock = threading.Lock()
+
+
+class MockModel(llm.Model):
+    model_id = MOCK_MODEL
+    can_stream = True
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+        ttft: float | None = None
+        chunks_per_second: float | None = None
+        chunk_bytes: int | None = None
+        response_bytes: int | None = None
+        error_rate: float | None = None
+        seed: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        settings = mock_settings(dict(prompt.options))
+        text = []
+        try:
+            for chunk in mock_stream(prompt.prompt or '', settings):
+                text.append(chunk)
+                yield chunk
+        except MockAPIError as e:
+            raise llm.ModelError(str(e)) from e
+        history_text = ''.join(
+            ''.join(getattr(part, 'text', None) or '' for part in message.parts)
+            for message in getattr(prompt, 'messages', None) or []
+        )
+        response.set_usage(
+            input=estimate_tokens((prompt.system or '') + (history_text or prompt.prompt or '')),
+            output=estimate_tokens(''.join(text)),
+        )
+
+
+@llm.hookimpl
+def register_models(register):
+    register(MockModel())
+
+
+def ensure_registered() -> None:
+    """Register this plugin with llm, unless it already is (e.g. through its entry point)"""
+    from llm.plugins import pm
+
+    plugin = sys.modules[__name__]
+    with _register_lock:
+        if not pm.is_registered(plugin) and pm.get_plugin('llmd-mock') is None:
+            pm.register(plugin, name='llmd-mock')
@@ -0,0 +1,310 @@
+"""Mock models for offline testing and load testing.
+
+The model named 'mock' answers without a network connection, in both
+backends: through `llm` (see `mock_llm_plugin`) and, for conversations
+with images, through `MockAnthropicClient`, a stand-in for the Anthropic
+client. How it answers is set with model options, in a yaml header or
+config like any other model:
+
+    model: mock
+    options:
+      ttft: 0.5               # seconds before the first chunk
+      chunks_per_second: 40   # streaming rate after that
+      chunk_bytes: 16
+      response_bytes: 2000
+      error_rate: 0.1         # fraction of requests that fail
+      seed: 1                 # for repeatable errors
+
+The whole response takes about ttft + response_bytes / chunk_bytes /
+chunks_per_second seconds, streamed or not.
+
+`MockAnthropicClient` also has an offline stand-in for the Files API
+(`MockFiles`), and its messages check that the file ids they refer to
+were uploaded.
+"""
+from collections.abc import Iterator
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import asyncio
+import itertools
+import random
+import threading
+import time
+
+MOCK_MODEL = 'mock'
+
+MOCK_DEFAULTS = {
+    'ttft': 0.05,
+    'chunks_per_second': 50.0,
+    'chunk_bytes': 16,
+    'response_bytes': 200,
+    'error_rate': 0.0,
+    'seed': None,
+}
+
+_FILLER = "The quick brown fox jumps over the lazy dog. "
+
+_rngs = dict()
+_rngs_lock = threading.Lock()
+
+
+class MockAPIError(Exception):
+    """An injected failure, like an overloaded API"""
+
+    status_code = 529
+
+
+class MockNotFoundError(Exception):
+    """A request referred to a file that wasn't uploaded, or was deleted"""
+
+    status_code = 404
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        # As anthropic's APIStatusError.body
+        self.body = {'type': 'error', 'error': {'type': 'not_found_error', 'message': message}}
+
+
+def is_mock_model(model_name: str | None) -> bool:
+    """Whether a model name refers to the mock model"""
+    return model_name == MOCK_MODEL
+
+
+def mock_settings(options: dict | None) -> dict:
+    """
+    The mock model's settings from model options, with defaults for the rest.
+
+    Options that aren't mock settings (such as max_tokens) are ignored.
+
+    Examples
+    --------
+    >>> mock_settings({'ttft': 1, 'max_tokens': 100})['ttft']
+    1
+    """
+    options = options or dict()
+    return {key: default if options.get(key) is None else options[key] for key, default in MOCK_DEFAULTS.items()}
+
+
+def _rng(seed) -> random.Random:
+    # Seeded generators are shared, so a sequence of requests is repeatable
+    if seed is None:
+        return random.Random()
+    with _rngs_lock:
+        return _rngs.setdefault(seed, random.Random(seed))
+
+
+def mock_response_text(prompt_text: str, response_bytes: int) -> str:
+    """
+    The mock model's response: the start of the prompt, padded to response_bytes.
+
+    Examples
+    --------
+    >>> mock_response_text('What is 2 + 2?', 40)
+    'Mock answer to: What is 2 + 2? The quick'
+    """
+    lines = prompt_text.strip().splitlines()
+    text = f"Mock answer to: {lines[0][:60] if lines else ''}"
+    if len(text) < response_bytes:
+        text = f"{text} {_FILLER * (response_bytes // len(_FILLER) + 1)}"[:response_bytes]
+    return text.rstrip()
+
+
+def _chunks(text: str, chunk_bytes: int) -> list[str]:
+    chunk_bytes = max(1, int(chunk_bytes))
+    return [text[i:i + chunk_bytes] for i in range(0, len(text), chunk_bytes)]
+
+
+def _should_fail(settings: dict) -> bool:
+    return settings['error_rate'] > 0 and _rng(settings['seed']).random() < settings['error_rate']
+
+
+def mock_stream(prompt_text: str, settings: dict) -> Iterator[str]:
+    """
+    Yield a mock response in chunks, at the pace set by the settings.
+
+    Raises
+    ------
+    MockAPIError
+        For the fraction of requests set by error_rate, before any text.
+    """
+    time.sleep(settings['ttft'])
+    if _should_fail(settings):
+        raise MockAPIError(f"Mock model overloaded (error_rate {settings['error_rate']})")
+    interval = 1 / settings['chunks_per_second'] if settings['chunks_per_second'] else 0
+    for i, chunk in enumerate(_chunks(mock_response_text(prompt_text, settings['response_bytes']), settings['chunk_bytes'])):
+        if i and interval:
+            time.sleep(interval)
+        yield chunk
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _message_text(message: dict) -> str:
+    content = message['content']
+    if isinstance(content, str):
+        return content
+    return '\n'.join(block.get('text', '') for block in content if block.get('type') == 'text')
+
+
+def _mock_message(request: dict, text: str):
+    """An object shaped like an Anthropic Message"""
+    prompt_tokens = estimate_tokens(str(request.get('system', ''))) + sum(
+        estimate_tokens(_message_text(message)) for message in request['messages']
+    )
+    return SimpleNamespace(
+        model=request.get('model', MOCK_MODEL),
+        role='assistant',
+        content=[SimpleNamespace(type='text', text=text)],
+        stop_reason='end_turn',
+        usage=SimpleNamespace(
+            input_tokens=prompt_tokens,
+            output_tokens=estimate_tokens(text),
+            cache_read_input_tokens=0,
+            cache_creation_input_tokens=0,
+        ),
+    )
+
+
+def _split_request(kwargs: dict) -> tuple[dict, dict]:
+    """The request, and the mock settings from the model options in it"""
+    settings = mock_settings({key: kwargs.pop(key) for key in list(kwargs) if key in MOCK_DEFAULTS})
+    return kwargs, settings
+
+
+def _last_prompt(request: dict) -> str:
+    return _message_text(request['messages'][-1]) if request['messages'] else ''
+
+
+class _MockStream:
+    """Like the SDK's MessageStream: iterate text_stream, then get_final_message()"""
+
+    def __init__(self, request: dict, settings: dict):
+        self._request = request
+        self._settings = settings
+        self._text = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self) -> Iterator[str]:
+        for chunk in mock_stream(_last_prompt(self._request), self._settings):
+            self._text.append(chunk)
+            yield chunk
+
+    def get_final_message(self):
+        return _mock_message(self._request, ''.join(self._text))
+
+
+class MockFiles:
+    """
+    A stand-in for the Files API (`client.beta.files`), keeping uploads in memory.
+
+    Uploads are shared by every mock client in the process, like files
+    in an account.
+
+    Examples
+    --------
+    >>> metadata = MockFiles().upload(file=('a.txt', b'Hello', 'text/plain'))
+    >>> MockFiles.uploads[metadata.id]
+    b'Hello'
+    """
+
+    uploads = dict()
+    _ids = itertools.count(1)
+
+    def upload(self, file, expires_in_seconds=None, betas=None):
+        filename, content, media_type = file
+        data = content if isinstance(content, bytes) else content.read()
+        file_id = f"file_mock_{next(self._ids)}"
+        self.uploads[file_id] = data
+        now = datetime.now(timezone.utc)
+        return SimpleNamespace(
+            id=file_id,
+            type='file',
+            filename=filename,
+            mime_type=media_type,
+            size_bytes=len(data),
+            created_at=now,
+            expires_at=now + timedelta(seconds=expires_in_seconds) if expires_in_seconds else None,
+        )
+
+    def delete(self, file_id, betas=None):
+        self.uploads.pop(file_id, None)
+        return SimpleNamespace(id=file_id, type='file_deleted')
+
+
+def _check_files(request: dict) -> None:
+    """Raise MockNotFoundError if the request refers to a file that wasn't uploaded"""
+    for message in request['messages']:
+        if isinstance(message['content'], str):
+            continue
+        for block in message['content']:
+            source = block.get('source')
+            if isinstance(source, dict) and source.get('type') == 'file' and source['file_id'] not in MockFiles.uploads:
+                raise MockNotFoundError(f"File not found: {source['file_id']}")
+
+
+class _MockMessages:
+    def create(self, **kwargs):
+        request, settings = _split_request(kwargs)
+        _check_files(request)
+        return _mock_message(request, ''.join(mock_stream(_last_prompt(request), settings)))
+
+    def stream(self, **kwargs) -> _MockStream:
+        request, settings = _split_request(kwargs)
+        _check_files(request)
+        return _MockStream(request, settings)
+
+
+class _AsyncMockMessages:
+    async def create(self, **kwargs):
+        request, settings = _split_request(kwargs)
+        _check_files(request)
+        # Sleep on the event loop rather than blocking it
+        await asyncio.sleep(settings['ttft'])
+        if _should_fail(settings):
+            raise MockAPIError(f"Mock model overloaded (error_rate {settings['error_rate']})")
+        text = mock_response_text(_last_prompt(request), settings['response_bytes'])
+        n_chunks = len(_chunks(text, settings['chunk_bytes']))
+        if settings['chunks_per_second']:
+            await asyncio.sleep((n_chunks - 1) / settings['chunks_per_second'])
+        return _mock_message(request, text)
+
+
+class MockAnthropicClient:
+    """
+    A stand-in for `anthropic.Anthropic` that answers with the mock model.
+
+    Supports `messages.create`, `messages.stream` and their `beta`
+    versions, and `beta.files` (see `MockFiles`). The mock settings
+    are taken from the request's keyword arguments, where the model
+    options end up.
+
+    Examples
+    --------
+    >>> client = MockAnthropicClient()
+    >>> message = client.messages.create(model='mock', max_tokens=10, ttft=0,
+    ...     messages=[{'role': 'user', 'content': 'Hi'}], response_bytes=0)
+    >>> message.content[0].text
+    'Mock answer to: Hi'
+    """
+
+    api_key = 'mock'
+
+    def __init__(self):
+        self.messages = _MockMessages()
+        self.beta = SimpleNamespace(messages=self.messages, files=MockFiles())
+
+
+class MockAsyncAnthropicClient:
+    """A stand-in for `anthropic.AsyncAnthropic`, supporting `messages.create`"""
+
+    def __init__(self):
+        self.messages = _AsyncMockMessages()
+        self.beta = SimpleNamespace(messages=self.messages)
@@ -1,10 +1,22 @@
 import re
 import yaml
+from llm_tool.config_and_system import load_yaml
+from llm_tool.fan_out import KEEP_MARKER, answer_label
 from llm_tool.paths import resolve_existing_filepath
+from llm_tool.scanner import scan_conversation
 import os
 
+_YAML_HEADER = re.compile(r'^---\s*\n(.*?)\n---\s*\n', re.DOTALL)
 
-def parse_conversation(file_contents: str,base_path: str | os.PathLike = ".", ignore_images=False,ignore_links=False) -> list[dict]:
+# A turn containing <!--llm low-priority llm--> can be left out first when
+# the conversation is too long for the context window
+LOW_PRIORITY_MARKER = 'low-priority'
+
+# The summary of archived turns has <!--llm archive: <file> llm--> (see compaction)
+ARCHIVE_LABEL = re.compile(r'^archive:\s*(?P<archive>\S+)$')
+
+
+def parse_conversation(file_contents: str,base_path: str | os.PathLike = ".", ignore_images=False,ignore_links=False, expand_archives=False) -> list[dict]:
     """Parse a conversation into user and assistant turns
 
     Args:
@@ -13,10 +25,17 @@ def parse_conversation(file_contents: str,base_path: str | os.PathLike = ".", ig
         base_path (str | os.PathLike): The base path to resolve relative links.
         ignore_images (bool)
         ignore_links (bool)
+        expand_archives (bool): Replace summaries of archived turns with
+           the turns from their archives (see `compaction`).
 
     Returns:
         list[dict]: A list of turns, where turns have either a role of
-         'user' or 'assistant', with content.
+         'user' or 'assistant', with content. Turns marked with a
+         `<!--llm low-priority llm-->` comment also have 'low_priority': True.
+         Assistant turns labelled with a `<!--llm model: name llm-->`
+         comment have 'model': name, and those marked `<!--llm keep llm-->`
+         have 'keep': True (see `fan_out.select_branch`). User turns
+         summarising archived turns have 'archive': the archive's file name.
 
     Examples:
         >>> content = "# User\\nHello\\n[file](path.txt)\\n![img](img.png)\\n# Assistant\\nHi there"
@@ -29,27 +48,73 @@ def parse_conversation(file_contents: str,base_path: str | os.PathLike = ".", ig
          {'role': 'assistant', 'content': 'Hi there'}
         ]
     """
-    pattern = r'# %(User|Assistant)\n(.*?)(?=# %User|# %Assistant|$)'
-
-    pruned_file_contents = _remove_commented_text(file_contents)
-
-    conversation = []
-    for role, content in re.findall(pattern, pruned_file_contents, re.DOTALL):
-        conversation.append({
-            "role": role.lower(),
-            "content": _parse_user_content_types(
-                content,
-                base_path = base_path,
-                ignore_images=ignore_images,
-                ignore_links=ignore_links
-                ) if role == 'User' else content.strip()
-        })
+    scanned = scan_conversation(file_contents)
+
+    # Each distinct path is resolved and checked once
+    resolved_paths = dict()
+    conversation = [
+        _parse_scanned_turn(
+            turn,
+            base_path=base_path,
+            ignore_images=ignore_images,
+            ignore_links=ignore_links,
+            resolved_paths=resolved_paths,
+            )
+        for turn in scanned['turns']
+    ]
+
+    if expand_archives:
+        from llm_tool.compaction import expand_archived_turns
+
+        conversation = expand_archived_turns(
+            conversation,
+            base_path=base_path,
+            ignore_images=ignore_images,
+            ignore_links=ignore_links,
+            )
     
     metadata = {'has_images': _has_images(conversation)}
 
     return {'conversation':conversation, 'metadata': metadata}
 
 
+def _parse_scanned_turn(turn: dict, base_path: str | os.PathLike = ".", ignore_images=False, ignore_links=False, resolved_paths: dict | None = None) -> dict:
+    """A turn of the conversation from a turn found by `scan_conversation`"""
+    parsed = {
+        "role": turn['role'],
+        "content": _user_content_from_spans(
+            turn['text'],
+            turn['spans'],
+            base_path = base_path,
+            ignore_images=ignore_images,
+            ignore_links=ignore_links,
+            resolved_paths=resolved_paths,
+            ) if turn['role'] == 'user' else turn['text'].strip()
+    }
+    if LOW_PRIORITY_MARKER in turn['comments']:
+        parsed['low_priority'] = True
+    if turn['role'] == 'assistant' and turn['comments']:
+        label = answer_label(turn['comments'])
+        if label is not None:
+            parsed['model'] = label
+        if KEEP_MARKER in turn['comments']:
+            parsed['keep'] = True
+    if turn['role'] == 'user' and turn['comments']:
+        archive = _archive_label(turn['comments'])
+        if archive is not None:
+            parsed['archive'] = archive
+    return parsed
+
+
+def _archive_label(comments: list[str]) -> str | None:
+    """The archive named in a turn's comments, if any"""
+    for comment in comments:
+        match = ARCHIVE_LABEL.match(comment)
+        if match:
+            return match.group('archive')
+    return None
+
+
 def parse_markdown_with_yaml(markdown_content: str) -> tuple[dict,str]:
     """Remove YAML header from markdown document and return as dict.
 
@@ -65,11 +130,8 @@ def parse_markdown_with_yaml(markdown_content: str) -> tuple[dict,str]:
         dict: Contents of the YAML header, or empty dict
         str: Body of the markdown doc
     """
-    # Regular expression to match the YAML header
-    yaml_pattern = re.compile(r'^---\s*\n(.*?)\n---\s*\n', re.DOTALL)
-    
     # Find the YAML header
-    match = yaml_pattern.match(markdown_content)
+    match = _YAML_HEADER.match(markdown_content)
     
     if match:
         # Extract the YAML content
@@ -77,7 +139,7 @@ def parse_markdown_with_yaml(markdown_content: str) -> tuple[dict,str]:
         
         try:
             # Parse the YAML content into a dictionary
-            yaml_dict = yaml.safe_load(yaml_content)
+            yaml_dict = load_yaml(yaml_content)
             
             # Get the body of the Markdown document
             markdown_body = markdown_content[match.end():]
@@ -91,6 +153,42 @@ def parse_markdown_with_yaml(markdown_content: str) -> tuple[dict,str]:
         return dict(), markdown_content
 
 
+def set_yaml_header_value(markdown_content: str, key: str, value) -> str:
+    """Set a top-level key in the YAML header of a markdown document.
+
+    The line holding the key is replaced, or added at the end of the
+    header. The rest of the header is left exactly as it was. A header
+    is added if the document doesn't have one.
+
+    Args:
+        markdown_content (str): The contents of the markdown doc as a string
+        key (str): The top-level key to set
+        value: The value, which must fit on one line as YAML
+
+    Returns:
+        str: The markdown doc with the header updated
+
+    Examples:
+        >>> set_yaml_header_value("---\\nmodel: gpt-4o\\n---\\n# %User\\nHi\\n", 'llm_conversation_id', 'abc')
+        '---\\nmodel: gpt-4o\\nllm_conversation_id: abc\\n---\\n# %User\\nHi\\n'
+    """
+    line = yaml.safe_dump({key: value}, default_flow_style=True, width=float('inf')).strip()
+    # safe_dump wraps a single mapping in braces in flow style
+    line = line[1:-1] if line.startswith('{') else line
+
+    match = _YAML_HEADER.match(markdown_content)
+    if not match:
+        return f"---\n{line}\n---\n{markdown_content}"
+
+    header = match.group(1)
+    key_line = re.compile(rf'^{re.escape(key)}\s*:.*$', re.MULTILINE)
+    if key_line.search(header):
+        header = key_line.sub(lambda _: line, header, count=1)
+    else:
+        header = f"{header}\n{line}"
+    return f"---\n{header}\n---\n{markdown_content[match.end():]}"
+
+
 def _remove_commented_text(file_contents,pattern=r'<!--llm.*?llm-->'):
     """Remove commented text from a string"""
     return re.sub(pattern,'',file_contents,flags=re.DOTALL)
@@ -99,21 +197,51 @@ def _remove_commented_text(file_contents,pattern=r'<!--llm.*?llm-->'):
     
 def _parse_user_content_types(content: str, base_path: str | os.PathLike = ".", ignore_images=False,ignore_links=False) -> list[dict]:
     """Find and split text, links and images in a user turn"""
-    chunk_pattern = r'(?P<text>.*?)(?:(?P<link>(?<!!)\[.*?\]\((?P<linkpath>.*?)\))|(?P<image>!\[.*?\]\((?P<imagepath>.*?)\))|$)'
+    turns = scan_conversation(content, role='user')['turns']
+    if not turns:
+        return []
+    return _user_content_from_spans(
+        turns[0]['text'],
+        turns[0]['spans'],
+        base_path=base_path,
+        ignore_images=ignore_images,
+        ignore_links=ignore_links,
+        )
+
+
+def _user_content_from_spans(text: str, spans: list[tuple], base_path: str | os.PathLike = ".", ignore_images=False,ignore_links=False, resolved_paths: dict | None = None) -> list[dict]:
+    """Split a user turn into text, link and image chunks at the spans found by the scanner
+
+    `resolved_paths` memoises `resolve_existing_filepath` across the turns
+    of a conversation.
+    """
+    if resolved_paths is None:
+        resolved_paths = dict()
+
+    def resolve(path):
+        if path not in resolved_paths:
+            resolved_paths[path] = str(resolve_existing_filepath(path,base_path))
+        return resolved_paths[path]
+
     chunks = []
-    for match in re.finditer(chunk_pattern, content, re.DOTALL):
-        if match.group('text').strip():
-            chunks.append({'type': 'text', 'text': match.group('text').strip()})
-        if match.group('link') and not ignore_links:
-            chunks.append({'type': 'link', 'link': str(resolve_existing_filepath(match.group('linkpath'),base_path))})
-        if match.group('image') and not ignore_images:
-            chunks.append({'type': 'image', 'source': str(resolve_existing_filepath(match.group('imagepath'),base_path))})
+    text_start = 0
+    for kind, start, path_start, path_end, end in spans:
+        if text[text_start:start].strip():
+            chunks.append({'type': 'text', 'text': text[text_start:start].strip()})
+        path = text[path_start:path_end]
+        if kind == 'link' and not ignore_links:
+            chunks.append({'type': 'link', 'link': resolve(path)})
+        if kind == 'image' and not ignore_images:
+            chunks.append({'type': 'image', 'source': resolve(path)})
+        text_start = end
+    if text[text_start:].strip():
+        chunks.append({'type': 'text', 'text': text[text_start:].strip()})
     return chunks
 
 def _has_images(conversation: list[dict]) -> bool:
     """Check if a conversation contains any image elements"""
     return any(
         any(chunk.get('type') == 'image' for chunk in turn['content'])
-        if isinstance(turn['content'], list) else False
+        if isinstance(turn.get('content'), list) else False
         for turn in conversation
     )
\ No newline at end of file
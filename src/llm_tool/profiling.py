@@ -0,0 +1,185 @@
+"""Lightweight timing of the stages of a run, for `llmd --profile`.
+
+Stages are timed with `span`, and counts such as bytes sent or tokens
+are recorded with `record`. Both act on the profile of the current run,
+which `profiling` sets up for the current thread. Outside a profiled run
+they do nothing: `span` returns a shared no-op context manager after one
+context variable lookup, so instrumented code pays almost nothing when
+profiling is off.
+"""
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import json
+import sys
+import threading
+import time
+
+_current = ContextVar('llmd_profile', default=None)
+_NO_SPAN = nullcontext()
+
+# Table and JSON output from concurrent runs (llmd in batch mode) isn't interleaved
+_output_lock = threading.Lock()
+
+
+class Profile:
+    """
+    The spans and metrics of one profiled run.
+
+    Attributes
+    ----------
+    label : str
+        What was profiled, usually the markdown file.
+    spans : dict
+        Seconds spent in each named stage, in the order they first
+        started. Repeated spans with the same name are added together.
+    metrics : dict
+        Other measurements, e.g. time_to_first_token, bytes_sent,
+        input_tokens and output_tokens.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.spans = dict()
+        self.metrics = dict()
+        self._start = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        self.spans.setdefault(name, 0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] += time.perf_counter() - start
+
+    def finish(self) -> None:
+        self.total = time.perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        """The profile as a JSON-serialisable dict, with times in seconds"""
+        return {
+            'label': self.label,
+            'total': self.total,
+            'spans': dict(self.spans),
+            **self.metrics,
+        }
+
+    def format_table(self) -> str:
+        """
+        The profile as a table for the terminal.
+
+        Examples
+        --------
+        >>> print(profile.format_table())
+        Profile: chat.md
+          config                   1.2 ms
+          parse                    3.4 ms
+          request               1840.5 ms
+          total                 1851.0 ms
+          time_to_first_token    612.3 ms
+          bytes_sent             10432
+        """
+        rows = list(self.spans.items())
+        if self.total is not None:
+            rows.append(('total', self.total))
+        lines = [f"Profile: {self.label}"]
+        lines += [f"  {name:<20} {seconds * 1000:9.1f} ms" for name, seconds in rows]
+        for name, value in self.metrics.items():
+            if name == 'time_to_first_token' and value is not None:
+                lines.append(f"  {name:<20} {value * 1000:9.1f} ms")
+            elif value is not None:
+                lines.append(f"  {name:<20} {value:>9}")
+        return '\n'.join(lines)
+
+
+def span(name: str):
+    """
+    Time a stage of the current profiled run.
+
+    Examples
+    --------
+    >>> with span('parse'):
+    ...     parsed = parse_conversation(content)
+    """
+    profile = _current.get()
+    if profile is None:
+        return _NO_SPAN
+    return profile.span(name)
+
+
+def record(**metrics) -> None:
+    """
+    Record metrics for the current profiled run, if there is one.
+
+    Numbers are added to any earlier value of the same metric, so that
+    e.g. bytes sent can be recorded in several places.
+
+    Examples
+    --------
+    >>> record(input_tokens=1200, output_tokens=310)
+    """
+    profile = _current.get()
+    if profile is None:
+        return
+    for name, value in metrics.items():
+        previous = profile.metrics.get(name)
+        if isinstance(previous, (int, float)) and isinstance(value, (int, float)):
+            value = previous + value
+        profile.metrics[name] = value
+
+
+def is_profiling() -> bool:
+    """Whether a profiled run is active, for metrics that cost something to measure"""
+    return _current.get() is not None
+
+
+def _write_json_line(profile: Profile, json_path: str) -> None:
+    line = json.dumps(profile.as_dict(), default=str)
+    if json_path == '-':
+        print(line)
+        return
+    with open(json_path, 'a') as f:
+        f.write(line + '\n')
+
+
+@contextmanager
+def profiling(label: str, table: bool = True, json_path: str | None = None) -> Iterator[Profile]:
+    """
+    Profile a run: time its spans and report them when it ends.
+
+    The profile is reported even if the run raises.
+
+    Parameters
+    ----------
+    label : str
+        What is being profiled, shown in the output.
+    table : bool
+        Whether to print a table of the timings to stderr.
+    json_path : str or None
+        A file to append the profile to as a line of JSON, or '-' for
+        stdout.
+
+    Yields
+    ------
+    Profile
+        The profile of the run.
+
+    Examples
+    --------
+    >>> with profiling('chat.md', json_path='profile.jsonl'):
+    ...     read_and_write_response('chat.md')
+    """
+    profile = Profile(label)
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+        profile.finish()
+        with _output_lock:
+            if table:
+                print(profile.format_table(), file=sys.stderr)
+            if json_path is not None:
+                _write_json_line(profile, json_path)
@@ -0,0 +1,119 @@
+"""Anthropic prompt caching for the system message and conversation history.
+
+Every request resends the system message and all earlier turns. Marking
+them with `cache_control` breakpoints lets the API reuse the processed
+prefix from the previous request in the conversation, which is cheaper
+and faster than processing it again.
+"""
+import copy
+
+_EPHEMERAL = {"type": "ephemeral"}
+
+
+def _text_blocks(content) -> list[dict]:
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [dict(block) for block in content]
+
+
+def add_cache_breakpoints(request_kwargs: dict) -> dict:
+    """
+    Add cache_control breakpoints to a messages API request.
+
+    Breakpoints go on the system message and on the last turn before the
+    new prompt, which is the end of the history that the next request in
+    the conversation will send again unchanged. Empty text can't be
+    cached, so empty system messages and turns are left alone.
+
+    Parameters
+    ----------
+    request_kwargs : dict
+        Keyword arguments for `client.messages.create`, with `system` as a
+        string and `messages` as a list of turns. They are not modified.
+
+    Returns
+    -------
+    dict
+        A copy of request_kwargs with the breakpoints added.
+
+    Examples
+    --------
+    >>> request = {'system': 'Be brief', 'messages': [
+    ...     {'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]},
+    ...     {'role': 'assistant', 'content': 'Hello'},
+    ...     {'role': 'user', 'content': [{'type': 'text', 'text': 'Bye'}]}]}
+    >>> cached = add_cache_breakpoints(request)
+    >>> cached['system']
+    [{'type': 'text', 'text': 'Be brief', 'cache_control': {'type': 'ephemeral'}}]
+    >>> cached['messages'][1]
+    {'role': 'assistant', 'content': [{'type': 'text', 'text': 'Hello', 'cache_control': {'type': 'ephemeral'}}]}
+    """
+    request_kwargs = dict(request_kwargs)
+
+    system = request_kwargs.get('system')
+    if isinstance(system, str) and system.strip():
+        request_kwargs['system'] = [{"type": "text", "text": system, "cache_control": dict(_EPHEMERAL)}]
+
+    messages = list(request_kwargs.get('messages', []))
+    if len(messages) >= 2:
+        last_stable = copy.copy(messages[-2])
+        blocks = _text_blocks(last_stable['content'])
+        if blocks and (blocks[-1].get('type') != 'text' or blocks[-1]['text'].strip()):
+            blocks[-1]['cache_control'] = dict(_EPHEMERAL)
+            last_stable['content'] = blocks
+            messages[-2] = last_stable
+    request_kwargs['messages'] = messages
+
+    return request_kwargs
+
+
+def format_cache_usage(usage) -> str | None:
+    """
+    Summarise the prompt cache token counts of an API response.
+
+    Parameters
+    ----------
+    usage : object or dict
+        The `usage` of an Anthropic message, or the token details of an
+        llm response.
+
+    Returns
+    -------
+    str or None
+        A line for the terminal, or None if the usage has no cache counts.
+
+    Examples
+    --------
+    >>> format_cache_usage({'input_tokens': 12, 'cache_read_input_tokens': 3000, 'cache_creation_input_tokens': 40})
+    'Prompt cache: 3000 tokens read, 40 written, 12 uncached'
+    """
+    def count(name):
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        return value or 0
+
+    read = count('cache_read_input_tokens')
+    written = count('cache_creation_input_tokens')
+    if not read and not written:
+        return None
+    return f"Prompt cache: {read} tokens read, {written} written, {count('input_tokens')} uncached"
+
+
+def llm_cache_options(model, config: dict) -> dict:
+    """
+    Model options that turn on prompt caching for an llm model, if it has them.
+
+    Models from the llm-anthropic plugin have a `cache` option. Other
+    models, and models where `cache` is already set in the config, get no
+    extra options.
+
+    Examples
+    --------
+    >>> llm_cache_options(llm.get_model('claude-3.5-sonnet'), {'prompt_cache': True, 'model_options': {}})
+    {'cache': True}
+    """
+    if not config.get('prompt_cache') or 'cache' in config['model_options']:
+        return dict()
+    fields = getattr(model.Options, 'model_fields', None)
+    if fields is None:
+        fields = getattr(model.Options, '__fields__', dict())
+    return {'cache': True} if 'cache' in fields else dict()
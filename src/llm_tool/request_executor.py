@@ -0,0 +1,448 @@
+"""Deadlines, retries and hedging for requests to models.
+
+Every answer llmd asks for goes through `stream_with_policy` (streamed
+answers) or `call_with_policy` (whole answers), with the settings of
+`request_policy`:
+
+    request_policy:
+      max_attempts: 3       # retries of overloaded, rate limited or failed requests
+      backoff: 0.5          # seconds, doubled on each retry, with full jitter
+      max_backoff: 30
+      deadline: 600         # seconds to the first text (the whole answer, unstreamed)
+      stall_timeout: 120    # seconds without a chunk once text is streaming
+      hedge: false
+      hedge_percentile: 95
+      hedge_min_samples: 20
+
+Each request is read in its own thread, so that a request that stalls
+can be given up on. A request that fails with a retryable error (see
+`is_retryable`) before it gives any text is retried after a jittered,
+exponentially growing delay, or the delay the API asked for. Once text
+has been written to the file a failure is raised, as retrying would
+write the answer twice.
+
+With `hedge: true`, a request that has given no text after the
+`hedge_percentile` of the model's recent latencies is sent again, and
+whichever copy answers first is used. The other is cancelled: a stream
+is closed when its next chunk arrives and a whole answer is left to
+finish in the background. Hedging is off by default, as a hedged
+request may be paid for twice, and with `persist_conversation`, as
+both copies would be logged. Latencies are kept for each model, for
+streamed and whole answers separately, in the user cache dir
+(`LatencyHistory`), so the thresholds follow the model's latency.
+"""
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from os import PathLike
+from pathlib import Path
+import contextvars
+import json
+import math
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from llm_tool.profiling import record
+
+# Request timeouts, conflicts, rate limits, server errors and an overloaded API
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+
+_DEFAULT_POLICY = {
+    'max_attempts': 3,
+    'backoff': 0.5,
+    'max_backoff': 30,
+    'deadline': 600,
+    'stall_timeout': 120,
+    'hedge': False,
+    'hedge_percentile': 95,
+    'hedge_min_samples': 20,
+}
+
+_histories: dict[Path, 'LatencyHistory'] = dict()
+_histories_lock = threading.Lock()
+
+
+def request_policy(config: dict) -> dict:
+    """The request_policy settings of a config, with defaults for those not set"""
+    return {**_DEFAULT_POLICY, **(config.get('request_policy') or dict())}
+
+
+def _causes(error: BaseException) -> Iterator[BaseException]:
+    # llm wraps the errors of some plugins in llm.ModelError
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a request that failed with this error is worth sending again.
+
+    Errors with a status code in RETRYABLE_STATUS_CODES, timeouts and
+    connection errors are retryable, as is an error caused by one.
+
+    Examples
+    --------
+    >>> is_retryable(TimeoutError())
+    True
+    >>> is_retryable(ValueError('Bad request'))
+    False
+    """
+    for cause in _causes(error):
+        if getattr(cause, 'status_code', None) in RETRYABLE_STATUS_CODES:
+            return True
+        if isinstance(cause, (TimeoutError, ConnectionError)):
+            return True
+        # anthropic's, named rather than imported
+        if type(cause).__name__ in ('APIConnectionError', 'APITimeoutError'):
+            return True
+    return False
+
+
+def retry_after(error: BaseException) -> float | None:
+    """The seconds to wait that an API error's retry-after header asks for, if any"""
+    for cause in _causes(error):
+        headers = getattr(getattr(cause, 'response', None), 'headers', None)
+        if not headers:
+            continue
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            # llm.ModelError keeps the API's error among its causes
+            continue
+    return None
+
+
+def backoff_delay(retry: int, backoff: float, max_backoff: float, rng: random.Random | None = None) -> float:
+    """
+    A random delay before a retry, of up to backoff * 2 ** (retry - 1).
+
+    The delay is drawn from zero up to the exponential bound ("full
+    jitter") so that requests that failed together, such as those of a
+    batch, are spread out when they are retried.
+
+    Examples
+    --------
+    >>> 0 <= backoff_delay(3, 0.5, 30, random.Random(0)) <= 2
+    True
+    >>> backoff_delay(20, 0.5, 30, random.Random(0)) <= 30
+    True
+    """
+    return (rng or random).uniform(0, min(max_backoff, backoff * 2 ** (retry - 1)))
+
+
+class LatencyHistory:
+    """
+    The recent latencies of each model, kept in a JSON file between runs.
+
+    Safe to use from several threads. Latencies are kept separately for
+    each kind of request: 'first_token' for streamed answers and
+    'response' for whole answers.
+
+    Parameters
+    ----------
+    path : str, PathLike or None
+        The file, or None to keep the history in memory only.
+    max_samples : int
+        The number of latencies kept for each model and kind.
+    """
+
+    def __init__(self, path: str | PathLike[str] | None = None, max_samples: int = 200):
+        self.path = Path(path) if path is not None else None
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {
+            (model_name, kind): deque(values[-max_samples:], maxlen=max_samples)
+            for model_name, kinds in self._load().items()
+            for kind, values in kinds.items()
+        }
+
+    def _load(self) -> dict:
+        if self.path is None:
+            return dict()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return history if isinstance(history, dict) else dict()
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        history = dict()
+        for (model_name, kind), values in self._samples.items():
+            history.setdefault(model_name, dict())[kind] = list(values)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(history, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            print(f"Couldn't save the latency history: {e}")
+
+    def add(self, model_name: str, kind: str, seconds: float) -> None:
+        """Record a latency and save the history"""
+        with self._lock:
+            key = (model_name, kind)
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self.max_samples)
+            self._samples[key].append(round(seconds, 3))
+            self._save()
+
+    def samples(self, model_name: str, kind: str) -> list[float]:
+        """The recorded latencies, oldest first"""
+        with self._lock:
+            return list(self._samples.get((model_name, kind), ()))
+
+    def percentile(self, model_name: str, kind: str, percent: float, min_samples: int = 1) -> float | None:
+        """
+        A percentile of the recorded latencies, by the nearest-rank method.
+
+        Returns
+        -------
+        float or None
+            None if fewer than min_samples latencies are recorded.
+
+        Examples
+        --------
+        >>> history = LatencyHistory()
+        >>> for seconds in range(1, 11):
+        ...     history.add('m', 'first_token', seconds)
+        >>> history.percentile('m', 'first_token', 90)
+        9
+        >>> history.percentile('m', 'first_token', 90, min_samples=20) is None
+        True
+        """
+        samples = sorted(self.samples(model_name, kind))
+        if not samples or len(samples) < min_samples:
+            return None
+        rank = min(len(samples), max(1, math.ceil(percent / 100 * len(samples))))
+        return samples[rank - 1]
+
+
+def latency_history() -> LatencyHistory:
+    """The latency history in the user cache dir, shared by the threads of this process"""
+    from llm_tool.config_and_system import get_user_cache_dir
+
+    path = get_user_cache_dir('latency') / 'latency.json'
+    with _histories_lock:
+        if path not in _histories:
+            _histories[path] = LatencyHistory(path)
+        return _histories[path]
+
+
+class _Attempt:
+    """One request, read in its own thread so that it can be given up on"""
+
+    def __init__(self, start: Callable[[], Iterable[str]], events: queue.Queue, hedge: bool = False):
+        self.hedge = hedge
+        self.headers = 0
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self._start = start
+        self._events = events
+        # Spans and metrics recorded by the request go to this run's profile
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run,), daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            chunks = self._start()
+            try:
+                for chunk in chunks:
+                    if self.cancelled.is_set():
+                        return
+                    self._events.put((self, 'chunk', chunk))
+            finally:
+                # Closes the stream, and its connection, in the thread reading it
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            self._events.put((self, 'error', e))
+            return
+        self._events.put((self, 'done', None))
+
+
+def run_request(
+    start: Callable[[], Iterable[str]],
+    config: dict,
+    kind: str = 'first_token',
+    header_chunks: int = 0,
+    history: LatencyHistory | None = None,
+    ) -> Iterator[str]:
+    """
+    Yield the chunks of a request, retrying and hedging it by the config's request_policy.
+
+    Parameters
+    ----------
+    start : callable
+        Sends the request, returning its chunks. Called for each attempt.
+    config : dict
+        The config, for its model_name, persist_conversation and
+        request_policy.
+    kind : str
+        The kind of latency to record and hedge on: 'first_token' or
+        'response'.
+    header_chunks : int
+        The number of chunks each attempt yields before sending its
+        request, such as the assistant header. They are yielded once,
+        as soon as the first attempt gives them.
+    history : LatencyHistory or None
+        The latency history, by default the one in the user cache dir.
+
+    Yields
+    ------
+    str
+        The header chunks, then the chunks of the first attempt to give
+        any text.
+
+    Raises
+    ------
+    TimeoutError
+        If no text arrives within the deadline, or a stream stalls for
+        longer than the stall_timeout.
+    Exception
+        The error of the last attempt, if it isn't retryable or the
+        attempts or time ran out.
+    """
+    policy = request_policy(config)
+    model_name = config.get('model_name')
+    if history is None:
+        history = latency_history()
+    hedge_after = None
+    if policy['hedge'] and not config.get('persist_conversation'):
+        hedge_after = history.percentile(model_name, kind, policy['hedge_percentile'], policy['hedge_min_samples'])
+
+    events = queue.Queue()
+    active = []
+    retries = 0
+    headers_sent = 0
+    deadline_at = time.monotonic() + policy['deadline'] if policy['deadline'] else None
+    retry_at = None
+    hedge_at = None
+
+    def launch(hedge: bool = False) -> None:
+        nonlocal hedge_at
+        attempt = _Attempt(start, events, hedge)
+        active.append(attempt)
+        hedge_at = None if hedge or hedge_after is None else attempt.started + hedge_after
+
+    try:
+        launch()
+        while True:
+            wake_at = min((t for t in (deadline_at, retry_at, hedge_at) if t is not None), default=None)
+            try:
+                attempt, event, value = events.get(
+                    timeout=None if wake_at is None else max(0, wake_at - time.monotonic()),
+                    )
+            except queue.Empty:
+                now = time.monotonic()
+                if deadline_at is not None and now >= deadline_at:
+                    raise TimeoutError(f"No response from {model_name} within {policy['deadline']}s")
+                if retry_at is not None and now >= retry_at:
+                    retry_at = None
+                    launch()
+                elif hedge_at is not None and now >= hedge_at:
+                    print(f"No response from {model_name} after {hedge_after:.1f}s: sending the request again")
+                    record(hedged_requests=1)
+                    launch(hedge=True)
+                continue
+
+            if attempt not in active:
+                continue
+            if event == 'chunk' and attempt.headers < header_chunks:
+                attempt.headers += 1
+                if headers_sent < attempt.headers:
+                    headers_sent += 1
+                    yield value
+                continue
+
+            if event == 'error':
+                active.remove(attempt)
+                if active:
+                    # The other copy of a hedged request may still answer
+                    continue
+                hedge_at = None
+                if not is_retryable(value) or retries + 1 >= policy['max_attempts']:
+                    raise value
+                retries += 1
+                delay = min(
+                    max(backoff_delay(retries, policy['backoff'], policy['max_backoff']), retry_after(value) or 0),
+                    policy['max_backoff'],
+                    )
+                if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                    raise value
+                print(f"{model_name} failed ({type(value).__name__}: {value}): retrying in {delay:.1f}s")
+                record(request_retries=1)
+                retry_at = time.monotonic() + delay
+                continue
+
+            # The first text, or the end of a request that gave none
+            winner = attempt
+            for other in active:
+                if other is not winner:
+                    other.cancelled.set()
+            if event == 'done':
+                return
+            history.add(model_name, kind, time.monotonic() - winner.started)
+            if winner.hedge:
+                record(hedge_wins=1)
+            yield value
+            break
+
+        stall_timeout = policy['stall_timeout']
+        while True:
+            try:
+                attempt, event, value = events.get(timeout=stall_timeout or None)
+            except queue.Empty:
+                raise TimeoutError(f"{model_name} sent nothing for {stall_timeout}s") from None
+            if attempt is not winner:
+                continue
+            if event == 'error':
+                raise value
+            if event == 'done':
+                return
+            yield value
+    finally:
+        for attempt in active:
+            attempt.cancelled.set()
+
+
+def stream_with_policy(
+    start: Callable[[], Iterable[str]],
+    config: dict,
+    history: LatencyHistory | None = None,
+    ) -> Iterator[str]:
+    """
+    Stream an answer by the config's request_policy (see `run_request`).
+
+    start returns a backend's stream, such as `llm_conversation_stream`,
+    whose first chunk is the assistant header.
+    """
+    return run_request(start, config, kind='first_token', header_chunks=1, history=history)
+
+
+def call_with_policy(
+    call: Callable[[], str],
+    config: dict,
+    history: LatencyHistory | None = None,
+    ) -> str:
+    """
+    Ask for a whole answer by the config's request_policy (see `run_request`).
+
+    Examples
+    --------
+    >>> call_with_policy(lambda: 'Hello', {'model_name': 'm'}, LatencyHistory())
+    'Hello'
+    """
+    return ''.join(run_request(lambda: [call()], config, kind='response', history=history))
@@ -0,0 +1,177 @@
+from collections.abc import Iterable, Iterator
+from os import PathLike
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def _file_sha256(filepath: str | PathLike[str]) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hashable_content(content):
+    """Replace image paths or base64 image data with a hash of the image bytes
+
+    Uploaded images keep their file id, which stands for their content.
+    Links left to be uploaded as documents are replaced by a hash of the
+    linked file.
+    """
+    if not isinstance(content, list):
+        return content
+    hashable = []
+    for chunk in content:
+        if chunk.get('type') == 'link':
+            chunk = {'type': 'link', 'sha256': _file_sha256(chunk['link'])}
+        elif chunk.get('type') == 'image' and isinstance(chunk.get('source'), str):
+            chunk = {'type': 'image', 'sha256': _file_sha256(chunk['source'])}
+        elif chunk.get('type') == 'image' and isinstance(chunk.get('source'), dict) and chunk['source'].get('type') != 'file':
+            data = chunk['source'].get('data', '').encode('ascii')
+            chunk = {'type': 'image', 'sha256': hashlib.sha256(data).hexdigest()}
+        hashable.append(chunk)
+    return hashable
+
+
+def make_cache_key(parsed_file_contents: dict, config: dict) -> str:
+    """
+    Hash everything that determines a model's response to a conversation.
+
+    The key covers the model name, the rendered system message, the model
+    options and the hydrated conversation. Linked files should already be
+    inlined; images are keyed on the contents of the image file (or on the
+    encoded image, once it has been hydrated), so editing an image
+    invalidates the cached response.
+
+    Parameters
+    ----------
+    parsed_file_contents : dict
+        The output of `parse_conversation`, after links have been replaced.
+    config : dict
+        The output of `get_config`.
+
+    Returns
+    -------
+    str
+        A hex sha256 digest.
+
+    Examples
+    --------
+    >>> parsed = {'conversation': [{'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]}]}
+    >>> config = {'model_name': 'gpt-4o', 'system_msg': '', 'model_options': {}}
+    >>> len(make_cache_key(parsed, config))
+    64
+    """
+    payload = {
+        'model_name': config['model_name'],
+        'system_msg': config['system_msg'],
+        'model_options': config['model_options'],
+        'conversation': [
+            {'role': turn['role'], 'content': _hashable_content(turn['content'])}
+            for turn in parsed_file_contents['conversation']
+        ],
+    }
+    serialised = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    A content-addressed store of formatted model responses on disk.
+
+    Each response is a file named after its cache key. Reading an entry
+    touches its mtime, so evicting the oldest mtimes first gives LRU order.
+    Entries older than `max_age_days` are dropped, and the least recently
+    used entries are dropped while the cache is bigger than `max_bytes`.
+
+    Parameters
+    ----------
+    cache_dir : str or PathLike
+        The directory holding the cache entries.
+    max_bytes : int
+        The maximum total size of the cache.
+    max_age_days : float
+        The maximum age of an entry since it was last used.
+    """
+
+    suffix = '.md'
+
+    def __init__(self, cache_dir: str | PathLike[str], max_bytes: int = 100 * 1024 * 1024, max_age_days: float = 30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / (key + self.suffix)
+
+    def get(self, key: str) -> str | None:
+        """Return the cached response for a key, or None on a miss"""
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if time.time() - stat.st_mtime > self.max_age_seconds:
+            path.unlink(missing_ok=True)
+            return None
+        response = path.read_text(encoding='utf-8')
+        os.utime(path)
+        return response
+
+    def put(self, key: str, response: str) -> None:
+        """Store a response atomically, then evict old entries"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(response)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def _entry_paths(self) -> Iterable[Path]:
+        return self.cache_dir.glob('*' + self.suffix)
+
+    def evict(self) -> None:
+        """Drop expired entries, then least recently used ones until under max_bytes"""
+        now = time.time()
+        entries = []
+        for path in self._entry_paths():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.max_age_seconds:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+
+
+def make_response_cache(config: dict) -> ResponseCache:
+    """Create the response cache in the user config dir from config settings"""
+    from llm_tool.config_and_system import get_user_cache_dir
+
+    return ResponseCache(
+        get_user_cache_dir('responses'),
+        max_bytes=int(config['cache_max_mb'] * 1024 * 1024),
+        max_age_days=config['cache_max_age_days'],
+    )
+
+
+def store_streamed_response(chunks: Iterable[str], cache: ResponseCache, key: str) -> Iterator[str]:
+    """Pass chunks through, storing the full response once the stream completes"""
+    collected = []
+    for chunk in chunks:
+        collected.append(chunk)
+        yield chunk
+    if collected:
+        cache.put(key, ''.join(collected))
@@ -0,0 +1,361 @@
+"""Writing answers into markdown files that may change while the model thinks.
+
+A run holds an advisory lock on the file (`file_lock`) from reading the
+prompt to writing the answer, so two llmd processes never answer the same
+file at once. The second waits, then finds nothing new to answer.
+
+Editors and sync tools don't take the lock, so the file is also
+snapshotted when it is read (`read_with_snapshot`). A snapshot is a few
+hashes, whatever the size of the file. When the answer is ready,
+`write_answer` compares the file with the snapshot:
+
+* unchanged: the answer is appended, in one write;
+* a new `# %User` prompt (or only whitespace) added at the end: the
+  answer is re-anchored after the prompt it answers, and the file is
+  replaced atomically;
+* anything else: the answer is written to a side file next to it,
+  `<name>.llmd-conflict-<time>.md`, holding the conversation as it was
+  read and the answer, so nothing is lost or interleaved.
+
+The `on_conflict` setting picks 'reanchor' (the default), 'side_file'
+(never re-anchor) or 'append' (append whatever happened, as llmd did
+before).
+"""
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from os import PathLike
+from pathlib import Path
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from llm_tool.mapped_reader import map_file, sha256_of
+from llm_tool.profiling import span
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+ON_CONFLICT = ('reanchor', 'side_file', 'append')
+
+_NEW_PROMPT = re.compile(rb'\s*# %User\s*(<!--llm.*?llm-->\s*)*\n', re.DOTALL)
+
+
+def lock_path(markdown_filepath: str | PathLike[str]) -> Path:
+    """The lock file kept next to a markdown file
+
+    >>> lock_path('/notes/chat.md')
+    PosixPath('/notes/.chat.md.llmd-lock')
+    """
+    path = Path(markdown_filepath)
+    return path.with_name(f".{path.name}.llmd-lock")
+
+
+@contextmanager
+def file_lock(markdown_filepath: str | PathLike[str]) -> Iterator[None]:
+    """
+    Hold an advisory lock on a markdown file.
+
+    The lock is taken on a hidden lock file next to it, which stays put
+    when editors replace the markdown file on save. Where locks aren't
+    available (Windows) this does nothing.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    try:
+        lock_file = open(lock_path(markdown_filepath), 'a')
+    except OSError as e:
+        print(f"Couldn't lock {markdown_filepath}: {e}")
+        yield
+        return
+
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for another llmd to finish with {markdown_filepath}")
+            with span('wait_for_lock'):
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def normalise_newlines(text: str) -> str:
+    """Newlines as text mode reads them"""
+    if '\r' in text:
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+class FileSnapshot:
+    """
+    What a markdown file held when it was read, kept up to date with llmd's own writes.
+
+    Only hashes of the file are kept, so that a snapshot of a very large
+    file is small.
+
+    Attributes
+    ----------
+    end : int
+        Where answers go, in bytes: the end of the conversation that was
+        read, and of the answers written since.
+    size, mtime_ns : int
+        From the file's stat, for a cheap check that it is unchanged.
+    sha256 : str
+        The hash of the whole file, for when the stat changed but the
+        content didn't.
+    original : str or None
+        The file up to `end`, to write to a side file with the answer,
+        if it was kept.
+    side_file : Path or None
+        Where answers go once a conflict has been found.
+    """
+
+    def __init__(self, data: bytes, stat: os.stat_result, original: str | None = None):
+        self.side_file = None
+        self.original = original
+        self.update(sha256_of(data), len(data), stat)
+
+    def update(self, prefix, end: int, stat: os.stat_result, rest: bytes = b'') -> None:
+        """Record that the file is the conversation hashed by prefix, up to end, followed by rest"""
+        self._prefix = prefix
+        self.end = end
+        whole = prefix.copy()
+        whole.update(rest)
+        self.sha256 = whole.hexdigest()
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+
+    def prefix_matches(self, data: bytes) -> bool:
+        """Whether data starts with the conversation up to end"""
+        return len(data) >= self.end and sha256_of(data, self.end).hexdigest() == self._prefix.hexdigest()
+
+    def unchanged(self, path: str | PathLike[str]) -> bool:
+        """Whether the file is still the conversation up to end, and nothing else"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != self.size or self.end != self.size:
+            return False
+        if stat.st_mtime_ns == self.mtime_ns:
+            return True
+        with map_file(path) as data:
+            same = sha256_of(data).hexdigest() == self.sha256
+        if same:
+            self.mtime_ns = stat.st_mtime_ns
+        return same
+
+    def appended(self, answer: str, stat: os.stat_result) -> None:
+        """Record that llmd appended an answer to the unchanged file"""
+        encoded = answer.encode('utf-8')
+        self._prefix.update(encoded)
+        self.update(self._prefix, self.end + len(encoded), stat)
+        if self.original is not None:
+            self.original += answer
+
+    def header_replaced(self, old_header: str, new_header: str, body: bytes, stat: os.stat_result) -> None:
+        """Record that llmd replaced the yaml header of the unchanged file"""
+        prefix = hashlib.sha256(new_header.encode('utf-8'))
+        prefix.update(body)
+        self.update(prefix, stat.st_size, stat)
+        if self.original is not None:
+            self.original = new_header + self.original[len(normalise_newlines(old_header)):]
+
+
+def read_with_snapshot(path: str | PathLike[str]) -> tuple[str, FileSnapshot]:
+    """Read a markdown file, and snapshot it to check for changes before writing"""
+    with open(path, 'rb') as file:
+        data = file.read()
+        stat = os.fstat(file.fileno())
+    content = normalise_newlines(data.decode('utf-8'))
+    return content, FileSnapshot(data, stat, original=content)
+
+
+def replace_file(path: str | PathLike[str], pieces: list[bytes]) -> None:
+    """Replace a file atomically with the pieces given, keeping its permissions"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for piece in pieces:
+                file.write(piece)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def side_file_path(path: str | PathLike[str]) -> Path:
+    """A new side file next to a markdown file, for an answer that can't go in it"""
+    path = Path(path)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    side_file = path.with_name(f"{path.stem}.llmd-conflict-{stamp}{path.suffix}")
+    n = 1
+    while side_file.exists():
+        n += 1
+        side_file = path.with_name(f"{path.stem}.llmd-conflict-{stamp}-{n}{path.suffix}")
+    return side_file
+
+
+def write_side_file(path: str | PathLike[str], snapshot: FileSnapshot, answer: str) -> Path:
+    """Write the conversation as it was read and the answer to a side file
+
+    Snapshots of memory-mapped files don't keep the conversation, so
+    their side files only hold the answer. Later answers in the same run
+    are appended to the side file.
+    """
+    snapshot.side_file = side_file_path(path)
+    with open(snapshot.side_file, 'x', encoding='utf-8', newline='') as file:
+        file.write((snapshot.original or '') + answer)
+    print(f"{path} changed while waiting for the answer: it was written to {snapshot.side_file}")
+    return snapshot.side_file
+
+
+def _append(path: str | PathLike[str], text: str) -> os.stat_result:
+    with open(path, 'ab') as file:
+        file.write(text.encode('utf-8'))
+        file.flush()
+        return os.fstat(file.fileno())
+
+
+def _reanchor(path: str | PathLike[str], data: bytes, snapshot: FileSnapshot, answer: str) -> bool:
+    """Put the answer after its prompt if only whitespace or a new prompt was added
+
+    Returns:
+        bool: Whether the answer was written.
+    """
+    if not snapshot.prefix_matches(data):
+        return False
+    added = bytes(data[snapshot.end:])
+    encoded = answer.encode('utf-8')
+
+    if not added.strip():
+        prefix = sha256_of(data)
+        prefix.update(encoded)
+        end = len(data) + len(encoded)
+        snapshot.update(prefix, end, _append(path, answer))
+        if snapshot.original is not None:
+            snapshot.original += normalise_newlines(added.decode('utf-8')) + answer
+        return True
+
+    if not _NEW_PROMPT.match(added):
+        return False
+    rest = b'\n\n' + added.lstrip(b'\n')
+    with memoryview(data) as view:
+        replace_file(path, [view[:snapshot.end], encoded, rest])
+    snapshot._prefix.update(encoded)
+    snapshot.update(snapshot._prefix, snapshot.end + len(encoded), os.stat(path), rest)
+    if snapshot.original is not None:
+        snapshot.original += answer
+    print(f"{path} changed while waiting for the answer: it was put after its prompt")
+    return True
+
+
+def write_answer(
+    path: str | PathLike[str],
+    answer: str,
+    snapshot: FileSnapshot | None = None,
+    on_conflict: str = 'reanchor',
+    ) -> Path:
+    """
+    Write an answer into a markdown file, unless it changed in a way that conflicts.
+
+    Parameters
+    ----------
+    path : str or PathLike
+        The markdown file.
+    answer : str
+        The text to add after the conversation, starting with its
+        `# %Assistant` header.
+    snapshot : FileSnapshot or None
+        The file as it was read. Without one, the answer is appended.
+        It is updated with the answer written.
+    on_conflict : str
+        'reanchor', 'side_file' or 'append' (see the module docstring).
+
+    Returns
+    -------
+    Path
+        The file the answer was written to.
+
+    Raises
+    ------
+    ValueError
+        If on_conflict isn't one of ON_CONFLICT.
+    """
+    if on_conflict not in ON_CONFLICT:
+        raise ValueError(f"on_conflict must be one of {ON_CONFLICT}, not {on_conflict!r}")
+
+    with span('write_file'):
+        if snapshot is None or on_conflict == 'append':
+            _append(path, answer)
+            return Path(path)
+
+        if snapshot.side_file is not None:
+            _append(snapshot.side_file, answer)
+            return snapshot.side_file
+
+        if snapshot.unchanged(path):
+            snapshot.appended(answer, _append(path, answer))
+            return Path(path)
+
+        if on_conflict == 'reanchor' and os.path.exists(path):
+            with map_file(path) as data:
+                if _reanchor(path, data, snapshot, answer):
+                    return Path(path)
+
+        return write_side_file(path, snapshot, answer)
+
+
+def finish_streamed_answer(path: str | PathLike[str], answer: str, snapshot: FileSnapshot, stat: os.stat_result) -> Path:
+    """
+    Check that a file wasn't edited while an answer was streamed into it.
+
+    If it was, the answer may have been overwritten or split by the
+    edit, so the whole answer is also written to a side file.
+
+    Parameters
+    ----------
+    path : str or PathLike
+        The markdown file.
+    answer : str
+        Everything that was streamed into the file.
+    snapshot : FileSnapshot
+        The file before the answer was streamed, which is updated.
+    stat : os.stat_result
+        The file's stat after the last chunk was written.
+
+    Returns
+    -------
+    Path
+        The file that holds the whole answer.
+    """
+    encoded = answer.encode('utf-8')
+    expected_size = snapshot.size + len(encoded)
+    try:
+        now = os.stat(path)
+    except FileNotFoundError:
+        now = None
+
+    if now is not None and now.st_size == expected_size:
+        untouched = stat.st_size == expected_size and (now.st_ino, now.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+        if not untouched:
+            expected = snapshot._prefix.copy()
+            expected.update(encoded)
+            with span('write_file'), map_file(path) as data:
+                untouched = sha256_of(data).hexdigest() == expected.hexdigest()
+        if untouched:
+            snapshot.appended(answer, now)
+            return Path(path)
+
+    with span('write_file'):
+        return write_side_file(path, snapshot, answer)
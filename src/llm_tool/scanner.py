@@ -0,0 +1,261 @@
+"""A single-pass scanner for the structure of a markdown conversation.
+
+The scanner walks the text once, from one token of interest to the next:
+role headers, `<!--llm ... llm-->` comments, fenced code block markers and
+the pieces of links and images. Plain text between tokens is skipped by
+the regex engine, and every position is visited once, so scanning is
+linear in the size of the text.
+
+Inside a fenced code block nothing is structure: `# %User`, links and
+comment markers are all kept as text.
+"""
+import re
+
+_STRUCTURE_TOKENS = (
+    r'^[ ]{0,3}(?P<fence>`{3,}|~{3,})'
+    r'|(?P<comment><!--llm)'
+    r'|(?P<header># %(?P<role>User|Assistant)(?P<newline>\r?\n)?)'
+)
+
+# Which tokens matter depends on the state of the scan, so there is one
+# pattern per state. Tokens that can't change anything (a ')' when no link
+# is open, say) are then skipped by the regex engine instead of the loop.
+_PATTERNS = {
+    # Assistant turns, text before the first header and fenced code
+    'structure': re.compile(_STRUCTURE_TOKENS, re.MULTILINE),
+    # A user turn, outside a link
+    'user': re.compile(_STRUCTURE_TOKENS + r'|(?P<image>!\[)|(?P<bracket>\[)', re.MULTILINE),
+    # After the opening '[' or '![' of a link
+    'link_text': re.compile(_STRUCTURE_TOKENS + r'|(?P<middle>\]\()', re.MULTILINE),
+    # After the '](' of a link
+    'link_path': re.compile(_STRUCTURE_TOKENS + r'|(?P<paren>\))', re.MULTILINE),
+}
+
+# For scan_boundaries on bytes, such as a memory-mapped file
+_STRUCTURE_BYTES = re.compile(_STRUCTURE_TOKENS.encode('ascii'), re.MULTILINE)
+
+_COMMENT_CLOSE = 'llm-->'
+
+_COMMENT = re.compile(r'<!--llm(.*?)llm-->', re.DOTALL)
+
+
+def _skip_comments_to_newline(text: str, position: int) -> int:
+    """Skip comments directly after a header, and the newline after them if there is one.
+
+    With the comments removed, `# %User<!--llm note llm-->` followed by a
+    newline is a header, so the position after the newline is returned.
+    Otherwise `position` is returned unchanged.
+    """
+    end = position
+    while text.startswith('<!--llm', end):
+        close = text.find(_COMMENT_CLOSE, end + len('<!--llm'))
+        if close == -1:
+            break
+        end = close + len(_COMMENT_CLOSE)
+    if end > position and text.startswith('\n', end):
+        return end + 1
+    return position
+
+
+def scan_conversation(text: str, role: str | None = None) -> dict:
+    """Find the turns of a conversation, with comments removed.
+
+    Role headers (`# %User` or `# %Assistant` followed by a newline) start
+    a turn. A header without a newline ends the current turn without
+    starting a new one. Text before the first header is not part of any
+    turn. Links and images are only recognised in user turns.
+
+    Args:
+        text (str): The body of the markdown file.
+        role (str | None): The role of a turn that starts at the beginning
+           of `text`, or None if text before the first header should be
+           dropped.
+
+    Returns:
+        dict: With keys
+            - 'turns': a list of dicts with 'role' ('user' or 'assistant'),
+              'start' (offset of the turn's header in `text`), 'text' (the
+              turn's text with comments removed) and, for user turns,
+              'spans': (kind, start, path_start, path_end, end) tuples for
+              each link or image, as offsets into the turn's text, and
+              'comments': the stripped text of each comment removed from the
+              turn, including comments directly after its header.
+            - 'boundaries': the offset of every role header in `text`,
+              including headers that only end a turn.
+            - 'has_stray_comment': whether there is a `<!--llm` with no
+              closing `llm-->`. Such an opener is kept as text.
+
+    Examples:
+        >>> scan_conversation("# %User\\nSee [a](b.txt)\\n# %Assistant\\nOk")['turns']
+        [{'role': 'user', 'start': 0, 'text': 'See [a](b.txt)\\n', 'spans': [('link', 4, 8, 13, 14)], 'comments': []},
+         {'role': 'assistant', 'start': 23, 'text': 'Ok', 'spans': [], 'comments': []}]
+    """
+    turns = []
+    boundaries = []
+    has_stray_comment = False
+    comment_closes_exhausted = False
+
+    turn_start = 0
+    pieces = []
+    pruned_length = 0
+    copy_from = 0
+    spans = []
+    comments = []
+    link_kind = link_start = link_middle = None
+    fence = None
+
+    def pruned_offset(position):
+        return pruned_length + position - copy_from
+
+    def finish_turn(end):
+        nonlocal pieces, pruned_length, spans, comments, link_kind
+        if role is not None:
+            pieces.append(text[copy_from:end])
+            turns.append({
+                'role': role,
+                'start': turn_start,
+                'text': ''.join(pieces),
+                'spans': spans,
+                'comments': comments,
+            })
+        pieces = []
+        pruned_length = 0
+        spans = []
+        comments = []
+        link_kind = None
+
+    position = 0
+    while True:
+        if fence is not None or role != 'user':
+            pattern = _PATTERNS['structure']
+        elif link_kind is None:
+            pattern = _PATTERNS['user']
+        elif link_middle is None:
+            pattern = _PATTERNS['link_text']
+        else:
+            pattern = _PATTERNS['link_path']
+        match = pattern.search(text, position)
+        if match is None:
+            break
+        kind = match.lastgroup
+        position = match.end()
+
+        if kind == 'fence':
+            marker = match.group('fence')
+            if fence is None:
+                fence = marker
+                link_kind = None
+            elif marker[0] == fence[0] and len(marker) >= len(fence):
+                fence = None
+            continue
+
+        if fence is not None:
+            continue
+
+        if kind == 'comment':
+            close = -1 if comment_closes_exhausted else text.find(_COMMENT_CLOSE, position)
+            if close == -1:
+                comment_closes_exhausted = True
+                has_stray_comment = True
+                continue
+            if role is not None:
+                pieces.append(text[copy_from:match.start()])
+                pruned_length += match.start() - copy_from
+                comments.append(text[position:close].strip())
+            position = copy_from = close + len(_COMMENT_CLOSE)
+
+        elif kind == 'header':
+            boundaries.append(match.start())
+            finish_turn(match.start())
+            if not match.group('newline'):
+                position = _skip_comments_to_newline(text, position)
+            if text[position - 1:position] == '\n':
+                role = match.group('role').lower()
+                turn_start = match.start()
+                comments = [
+                    comment.group(1).strip()
+                    for comment in _COMMENT.finditer(text, match.end(), position)
+                ]
+            else:
+                role = None
+            copy_from = position
+
+        elif kind in ('image', 'bracket'):
+            link_kind = 'image' if kind == 'image' else 'link'
+            link_start = pruned_offset(match.start())
+            link_middle = None
+
+        elif kind == 'middle':
+            link_middle = pruned_offset(position)
+
+        elif kind == 'paren':
+            spans.append((
+                link_kind, link_start, link_middle,
+                pruned_offset(match.start()), pruned_offset(position),
+            ))
+            link_kind = None
+
+    finish_turn(len(text))
+
+    return {
+        'turns': turns,
+        'boundaries': boundaries,
+        'has_stray_comment': has_stray_comment,
+    }
+
+
+def scan_boundaries(text: str | bytes, start: int = 0) -> tuple[list[int], bool]:
+    """Find the role headers of a conversation without building its turns.
+
+    Gives the same offsets as the 'boundaries' of `scan_conversation`,
+    but only follows fences and comments, so nothing is copied. Works on
+    str, and on bytes-like objects such as a memory-mapped file, whose
+    offsets are in bytes.
+
+    Args:
+        text (str | bytes): The body of the markdown file.
+        start (int): Where to start scanning. Must be the start of a line.
+
+    Returns:
+        tuple: (boundaries, has_stray_comment), as in `scan_conversation`.
+
+    Examples:
+        >>> scan_boundaries(b"# %User\nHi\n```\n# %User\n```\n# %Assistant\nOk")
+        ([0, 27], False)
+    """
+    if isinstance(text, str):
+        pattern, close_marker = _PATTERNS['structure'], _COMMENT_CLOSE
+    else:
+        pattern, close_marker = _STRUCTURE_BYTES, _COMMENT_CLOSE.encode('ascii')
+
+    boundaries = []
+    has_stray_comment = False
+    comment_closes_exhausted = False
+    fence = None
+    position = start
+    while True:
+        match = pattern.search(text, position)
+        if match is None:
+            break
+        kind = match.lastgroup
+        position = match.end()
+
+        if kind == 'fence':
+            marker = match.group('fence')
+            if fence is None:
+                fence = marker
+            elif marker[0] == fence[0] and len(marker) >= len(fence):
+                fence = None
+        elif fence is not None:
+            continue
+        elif kind == 'comment':
+            close = -1 if comment_closes_exhausted else text.find(close_marker, position)
+            if close == -1:
+                comment_closes_exhausted = True
+                has_stray_comment = True
+                continue
+            position = close + len(close_marker)
+        elif kind == 'header':
+            boundaries.append(match.start())
+
+    return boundaries, has_stray_comment
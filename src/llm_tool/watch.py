@@ -0,0 +1,193 @@
+from collections.abc import Callable
+from os import PathLike
+from pathlib import Path
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from llm_tool.batch import pending_model
+
+
+class PollingWatcher:
+    """Detect saved markdown files by polling their mtime and size.
+
+    Works everywhere, but costs a directory walk every `interval` seconds.
+    """
+
+    def __init__(self, directory: str | PathLike[str], interval: float = 1.0):
+        self.directory = Path(directory)
+        self.interval = interval
+        self._signatures = self._scan()
+
+    def _scan(self) -> dict:
+        signatures = dict()
+        for path in self.directory.rglob('*.md'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            signatures[path.resolve()] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def poll(self, timeout: float) -> set[Path]:
+        """Wait up to `timeout` seconds and return the files that changed"""
+        time.sleep(min(timeout, self.interval))
+        signatures = self._scan()
+        changed = {
+            path for path, signature in signatures.items()
+            if self._signatures.get(path) != signature
+        }
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Detect saved markdown files with Linux inotify.
+
+    Watches `directory` and its subdirectories for files that are closed
+    after writing or moved into place (editors that save by renaming a
+    temporary file). New subdirectories are watched as they appear.
+
+    Raises
+    ------
+    OSError
+        If inotify isn't available on this platform.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory: str | PathLike[str]):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watch_dirs = dict()
+        root = Path(directory).resolve()
+        self._add_watch(root)
+        for subdir in root.rglob('*'):
+            if subdir.is_dir():
+                self._add_watch(subdir)
+
+    def _add_watch(self, directory: Path):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self._watch_dirs[wd] = directory
+
+    def poll(self, timeout: float) -> set[Path]:
+        """Wait up to `timeout` seconds and return the files that changed"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            directory = self._watch_dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_watch(path)
+            elif path.suffix == '.md' and mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(directory: str | PathLike[str], poll: bool = False, poll_interval: float = 1.0):
+    """Create an inotify watcher, falling back to polling if it's unavailable"""
+    if not poll:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            print("inotify is not available: falling back to polling")
+    return PollingWatcher(directory, interval=poll_interval)
+
+
+def _file_signature(path: Path) -> tuple[int, int] | None:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def watch(
+    watcher,
+    base_config: dict,
+    respond: Callable[[str | PathLike[str]], None],
+    debounce: float = 1.0,
+    max_iterations: int | None = None,
+    ):
+    """
+    Answer new prompts in watched markdown files as they are saved.
+
+    Saves are debounced: a file is only checked once it has been quiet for
+    `debounce` seconds, so a burst of saves gives a single response. The
+    daemon's own appends are recognised by the file's mtime and size after
+    writing and are ignored. Files are only answered if their last turn is
+    an unanswered `# %User` prompt.
+
+    Parameters
+    ----------
+    watcher : InotifyWatcher or PollingWatcher
+        The source of file change events, usually from `make_watcher`.
+    base_config : dict
+        The merged DEFAULT, USER and PROJECT configs.
+    respond : callable
+        Called with each pending filepath to write the response in place,
+        normally `read_and_write_response`.
+    debounce : float
+        Seconds a file must be unchanged before it is answered.
+    max_iterations : int or None
+        Stop after this many polls. None runs until interrupted.
+    """
+    last_event = dict()
+    own_writes = dict()
+    iterations = 0
+
+    while max_iterations is None or iterations < max_iterations:
+        iterations += 1
+        for path in watcher.poll(timeout=debounce / 2):
+            last_event[path] = time.monotonic()
+
+        now = time.monotonic()
+        ready = [path for path, seen in last_event.items() if now - seen >= debounce]
+        for path in ready:
+            del last_event[path]
+            signature = _file_signature(path)
+            if signature is None or own_writes.get(path) == signature:
+                continue
+            try:
+                model_name = pending_model(path, base_config)
+                if model_name is None:
+                    continue
+                print(f"Answering {path} with {model_name}")
+                respond(path)
+            except Exception as e:
+                print(f"Failed to answer {path}: {type(e).__name__}: {e}")
+            own_writes[path] = _file_signature(path)
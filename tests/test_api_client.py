@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+import threading
+from types import SimpleNamespace
+import llm_tool.claude_vision as claude_vision
+from llm_tool.claude_vision import async_claude_vision_conversation, get_async_client, get_client
+
+pytest.importorskip("anthropic")
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients(monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    claude_vision._clients.clear()
+    claude_vision._async_clients.clear()
+    yield
+    claude_vision._clients.clear()
+    claude_vision._async_clients.clear()
+
+
+def test_get_client_is_shared():
+    assert get_client() is get_client({})
+
+
+def test_get_client_settings():
+    config = {'api_client': {'timeout': 30, 'connect_timeout': 3, 'max_retries': 5}}
+    client = get_client(config)
+    assert client is not get_client()
+    assert client.max_retries == 5
+    assert client.timeout.read == 30
+    assert client.timeout.connect == 3
+
+
+def test_get_client_from_threads():
+    clients = []
+    barrier = threading.Barrier(8)
+
+    def make():
+        barrier.wait()
+        clients.append(get_client())
+
+    threads = [threading.Thread(target=make) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(client) for client in clients}) == 1
+
+
+def test_get_async_client_per_event_loop():
+    async def two_clients():
+        return get_async_client(), get_async_client()
+
+    first, same = asyncio.run(two_clients())
+    assert first is same
+    second, _ = asyncio.run(two_clients())
+    assert second is not first
+
+
+def test_get_async_client_needs_running_loop():
+    with pytest.raises(RuntimeError):
+        get_async_client()
+
+
+class StubAsyncClient:
+    def __init__(self):
+        self.requests = []
+        self.messages = self
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        await asyncio.sleep(0.05)
+        return SimpleNamespace(content=[SimpleNamespace(text=kwargs['messages'][-1]['content'][0]['text'].upper())])
+
+
+def test_async_claude_vision_conversation(monkeypatch):
+    client = StubAsyncClient()
+    monkeypatch.setattr(claude_vision, 'get_async_client', lambda config=None: client)
+    config = {
+        'model_name': 'claude-test', 'system_msg': '', 'model_options': {},
+        'prompt_cache': False, 'image_cache': False, 'image_preprocess': None,
+    }
+
+    async def answer_all():
+        return await asyncio.gather(*(
+            async_claude_vision_conversation(
+                {'conversation': [{'role': 'user', 'content': [{'type': 'text', 'text': f"q{i}"}]}]}, '.', config,
+                )
+            for i in range(5)
+        ))
+
+    assert asyncio.run(answer_all()) == [f"\n# %Assistant\n\nQ{i}" for i in range(5)]
+    assert [request['max_tokens'] for request in client.requests] == [4096] * 5
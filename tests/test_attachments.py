@@ -0,0 +1,173 @@
+import json
+import time
+import pytest
+import llm_tool.__main__ as llmd_main
+from llm_tool.attachments import AttachmentRegistry, file_ids, is_missing_file_error
+from llm_tool.claude_vision import claude_vision_conversation, claude_vision_conversation_stream
+from llm_tool.context_window import estimate_turn_tokens
+from llm_tool.hydration import hydrate_conversation
+from llm_tool.mock_models import MockAnthropicClient, MockFiles, MockNotFoundError
+from llm_tool.response_cache import make_cache_key
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    monkeypatch.setattr(MockFiles, 'uploads', dict())
+    return MockFiles.uploads
+
+
+@pytest.fixture
+def registry(tmp_path, uploads):
+    return AttachmentRegistry(tmp_path / 'index', MockAnthropicClient(), min_document_kb=1)
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'index').mkdir()
+    (tmp_path / 'cats.png').write_bytes(b"cats")
+    (tmp_path / 'copy.png').write_bytes(b"cats")
+    (tmp_path / 'small.txt').write_text("small")
+    (tmp_path / 'big.txt').write_text("x" * 2000)
+    return tmp_path
+
+
+def test_files_are_uploaded_once_per_content(files, registry, uploads):
+    first = registry.file_id(files / 'cats.png', 'image/png')
+    assert registry.file_id(files / 'copy.png', 'image/png') == first
+    assert (registry.uploaded, registry.reused) == (1, 1)
+    assert uploads == {first: b"cats"}
+
+    # The index is kept between runs
+    again = AttachmentRegistry(files / 'index', MockAnthropicClient())
+    assert again.file_id(files / 'cats.png', 'image/png') == first
+    assert again.uploaded == 0
+
+
+def test_expired_uploads_are_uploaded_again(files, registry):
+    first = registry.file_id(files / 'cats.png', 'image/png')
+    index = json.loads(registry.index_path.read_text())
+    [entry] = index.values()
+    assert entry['expires_at'] == pytest.approx(time.time() + 30 * 24 * 3600, abs=60)
+
+    entry['expires_at'] = time.time() + 60
+    registry.index_path.write_text(json.dumps(index))
+    later = AttachmentRegistry(files / 'index', MockAnthropicClient())
+    assert later.file_id(files / 'cats.png', 'image/png') != first
+
+
+def test_ttl_is_clamped(files, uploads):
+    assert AttachmentRegistry(files / 'index', MockAnthropicClient(), ttl_days=0).ttl_seconds == 3600
+    assert AttachmentRegistry(files / 'index', MockAnthropicClient(), ttl_days=365).ttl_seconds == 90 * 24 * 3600
+
+
+def test_hydrate_with_attachments(files, registry):
+    conversation = [{'role': 'user', 'content': [
+        {'type': 'link', 'link': str(files / 'small.txt')},
+        {'type': 'link', 'link': str(files / 'big.txt')},
+        {'type': 'image', 'source': str(files / 'cats.png')},
+    ]}]
+    hydrate_conversation(conversation, files, attachments=registry)
+
+    small, big, image = conversation[0]['content']
+    assert small == {'type': 'text', 'text': 'small'}
+    assert big['type'] == 'document' and big['title'] == 'big.txt'
+    assert big['source']['type'] == 'file'
+    assert image == {'type': 'image', 'source': {'type': 'file', 'file_id': image['source']['file_id']}}
+    assert file_ids({'messages': conversation}) == [big['source']['file_id'], image['source']['file_id']]
+
+
+def test_cache_key_of_uploaded_images():
+    def key(file_id):
+        parsed = {'conversation': [{'role': 'user', 'content': [
+            {'type': 'image', 'source': {'type': 'file', 'file_id': file_id}}]}]}
+        return make_cache_key(parsed, {'model_name': 'm', 'system_msg': '', 'model_options': {}})
+
+    assert key('file_1') != key('file_2')
+
+
+def test_is_missing_file_error():
+    assert is_missing_file_error(MockNotFoundError("File not found: file_1"), ['file_1'])
+    assert not is_missing_file_error(MockNotFoundError("Model not found"), ['file_1'])
+    assert not is_missing_file_error(ValueError("file_1"), ['file_1'])
+
+    class BadRequest(Exception):
+        status_code = 400
+        body = {'type': 'error', 'error': {'type': 'invalid_request_error', 'message': "Bad file_1 image"}}
+
+    assert not is_missing_file_error(BadRequest("Bad file_1 image"), ['file_1'])
+
+
+CONFIG = {
+    'model_name': 'mock', 'system_msg': '', 'prompt_cache': True,
+    'model_options': {'ttft': 0, 'response_bytes': 0},
+    'image_cache': False, 'image_preprocess': None,
+    'attachments': {'enabled': True},
+}
+
+
+@pytest.mark.parametrize('answer', [claude_vision_conversation, lambda *args: ''.join(claude_vision_conversation_stream(*args))])
+def test_missing_files_are_uploaded_again(files, registry, uploads, monkeypatch, answer):
+    monkeypatch.setattr('llm_tool.attachments.AttachmentRegistry', lambda *args, **kwargs: registry)
+    conversation = [{'role': 'user', 'content': [
+        {'type': 'image', 'source': str(files / 'cats.png')},
+        {'type': 'text', 'text': 'What is this?'},
+    ]}]
+    hydrate_conversation(conversation, files, attachments=registry)
+    uploads.clear()
+
+    assert answer({'conversation': conversation}, files, CONFIG) == "\n# %Assistant\n\nMock answer to: What is this?"
+    assert registry.uploaded == 2
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch, uploads):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+
+
+def test_images_are_uploaded_once_per_conversation(workdir, uploads, capsys):
+    (workdir / 'cats.png').write_bytes(b"cats")
+    chat = workdir / 'chat.md'
+    chat.write_text(
+        "---\nmodel: mock\nimage_preprocess: null\nattachments:\n  enabled: true\n"
+        "options:\n  ttft: 0\n  response_bytes: 0\n---\n# %User\n![cats](cats.png)\nWhat is this?\n"
+    )
+    llmd_main.read_and_write_response(chat)
+    assert 'Attachments: 1 uploaded, 0 reused' in capsys.readouterr().out
+
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nAnd now?\n")
+    llmd_main.read_and_write_response(chat)
+    assert 'Attachments: 0 uploaded, 1 reused' in capsys.readouterr().out
+    assert chat.read_text().endswith("Mock answer to: And now?")
+    assert len(uploads) == 1
+
+
+def test_cached_responses_upload_nothing(workdir, uploads, capsys):
+    (workdir / 'cats.png').write_bytes(b"cats")
+    (workdir / 'big.txt').write_text("x" * 2000)
+    prompt = (
+        "---\nmodel: mock\ncache: true\nimage_preprocess: null\nattachments:\n  enabled: true\n  min_document_kb: 1\n"
+        "options:\n  ttft: 0\n  response_bytes: 0\n---\n# %User\n![cats](cats.png)\n[big](big.txt)\nWhat is this?\n"
+    )
+    chat = workdir / 'chat.md'
+    chat.write_text(prompt)
+    llmd_main.read_and_write_response(chat)
+    assert 'Attachments: 2 uploaded, 0 reused' in capsys.readouterr().out
+
+    copy = workdir / 'copy.md'
+    copy.write_text(prompt)
+    llmd_main.read_and_write_response(copy)
+    assert 'Attachments' not in capsys.readouterr().out
+    assert copy.read_text() == chat.read_text()
+    assert len(uploads) == 2
+
+
+def test_documents_count_towards_the_context_window(files, registry):
+    turn = {'role': 'user', 'content': [{'type': 'link', 'link': str(files / 'big.txt')}]}
+    linked = estimate_turn_tokens(turn)
+    hydrate_conversation([turn], files, attachments=registry)
+    assert turn['content'][0]['type'] == 'document'
+    assert estimate_turn_tokens(turn) == linked >= 500
@@ -0,0 +1,118 @@
+import pytest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from llm_tool.batch import find_markdown_files, pending_model, run_batch, format_batch_summary
+
+BASE_CONFIG = {'model': 'default-model', 'batch_max_workers': 4}
+
+
+@pytest.fixture
+def vault():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        (root / "sub").mkdir()
+        (root / "pending.md").write_text("# %User\nHello\n")
+        (root / "answered.md").write_text("# %User\nHello\n# %Assistant\nHi\n")
+        (root / "sub" / "other_model.md").write_text("---\nmodel: other-model\n---\n# %User\nHello\n")
+        (root / "notes.txt").write_text("# %User\nNot markdown\n")
+        yield root
+
+
+def test_find_markdown_files_directory(vault):
+    result = find_markdown_files([vault])
+    assert sorted(p.name for p in result) == ['answered.md', 'other_model.md', 'pending.md']
+
+
+def test_find_markdown_files_glob_and_duplicates(vault):
+    result = find_markdown_files([str(vault / "*.md"), vault / "pending.md"])
+    assert sorted(p.name for p in result) == ['answered.md', 'pending.md']
+
+
+def test_pending_model(vault):
+    assert pending_model(vault / "pending.md", BASE_CONFIG) == 'default-model'
+    assert pending_model(vault / "answered.md", BASE_CONFIG) is None
+    assert pending_model(vault / "sub" / "other_model.md", BASE_CONFIG) == 'other-model'
+
+
+def test_run_batch_answers_pending_files(vault):
+    answered = []
+    summary = run_batch(find_markdown_files([vault]), BASE_CONFIG, answered.append)
+    assert sorted(p.name for p in answered) == ['other_model.md', 'pending.md']
+    assert summary['checked'] == 3
+    assert summary['pending'] == 2
+    assert summary['answered'] == 2
+    assert summary['failed'] == {}
+
+
+def test_run_batch_reports_failures(vault):
+    def respond(filepath):
+        if filepath.name == 'pending.md':
+            raise RuntimeError("overloaded")
+
+    summary = run_batch(find_markdown_files([vault]), BASE_CONFIG, respond)
+    assert summary['answered'] == 1
+    assert list(summary['failed'].values()) == ["RuntimeError: overloaded"]
+    assert "1 failed:" in format_batch_summary(summary)
+
+
+def test_run_batch_model_concurrency(vault):
+    for i in range(6):
+        (vault / f"extra{i}.md").write_text("# %User\nHello\n")
+    config = dict(BASE_CONFIG, model_concurrency={'default-model': 2})
+    lock = threading.Lock()
+    in_flight = {'now': 0, 'max': 0}
+
+    def respond(filepath):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        time.sleep(0.02)
+        with lock:
+            in_flight['now'] -= 1
+
+    files = [vault / f"extra{i}.md" for i in range(6)]
+    summary = run_batch(files, config, respond)
+    assert summary['answered'] == 6
+    assert in_flight['max'] == 2
+
+
+def test_run_batch_fan_out_takes_a_permit_for_each_model(vault):
+    (vault / "both.md").write_text("---\nmodel:\n  - default-model\n  - other-model\n---\n# %User\nHello\n")
+    config = dict(BASE_CONFIG, model_concurrency={'other-model': 1})
+    lock = threading.Lock()
+    in_flight = {'now': 0, 'max': 0}
+
+    def respond(filepath):
+        if filepath.name == 'pending.md':
+            return
+        with lock:
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        time.sleep(0.02)
+        with lock:
+            in_flight['now'] -= 1
+
+    files = [vault / "both.md", vault / "sub" / "other_model.md", vault / "pending.md"]
+    summary = run_batch(files, config, respond)
+    assert summary['answered'] == 3
+    assert in_flight['max'] == 1
+
+
+def test_run_batch_busy_model_does_not_block_others(vault):
+    for i in range(3):
+        (vault / f"extra{i}.md").write_text("# %User\nHello\n")
+    config = dict(BASE_CONFIG, batch_max_workers=2, model_concurrency={'default-model': 1})
+    other_started = threading.Event()
+
+    def respond(filepath):
+        if filepath.name == 'other_model.md':
+            other_started.set()
+        elif not other_started.wait(2):
+            raise TimeoutError("other-model waited for default-model")
+
+    files = [vault / f"extra{i}.md" for i in range(3)] + [vault / "sub" / "other_model.md"]
+    summary = run_batch(files, config, respond)
+    assert summary['failed'] == {}
+    assert summary['answered'] == 4
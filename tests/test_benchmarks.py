@@ -0,0 +1,37 @@
+"""The benchmark runner's regression gate, on tiny inputs"""
+import sys
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / 'benchmarks'))
+import run_benchmarks
+
+
+def results(quick=True, **medians):
+    return {
+        'quick': quick,
+        'benchmarks': {name: {'median': median, 'min': median, 'repeat': 1} for name, median in medians.items()},
+    }
+
+
+def test_compare_results_flags_regressions():
+    baseline = results(parse=0.100, chunk=0.010, config=0.0001)
+    current = results(parse=0.150, chunk=0.011, config=0.001, fresh=0.2)
+    lines, regressions = run_benchmarks.compare_results(baseline, current, threshold=0.25)
+    assert regressions == ['parse']
+    assert lines[0].endswith('REGRESSION')
+    # Too fast in the baseline for its timings to be meaningful
+    assert 'REGRESSION' not in lines[2]
+    assert lines[3].split() == ['fresh', 'new']
+
+
+def test_compare_quick_with_full_run():
+    with pytest.raises(ValueError):
+        run_benchmarks.compare_results(results(quick=True, parse=1), results(quick=False, parse=1))
+
+
+def test_run_and_compare(tmp_path, capsys):
+    output = tmp_path / 'baseline.json'
+    assert run_benchmarks.main(['run', '--quick', '--repeat', '1', '--filter', 'chunk_user', '--output', str(output)]) == 0
+    assert run_benchmarks.main(['compare', str(output), str(output)]) == 0
+    assert 'chunk_user_assistant_turns/10k_turns' in capsys.readouterr().out
@@ -0,0 +1,203 @@
+import sys
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.compaction import (
+    compact_file, compaction_point, expand_archived_turns, new_archive_path, read_archive, summary_turns,
+    write_archive,
+)
+from llm_tool.parser import parse_conversation
+
+HEADER = "---\nmodel: summariser\nstream: false\n---\n"
+
+
+def chat_body(n_pairs):
+    return ''.join(f"# %User\nQuestion {i}\n\n# %Assistant\nAnswer {i}\n\n" for i in range(n_pairs))
+
+
+@pytest.fixture
+def chat(tmp_path):
+    path = tmp_path / 'chat.md'
+    path.write_text(HEADER + "Notes before the chat\n" + chat_body(3) + "# %User\nLast question\n")
+    return path
+
+
+def test_compaction_point_keeps_prompts_with_their_answers():
+    turns = [{'role': role} for role in ['user', 'assistant', 'assistant', 'user', 'assistant', 'user']]
+    assert compaction_point(turns, 1) == 5
+    assert compaction_point(turns, 2) == 3
+    assert compaction_point(turns, 4) is None
+    with pytest.raises(ValueError):
+        compaction_point(turns, 0)
+
+
+def test_compact_file_with_a_summary(chat):
+    original = chat.read_text()
+    archive = compact_file(chat, keep_turns=3, summary="We asked questions 0 and 1.")
+
+    assert archive == chat.parent / 'chat.llmd-archive-1.md.gz'
+    assert read_archive(archive) == chat_body(2)
+    assert chat.read_text() == (
+        HEADER + "Notes before the chat\n"
+        + summary_turns(archive.name, "We asked questions 0 and 1.")
+        + "# %User\nQuestion 2\n\n# %Assistant\nAnswer 2\n\n# %User\nLast question\n"
+    )
+
+    conversation = parse_conversation(chat.read_text().split('---\n', 2)[2])['conversation']
+    assert conversation[0]['archive'] == archive.name
+    assert conversation[1] == {'role': 'assistant', 'content': 'OK.'}
+    assert len(conversation) == 5
+
+    # Expanding gives back the original conversation
+    expanded = parse_conversation(chat.read_text().split('---\n', 2)[2], base_path=chat.parent, expand_archives=True)
+    assert expanded == parse_conversation(original.split('---\n', 2)[2], base_path=chat.parent)
+
+
+def test_compacting_again_nests_archives(chat):
+    first = compact_file(chat, keep_turns=3, summary="First")
+    with open(chat, 'a') as file:
+        file.write("\n# %Assistant\nLast answer\n\n# %User\nAnother question\n")
+    second = compact_file(chat, keep_turns=1, summary="Second")
+
+    assert second == new_archive_path(chat).with_name('chat.llmd-archive-2.md.gz')
+    assert "archive: chat.llmd-archive-1.md.gz" in read_archive(second)
+    body = chat.read_text().split('---\n', 2)[2]
+    texts = [
+        turn['content'] if turn['role'] == 'assistant' else turn['content'][0]['text']
+        for turn in parse_conversation(body, base_path=chat.parent, expand_archives=True)['conversation']
+    ]
+    assert texts == [
+        'Question 0', 'Answer 0', 'Question 1', 'Answer 1', 'Question 2', 'Answer 2',
+        'Last question', 'Last answer', 'Another question',
+    ]
+    assert first.exists()
+
+
+def test_nothing_to_compact(chat, capsys):
+    assert compact_file(chat, keep_turns=7, summary="Unused") is None
+    assert 'Nothing to compact' in capsys.readouterr().out
+    assert compact_file(chat, keep_turns=1, summary="Unused", min_turns=7) is None
+    assert list(chat.parent.glob('*.gz')) == []
+
+
+def test_file_changed_while_summarising_is_left_alone(chat):
+    def summarise(markdown):
+        with open(chat, 'a') as file:
+            file.write("more")
+        return "Summary"
+
+    before = chat.read_text()
+    assert compact_file(chat, keep_turns=1, summarise=summarise) is None
+    assert chat.read_text() == before + "more"
+    assert list(chat.parent.glob('*.gz')) == []
+
+
+def test_missing_archive_keeps_the_summary(tmp_path, capsys):
+    conversation = parse_conversation(summary_turns('gone.md.gz', 'Summary') + "# %User\nHi\n")['conversation']
+    assert expand_archived_turns(conversation, tmp_path) == conversation
+    assert 'gone.md.gz not found' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('absolute', [False, True])
+def test_archive_outside_the_directory_is_not_read(tmp_path, capsys, absolute):
+    chats = tmp_path / 'chats'
+    chats.mkdir()
+    write_archive(tmp_path / 'secret.md.gz', "# %User\nSecret\n")
+    archive = str(tmp_path / 'secret.md.gz') if absolute else '../secret.md.gz'
+    conversation = parse_conversation(summary_turns(archive, 'Summary') + "# %User\nHi\n")['conversation']
+    assert expand_archived_turns(conversation, chats) == conversation
+    assert 'is outside' in capsys.readouterr().out
+
+
+class Summariser(llm.Model):
+    """Summarises by counting the turns it was sent"""
+    model_id = 'summariser'
+    prompts = []
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        self.prompts.append(prompt.prompt)
+        yield f"{len(prompt.messages or [])} messages"
+
+
+@pytest.fixture
+def summariser(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm, 'get_model', lambda name: Summariser())
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    monkeypatch.setattr(Summariser, 'prompts', [])
+    yield Summariser
+
+
+def test_llmd_compact_asks_the_model_for_a_summary(summariser, chat, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['llmd', 'compact', str(chat), '--keep-turns', '1'])
+    assert llmd_main.main() == 0
+
+    assert summariser.prompts[0].startswith("Summarise our conversation so far")
+    # The three archived pairs, then the summary prompt
+    assert "A summary of our conversation so far:\n\n7 messages\n" in chat.read_text()
+    assert chat.read_text().endswith("OK.\n\n# %User\nLast question\n")
+
+
+def test_llmd_compact_with_a_summary_file(summariser, chat, tmp_path, monkeypatch):
+    (tmp_path / 'summary.txt').write_text("Written by hand")
+    monkeypatch.setattr(sys, 'argv', ['llmd', 'compact', str(chat), '--summary-file', str(tmp_path / 'summary.txt'), '--keep-turns', '3'])
+    assert llmd_main.main() == 0
+    assert summariser.prompts == []
+    assert "Written by hand" in chat.read_text()
+
+
+def test_auto_compaction_before_answering(summariser, chat):
+    chat.write_text(chat.read_text().replace(
+        HEADER, HEADER.replace("stream: false\n", "stream: false\ncompact:\n  keep_turns: 1\n  auto_after_turns: 5\n"),
+    ))
+    llmd_main.read_and_write_response(chat)
+
+    content = chat.read_text()
+    assert (chat.parent / 'chat.llmd-archive-1.md.gz').exists()
+    # The answer was asked with the summary pair as history
+    assert content.endswith("# %User\nLast question\n\n\n# %Assistant\n\n3 messages")
+    assert len(summariser.prompts) == 2
+
+    # With fewer turns than the threshold, nothing more is archived
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nOne more\n")
+    llmd_main.read_and_write_response(chat)
+    assert not (chat.parent / 'chat.llmd-archive-2.md.gz').exists()
+
+
+def test_expand_archives_sends_the_archived_turns(summariser, chat):
+    compact_file(chat, keep_turns=1, summary="Short")
+    chat.write_text(chat.read_text().replace("stream: false\n", "stream: false\nexpand_archives: true\n"))
+    llmd_main.read_and_write_response(chat)
+    assert chat.read_text().endswith("\n\n# %Assistant\n\n7 messages")
+
+
+def test_auto_compaction_counts_the_turns_of_the_file(summariser, chat):
+    chat.write_text(chat.read_text().replace(
+        HEADER, HEADER.replace("stream: false\n", (
+            "stream: false\nexpand_archives: true\ncompact:\n  keep_turns: 1\n  auto_after_turns: 5\n"
+        )),
+    ))
+    llmd_main.read_and_write_response(chat)
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nOne more\n")
+    llmd_main.read_and_write_response(chat)
+
+    # The file has five turns, and the archived turns sent with them don't count
+    assert [path.name for path in chat.parent.glob('*.gz')] == ['chat.llmd-archive-1.md.gz']
+    assert len(summariser.prompts) == 3
+    assert chat.read_text().endswith("# %User\nOne more\n\n\n# %Assistant\n\n9 messages")
+
+
+def test_auto_compaction_threshold_must_leave_room(summariser, chat):
+    chat.write_text(chat.read_text().replace(
+        HEADER, HEADER.replace("stream: false\n", "stream: false\ncompact:\n  keep_turns: 3\n  auto_after_turns: 5\n"),
+    ))
+    with pytest.raises(ValueError, match="auto_after_turns"):
+        llmd_main.read_and_write_response(chat)
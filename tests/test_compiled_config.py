@@ -0,0 +1,135 @@
+import os
+import pytest
+import yaml
+import llm_tool.compiled_config as compiled_config
+from llm_tool.compiled_config import load_compiled_config
+from llm_tool.config_and_system import load_yaml
+
+DEFAULTS = {
+    'model': 'claude-3-5-sonnet-latest',
+    'system': '{sys_prefs}',
+    'options': {'max_tokens': 1024},
+    'sys_prefs': 'Be brief',
+}
+
+
+@pytest.fixture
+def sources(tmp_path):
+    user = tmp_path / 'config.yaml'
+    project = tmp_path / 'project' / 'llmd_config.yaml'
+    project.parent.mkdir()
+    user.write_text(yaml.dump({'sys_prefs': 'Be very brief'}))
+    return [user, project]
+
+
+@pytest.fixture
+def counting_loads(monkeypatch):
+    loads = []
+    load = compiled_config.load_config_or_empty
+
+    def counting_load(path, filename):
+        loads.append(filename)
+        return load(path, filename)
+
+    monkeypatch.setattr(compiled_config, 'load_config_or_empty', counting_load)
+    return loads
+
+
+def test_load_compiled_config(sources, tmp_path):
+    merged, rendered = load_compiled_config(DEFAULTS, sources, tmp_path / 'compiled.pickle')
+    assert merged['sys_prefs'] == 'Be very brief'
+    assert rendered['system_msg'] == 'Be very brief'
+    assert rendered['model_options'] == {'max_tokens': 1024}
+
+
+def test_unchanged_sources_are_not_reloaded(sources, tmp_path, counting_loads):
+    cache_path = tmp_path / 'compiled.pickle'
+    first = load_compiled_config(DEFAULTS, sources, cache_path)
+    assert len(counting_loads) == 2
+    assert load_compiled_config(DEFAULTS, sources, cache_path) == first
+    assert len(counting_loads) == 2
+
+
+def test_changed_source_is_reloaded(sources, tmp_path, counting_loads):
+    cache_path = tmp_path / 'compiled.pickle'
+    load_compiled_config(DEFAULTS, sources, cache_path)
+
+    sources[1].write_text(yaml.dump({'model': 'gpt-4o'}))
+    merged, rendered = load_compiled_config(DEFAULTS, sources, cache_path)
+    assert rendered['model_name'] == 'gpt-4o'
+
+    # Same size and a new modification time
+    sources[1].write_text(yaml.dump({'model': 'gpt-4x'}))
+    stat = sources[1].stat()
+    os.utime(sources[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    merged, rendered = load_compiled_config(DEFAULTS, sources, cache_path)
+    assert rendered['model_name'] == 'gpt-4x'
+    assert len(counting_loads) == 6
+
+
+def test_new_llmd_version_is_reloaded(sources, tmp_path, monkeypatch):
+    cache_path = tmp_path / 'compiled.pickle'
+    load_compiled_config(DEFAULTS, sources, cache_path)
+    monkeypatch.setattr(compiled_config, '__version__', '999')
+    merged, _ = load_compiled_config(dict(DEFAULTS, model='gpt-4o'), sources, cache_path)
+    assert merged['model'] == 'gpt-4o'
+
+
+def test_corrupt_cache_is_rebuilt(sources, tmp_path):
+    cache_path = tmp_path / 'compiled.pickle'
+    cache_path.write_bytes(b'not a pickle')
+    merged, _ = load_compiled_config(DEFAULTS, sources, cache_path)
+    assert merged['sys_prefs'] == 'Be very brief'
+    assert load_compiled_config(DEFAULTS, sources, cache_path)[0] == merged
+
+
+def test_unrenderable_config(sources, tmp_path):
+    # The snippet might only be defined in a file header
+    merged, rendered = load_compiled_config(dict(DEFAULTS, system='{sys_missing}'), sources, tmp_path / 'compiled.pickle')
+    assert merged['system'] == '{sys_missing}'
+    assert rendered is None
+
+
+def test_invalid_config_is_raised(sources, tmp_path):
+    with pytest.raises(AttributeError):
+        load_compiled_config(dict(DEFAULTS, system=None), sources, tmp_path / 'compiled.pickle')
+
+
+def test_results_are_copies(sources, tmp_path):
+    cache_path = tmp_path / 'compiled.pickle'
+    merged, rendered = load_compiled_config(DEFAULTS, sources, cache_path)
+    merged['options']['max_tokens'] = 1
+    rendered['model_options']['max_tokens'] = 1
+    merged, rendered = load_compiled_config(DEFAULTS, sources, cache_path)
+    assert merged['options'] == rendered['model_options'] == {'max_tokens': 1024}
+
+
+def test_load_yaml():
+    assert load_yaml("model: gpt-4o\noptions:\n  max_tokens: 10\n") == {'model': 'gpt-4o', 'options': {'max_tokens': 10}}
+    with pytest.raises(yaml.constructor.ConstructorError):
+        load_yaml("!!python/object/apply:os.system ['true']")
+
+
+def test_base_config_sees_edits_in_the_same_process(tmp_path, monkeypatch):
+    import llm_tool.__main__ as llmd_main
+
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    project = tmp_path / 'llmd_config.yaml'
+    project.write_text(yaml.dump({'model': 'gpt-4o'}))
+    assert llmd_main.get_base_config()['model'] == 'gpt-4o'
+
+    project.write_text(yaml.dump({'model': 'gpt-4o-mini'}))
+    assert llmd_main.get_base_config()['model'] == 'gpt-4o-mini'
+    assert llmd_main.get_file_config({})['model_name'] == 'gpt-4o-mini'
+
+
+def test_base_config_follows_the_config_dir(tmp_path, monkeypatch):
+    import llm_tool.__main__ as llmd_main
+
+    monkeypatch.chdir(tmp_path)
+    for name in ('first', 'second'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'config.yaml').write_text(yaml.dump({'model': name}))
+        monkeypatch.setenv('llmd_config_dir', str(tmp_path / name))
+        assert llmd_main.get_base_config()['model'] == name
@@ -0,0 +1,164 @@
+import pytest
+from llm_tool.context_window import (
+    IMAGE_TOKENS, STRATEGIES, TURN_OVERHEAD_TOKENS,
+    estimate_turn_tokens, fit_conversation, register_strategy,
+)
+from llm_tool.parser import parse_conversation
+
+
+def user(text, **extra):
+    return {'role': 'user', 'content': [{'type': 'text', 'text': text}], **extra}
+
+
+def assistant(text):
+    return {'role': 'assistant', 'content': text}
+
+
+def make_conversation(n_exchanges, turn_chars=400):
+    # Every turn is 100 + TURN_OVERHEAD_TOKENS tokens
+    conversation = []
+    for i in range(n_exchanges):
+        conversation.append(user(f"{i}".ljust(turn_chars, 'u')))
+        conversation.append(assistant(f"{i}".ljust(turn_chars, 'a')))
+    conversation.append(user("New prompt"))
+    return conversation
+
+
+TURN_TOKENS = 100 + TURN_OVERHEAD_TOKENS
+
+
+def test_estimate_turn_tokens():
+    assert estimate_turn_tokens(assistant('x' * 400)) == TURN_TOKENS
+    image = {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': 'Y2F0cw=='}}
+    turn = {'role': 'user', 'content': [{'type': 'text', 'text': 'x' * 40}, image]}
+    assert estimate_turn_tokens(turn) == 10 + IMAGE_TOKENS + TURN_OVERHEAD_TOKENS
+
+
+def test_fit_conversation_under_budget_is_unchanged():
+    conversation = make_conversation(3)
+    logged = []
+    assert fit_conversation(conversation, 10_000, log=logged.append) is conversation
+    assert logged == []
+
+
+def test_fit_conversation_off():
+    conversation = make_conversation(3)
+    assert fit_conversation(conversation, None) is conversation
+
+
+def test_drop_oldest():
+    conversation = make_conversation(5)
+    logged = []
+    fitted = fit_conversation(conversation, 5 * TURN_TOKENS, log=logged.append)
+    # Two whole exchanges fit alongside the new prompt
+    assert fitted == conversation[6:]
+    assert logged == [f"Context window: dropped turns 1-6 (~{6 * TURN_TOKENS} tokens) to fit {5 * TURN_TOKENS} tokens"]
+
+
+def test_system_message_counts_against_budget():
+    conversation = make_conversation(5)
+    fitted = fit_conversation(conversation, 5 * TURN_TOKENS, system_msg='s' * 400, log=lambda line: None)
+    assert fitted == conversation[8:]
+
+
+def test_keep_ends():
+    conversation = make_conversation(5)
+    fitted = fit_conversation(
+        conversation, 5 * TURN_TOKENS, strategy='keep_ends',
+        options={'keep_first': 2}, log=lambda line: None,
+    )
+    assert fitted == conversation[:2] + conversation[8:]
+
+
+def test_keep_ends_keep_last():
+    conversation = make_conversation(5)
+    fitted = fit_conversation(
+        conversation, 8 * TURN_TOKENS, strategy='keep_ends',
+        options={'keep_first': 2, 'keep_last': 1}, log=lambda line: None,
+    )
+    assert fitted == conversation[:2] + conversation[-1:]
+
+
+def test_skip_low_priority():
+    conversation = make_conversation(3)
+    conversation[2]['low_priority'] = True
+    conversation[3]['low_priority'] = True
+    logged = []
+    fitted = fit_conversation(conversation, 5 * TURN_TOKENS, strategy='skip_low_priority', log=logged.append)
+    assert fitted == conversation[:2] + conversation[4:]
+    assert logged[0].startswith("Context window: dropped turns 3-4 ")
+
+
+def test_skip_low_priority_falls_back_to_oldest():
+    conversation = make_conversation(3)
+    conversation[2]['low_priority'] = True
+    fitted = fit_conversation(conversation, 3 * TURN_TOKENS, strategy='skip_low_priority', log=lambda line: None)
+    assert fitted == conversation[4:]
+
+
+def test_fit_conversation_starts_with_user_turn():
+    conversation = make_conversation(3)
+    fitted = fit_conversation(
+        conversation, 3 * TURN_TOKENS, strategy='keep_ends',
+        options={'keep_first': 0}, log=lambda line: None,
+    )
+    assert fitted[0]['role'] == 'user'
+    assert fitted[-1] == conversation[-1]
+
+
+def test_last_turn_is_kept_even_if_over_budget():
+    conversation = make_conversation(2)
+    logged = []
+    fitted = fit_conversation(conversation, 10, log=logged.append)
+    assert fitted == conversation[-1:]
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        fit_conversation(make_conversation(2), 10, strategy='nope')
+
+
+def test_register_strategy():
+    @register_strategy('first_and_last')
+    def first_and_last(conversation, tokens, budget, options):
+        return [0, len(conversation) - 1]
+
+    try:
+        conversation = make_conversation(3)
+        fitted = fit_conversation(conversation, 2 * TURN_TOKENS, strategy='first_and_last', log=lambda line: None)
+        assert fitted == [conversation[0], conversation[-1]]
+    finally:
+        del STRATEGIES['first_and_last']
+
+
+def test_low_priority_marker_is_parsed():
+    parsed = parse_conversation(
+        "# %User<!--llm low-priority llm-->\nBackground\n# %Assistant\nNoted\n"
+        "# %User\nQuestion <!--llm low-priority llm-->\n# %Assistant\nAnswer\n# %User\nMore\n"
+    )
+    assert [turn.get('low_priority', False) for turn in parsed['conversation']] == [True, False, True, False, False]
+    assert parsed['conversation'][2]['content'] == [{'type': 'text', 'text': 'Question'}]
+
+
+def test_keep_ends_keeps_whole_exchanges():
+    conversation = make_conversation(4)
+    fitted = fit_conversation(
+        conversation, 4 * TURN_TOKENS, strategy='keep_ends',
+        options={'keep_first': 1}, log=lambda line: None,
+    )
+    # The first prompt keeps its answer, and the last exchange is the new prompt
+    assert fitted == conversation[:2] + conversation[-1:]
+
+    fitted = fit_conversation(
+        conversation, 8 * TURN_TOKENS, strategy='keep_ends',
+        options={'keep_first': 2, 'keep_last': 4}, log=lambda line: None,
+    )
+    assert fitted == conversation[:2] + conversation[6:]
+
+
+def test_skip_low_priority_drops_whole_exchanges():
+    conversation = make_conversation(3)
+    conversation[2]['low_priority'] = True
+    fitted = fit_conversation(conversation, 5 * TURN_TOKENS, strategy='skip_low_priority', log=lambda line: None)
+    assert fitted == conversation[:2] + conversation[4:]
+    assert [turn['role'] for turn in fitted] == ['user', 'assistant', 'user', 'assistant', 'user']
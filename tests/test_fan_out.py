@@ -0,0 +1,174 @@
+import time
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.config_and_system import get_config
+from llm_tool.fan_out import label_response, model_configs, model_names, parse_model_list, select_branch
+from llm_tool.parser import parse_conversation
+
+
+class Named(llm.Model):
+    """Answers with its name and the last answer in the history it was sent"""
+    can_stream = True
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+        delay: float | None = None
+        fail: bool | None = None
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+
+    def execute(self, prompt, stream, response, conversation):
+        time.sleep(prompt.options.delay or 0)
+        if prompt.options.fail:
+            raise llm.ModelError(f"{self.model_id} is down")
+        answers = [message for message in prompt.messages or [] if message.role == 'assistant']
+        seen = ''.join(part.text for part in answers[-1].parts) if answers else 'nothing'
+        yield f"{self.model_id} saw {seen}"
+
+
+@pytest.fixture
+def workdir(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm, 'get_model', Named)
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    yield tmp_path
+
+
+HEADER = """---
+model:
+  - alpha
+  - model: beta
+    options:
+      delay: {beta_delay}
+      fail: {beta_fail}
+options:
+  delay: {delay}
+---
+"""
+
+
+def write_chat(path, body, delay=0, beta_delay=0, beta_fail='false'):
+    path.write_text(HEADER.format(delay=delay, beta_delay=beta_delay, beta_fail=beta_fail) + body)
+
+
+def test_model_names():
+    assert model_names('gpt-4o') == ['gpt-4o']
+    assert model_names(None) == []
+    assert model_names(['a', {'model': 'b'}]) == ['a', 'b']
+
+
+def test_parse_model_list():
+    models = parse_model_list(['a', {'model': 'b', 'options': {'temperature': 0}}], {'max_tokens': 10})
+    assert models == [
+        {'model_name': 'a', 'model_options': {'max_tokens': 10}},
+        {'model_name': 'b', 'model_options': {'max_tokens': 10, 'temperature': 0}},
+    ]
+    with pytest.raises(ValueError):
+        parse_model_list(['a', 'a'], {})
+    with pytest.raises(ValueError):
+        parse_model_list([{'options': {}}], {})
+
+
+def test_get_config_with_a_model_list():
+    config = get_config([{'model': ['a', 'b'], 'system': '', 'options': {'max_tokens': 10}}])
+    assert config['model_name'] == 'a'
+    assert [c['model_name'] for c in model_configs(config)] == ['a', 'b']
+    assert all(c['models'] is None for c in model_configs(config))
+
+    single = get_config([{'model': 'a', 'system': '', 'options': {}}])
+    assert single['models'] is None
+    assert model_configs(single) == [single]
+
+
+def test_labelled_answers_are_parsed():
+    body = (
+        "# %User\nHi\n"
+        "# %Assistant\n<!--llm model: alpha llm-->\n\nHello\n"
+        "# %Assistant\n<!--llm model: beta llm--><!--llm keep llm-->\n\nHey\n"
+    )
+    conversation = parse_conversation(body)['conversation']
+    assert conversation[1] == {'role': 'assistant', 'content': 'Hello', 'model': 'alpha'}
+    assert conversation[2] == {'role': 'assistant', 'content': 'Hey', 'model': 'beta', 'keep': True}
+
+
+def test_select_branch():
+    user = {'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]}
+    alpha = {'role': 'assistant', 'content': 'A', 'model': 'alpha'}
+    beta = {'role': 'assistant', 'content': 'B', 'model': 'beta'}
+    plain = {'role': 'assistant', 'content': 'C'}
+
+    assert select_branch([user, alpha, beta, user], 'alpha') == [user, alpha, user]
+    assert select_branch([user, alpha, beta, user], 'beta') == [user, beta, user]
+    # Other models carry on from the last answer
+    assert select_branch([user, alpha, beta], 'gamma') == [user, beta]
+    assert select_branch([user, dict(alpha, keep=True), beta], 'beta') == [user, dict(alpha, keep=True)]
+    assert select_branch([user, plain, user], 'alpha') == [user, plain, user]
+
+
+def test_unlabelled_answers_in_a_row_are_all_sent():
+    parsed = parse_conversation("# %User\nA\n# %Assistant\nB\n# %Assistant\nC\n# %User\nD\n")
+    config = {'model_name': 'alpha', 'context_window': None, 'system_msg': ''}
+    conversation = llmd_main._conversation_for_model(parsed, config)['conversation']
+    assert [turn['content'] for turn in conversation if turn['role'] == 'assistant'] == ['B', 'C']
+
+    plain = {'role': 'assistant', 'content': 'C'}
+    user = {'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]}
+    assert select_branch([user, plain, dict(plain, content='D'), user], 'alpha') == [
+        user, plain, dict(plain, content='D'), user,
+    ]
+
+
+def test_label_response():
+    assert label_response("\n# %Assistant\n\nHi", 'a') == "\n# %Assistant\n<!--llm model: a llm-->\n\nHi"
+
+
+def test_models_are_asked_concurrently(workdir):
+    chat = workdir / 'chat.md'
+    write_chat(chat, "# %User\nHello\n", delay=0.3, beta_delay=0.3)
+
+    start = time.perf_counter()
+    llmd_main.read_and_write_response(chat)
+    assert time.perf_counter() - start < 0.55
+
+    assert chat.read_text().endswith(
+        "# %User\nHello\n"
+        "\n\n# %Assistant\n<!--llm model: alpha llm-->\n\nalpha saw nothing"
+        "\n\n# %Assistant\n<!--llm model: beta llm-->\n\nbeta saw nothing"
+    )
+
+
+def test_each_model_continues_its_own_branch(workdir):
+    chat = workdir / 'chat.md'
+    write_chat(chat, "# %User\nHello\n")
+    llmd_main.read_and_write_response(chat)
+    with open(chat, 'a') as file:
+        file.write("\n\n# %User\nAnd then?\n")
+    llmd_main.read_and_write_response(chat)
+
+    content = chat.read_text()
+    assert content.endswith(
+        "# %User\nAnd then?\n"
+        "\n\n# %Assistant\n<!--llm model: alpha llm-->\n\nalpha saw alpha saw nothing"
+        "\n\n# %Assistant\n<!--llm model: beta llm-->\n\nbeta saw beta saw nothing"
+    )
+
+
+def test_a_failing_model_does_not_stop_the_others(workdir):
+    chat = workdir / 'chat.md'
+    write_chat(chat, "# %User\nHello\n", beta_fail='true')
+
+    with pytest.raises(RuntimeError, match='1 of 2 models failed: beta'):
+        llmd_main.read_and_write_response(chat)
+    assert chat.read_text().endswith("<!--llm model: alpha llm-->\n\nalpha saw nothing")
+
+
+def test_no_new_prompts(workdir, capsys):
+    chat = workdir / 'chat.md'
+    write_chat(chat, "# %User\nHello\n# %Assistant\nHi\n")
+    llmd_main.read_and_write_response(chat)
+    assert 'No new prompts.' in capsys.readouterr().out
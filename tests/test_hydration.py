@@ -0,0 +1,98 @@
+import base64
+import pytest
+import tempfile
+import threading
+import time
+from pathlib import Path
+import llm_tool.hydration as hydration
+from llm_tool.hydration import hydrate_conversation
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        temp_dir = Path(tmpdirname)
+        (temp_dir / "a.txt").write_text("alpha\n")
+        (temp_dir / "b.txt").write_text("beta")
+        (temp_dir / "cats.png").write_bytes(b"cats")
+        yield temp_dir
+
+
+def make_conversation(temp_dir):
+    return [
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': 'Compare'},
+            {'type': 'link', 'link': str(temp_dir / "a.txt")},
+            {'type': 'image', 'source': str(temp_dir / "cats.png")},
+            {'type': 'link', 'link': str(temp_dir / "b.txt")},
+        ]},
+        {'role': 'assistant', 'content': 'Done'},
+        {'role': 'user', 'content': [
+            {'type': 'link', 'link': str(temp_dir / "a.txt")},
+            {'type': 'text', 'text': 'Again'},
+        ]},
+    ]
+
+
+def test_hydrate_conversation_keeps_order(temp_dir):
+    result = hydrate_conversation(make_conversation(temp_dir), temp_dir)
+    assert result[0]['content'] == [
+        {'type': 'text', 'text': 'Compare'},
+        {'type': 'text', 'text': 'alpha'},
+        {'type': 'image', 'source': {
+            'type': 'base64', 'media_type': 'image/png', 'data': base64.b64encode(b"cats").decode('utf-8'),
+        }},
+        {'type': 'text', 'text': 'beta'},
+    ]
+    assert result[1] == {'role': 'assistant', 'content': 'Done'}
+    assert result[2]['content'] == [{'type': 'text', 'text': 'alpha'}, {'type': 'text', 'text': 'Again'}]
+
+
+def test_hydrate_conversation_links_only(temp_dir):
+    result = hydrate_conversation(make_conversation(temp_dir), temp_dir, images=False)
+    assert result[0]['content'][2] == {'type': 'image', 'source': str(temp_dir / "cats.png")}
+    assert result[0]['content'][1] == {'type': 'text', 'text': 'alpha'}
+
+
+def test_hydrate_conversation_reads_each_file_once(temp_dir, monkeypatch):
+    reads = []
+    read_link = hydration._read_link
+
+    def counting_read(path, *args):
+        reads.append(path)
+        return read_link(path, *args)
+
+    monkeypatch.setattr(hydration, '_read_link', counting_read)
+    hydrate_conversation(make_conversation(temp_dir), temp_dir, images=False)
+    assert sorted(reads) == [str(temp_dir / "a.txt"), str(temp_dir / "b.txt")]
+
+
+def test_hydrate_conversation_reads_concurrently(temp_dir, monkeypatch):
+    n_files = 8
+    barrier = threading.Barrier(n_files, timeout=5)
+
+    def slow_read(path, *args):
+        # Only returns once every file is being read at the same time
+        barrier.wait()
+        return Path(path).name
+
+    monkeypatch.setattr(hydration, '_read_link', slow_read)
+    conversation = [{'role': 'user', 'content': [
+        {'type': 'link', 'link': str(temp_dir / f"{i}.txt")} for i in range(n_files)
+    ]}]
+    start = time.perf_counter()
+    result = hydrate_conversation(conversation, temp_dir, max_workers=n_files)
+    assert time.perf_counter() - start < 5
+    assert [chunk['text'] for chunk in result[0]['content']] == [f"{i}.txt" for i in range(n_files)]
+
+
+def test_hydrate_conversation_skips_encoded_images(temp_dir):
+    source = {'type': 'base64', 'media_type': 'image/png', 'data': 'Y2F0cw=='}
+    conversation = [{'role': 'user', 'content': [{'type': 'image', 'source': source}]}]
+    assert hydrate_conversation(conversation, temp_dir)[0]['content'][0]['source'] is source
+
+
+def test_hydrate_conversation_missing_file(temp_dir):
+    conversation = [{'role': 'user', 'content': [{'type': 'link', 'link': str(temp_dir / "gone.txt")}]}]
+    with pytest.raises(FileNotFoundError):
+        hydrate_conversation(conversation, temp_dir)
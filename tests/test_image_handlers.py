@@ -0,0 +1,109 @@
+import base64
+import os
+import pytest
+import tempfile
+import tracemalloc
+from pathlib import Path
+import llm_tool.image_handlers as image_handlers
+from llm_tool.image_handlers import EncodedImageCache, get_base64, add_image_data_to_conversation
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname)
+
+
+@pytest.fixture(autouse=True)
+def empty_memory_cache():
+    image_handlers._memory_cache.clear()
+    image_handlers._memory_cache_chars = 0
+    yield
+    image_handlers._memory_cache.clear()
+    image_handlers._memory_cache_chars = 0
+
+
+@pytest.fixture
+def count_encodings(monkeypatch):
+    calls = []
+    encode = image_handlers._encode_in_chunks
+
+    def counting_encode(filepath, sink=None):
+        calls.append(filepath)
+        return encode(filepath, sink)
+
+    monkeypatch.setattr(image_handlers, '_encode_in_chunks', counting_encode)
+    return calls
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, image_handlers._ENCODE_CHUNK_BYTES + 1, 2 * image_handlers._ENCODE_CHUNK_BYTES])
+def test_get_base64_matches_b64encode(temp_dir, size):
+    image = temp_dir / "image.png"
+    data = os.urandom(size)
+    image.write_bytes(data)
+    assert get_base64(image) == base64.b64encode(data).decode('utf-8')
+
+
+@pytest.mark.parametrize("disk_cache", [False, True])
+def test_get_base64_holds_one_copy_of_the_encoding(temp_dir, disk_cache):
+    cache = None
+    if disk_cache:
+        cache = EncodedImageCache(temp_dir / "cache")
+        cache.cache_dir.mkdir()
+    image = temp_dir / "image.png"
+    image.write_bytes(os.urandom(4 * image_handlers._ENCODE_CHUNK_BYTES))
+
+    tracemalloc.start()
+    try:
+        encoded = get_base64(image, cache=cache)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1.5 * len(encoded)
+
+
+def test_get_base64_memory_cache(temp_dir, count_encodings):
+    image = temp_dir / "image.png"
+    image.write_bytes(b"png bytes")
+    assert get_base64(image) == get_base64(str(image))
+    assert len(count_encodings) == 1
+
+
+def test_get_base64_changed_file_is_reencoded(temp_dir, count_encodings):
+    image = temp_dir / "image.png"
+    image.write_bytes(b"first")
+    get_base64(image)
+    image.write_bytes(b"second version")
+    assert get_base64(image) == base64.b64encode(b"second version").decode('utf-8')
+    assert len(count_encodings) == 2
+
+
+def test_get_base64_disk_cache_across_runs(temp_dir, count_encodings):
+    cache = EncodedImageCache(temp_dir / "cache")
+    cache.cache_dir.mkdir()
+    image = temp_dir / "image.png"
+    image.write_bytes(b"png bytes")
+
+    encoded = get_base64(image, cache=cache)
+    assert len(list(cache.cache_dir.glob('*.b64'))) == 1
+
+    # A new run starts with an empty memory cache
+    image_handlers._memory_cache.clear()
+    assert get_base64(image, cache=cache) == encoded
+    assert len(count_encodings) == 1
+
+
+def test_add_image_data_encodes_repeated_images_once(temp_dir, count_encodings):
+    image = temp_dir / "cats.png"
+    image.write_bytes(b"cats")
+    conversation = [
+        {'role': 'user', 'content': [{'type': 'image', 'source': str(image)}]},
+        {'role': 'assistant', 'content': 'Two cats'},
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'Again'}, {'type': 'image', 'source': str(image)}]},
+    ]
+    result = add_image_data_to_conversation(conversation, temp_dir)
+    assert result[0]['content'][0]['source'] == {
+        'type': 'base64', 'media_type': 'image/png', 'data': base64.b64encode(b"cats").decode('utf-8'),
+    }
+    assert result[2]['content'][1]['source'] == result[0]['content'][0]['source']
+    assert len(count_encodings) == 1
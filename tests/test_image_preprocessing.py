@@ -0,0 +1,156 @@
+import base64
+import pytest
+import tempfile
+from pathlib import Path
+import llm_tool.image_handlers as image_handlers
+import llm_tool.image_preprocessing as image_preprocessing
+from llm_tool.image_handlers import add_image_data_to_conversation
+from llm_tool.image_preprocessing import media_type_for, preprocess_images, sniff_media_type
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname)
+
+
+@pytest.fixture
+def cache_dir(temp_dir):
+    cache_dir = temp_dir / "preprocessed"
+    cache_dir.mkdir()
+    return cache_dir
+
+
+def make_image(path, size=(64, 48), image_format=None, color=(200, 30, 30)):
+    Image.new('RGB', size, color).save(path, format=image_format)
+    return path
+
+
+@pytest.mark.parametrize("image_format, media_type", [
+    ('PNG', 'image/png'),
+    ('JPEG', 'image/jpeg'),
+    ('GIF', 'image/gif'),
+    ('WEBP', 'image/webp'),
+])
+def test_sniff_media_type(temp_dir, image_format, media_type):
+    image = make_image(temp_dir / "image", image_format=image_format)
+    assert sniff_media_type(image) == media_type
+
+
+def test_media_type_ignores_wrong_suffix(temp_dir):
+    image = make_image(temp_dir / "photo.png", image_format='JPEG')
+    assert media_type_for(image) == 'image/jpeg'
+
+
+def test_media_type_falls_back_to_suffix(temp_dir):
+    image = temp_dir / "photo.jpg"
+    image.write_bytes(b"not an image")
+    assert sniff_media_type(image) is None
+    assert media_type_for(image) == 'image/jpeg'
+
+
+def test_preprocess_downscales_keeping_aspect_ratio(temp_dir, cache_dir):
+    image = make_image(temp_dir / "big.png", size=(400, 200))
+    results = preprocess_images([image], cache_dir, max_dimension=100)
+    output_path, media_type = results[str(image)]
+    assert media_type == 'image/png'
+    with Image.open(output_path) as output:
+        assert output.size == (100, 50)
+
+
+def test_preprocess_converts_format(temp_dir, cache_dir):
+    image = make_image(temp_dir / "big.png", size=(400, 200))
+    output_path, media_type = preprocess_images([image], cache_dir, max_dimension=100, image_format='jpeg')[str(image)]
+    assert media_type == 'image/jpeg'
+    assert output_path.endswith('.jpg')
+    assert sniff_media_type(output_path) == 'image/jpeg'
+
+
+def test_preprocess_keeps_small_image_bytes(temp_dir, cache_dir):
+    image = make_image(temp_dir / "small.jpg", size=(10, 10), image_format='JPEG')
+    output_path, media_type = preprocess_images([image], cache_dir, max_dimension=100, quality=100)[str(image)]
+    assert media_type == 'image/jpeg'
+    assert Path(output_path).read_bytes() == image.read_bytes()
+
+
+def test_preprocess_cache_hit(temp_dir, cache_dir, monkeypatch):
+    image = make_image(temp_dir / "big.png", size=(400, 200))
+    first = preprocess_images([image], cache_dir, max_dimension=100)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached image was processed again")
+
+    monkeypatch.setattr(image_preprocessing, '_preprocess_one', fail)
+    assert preprocess_images([image], cache_dir, max_dimension=100) == first
+
+
+def test_preprocess_settings_are_part_of_key(temp_dir, cache_dir):
+    image = make_image(temp_dir / "big.png", size=(400, 200))
+    small, _ = preprocess_images([image], cache_dir, max_dimension=100)[str(image)]
+    smaller, _ = preprocess_images([image], cache_dir, max_dimension=50)[str(image)]
+    assert small != smaller
+    with Image.open(smaller) as output:
+        assert output.size == (50, 25)
+
+
+def test_preprocess_several_images_in_process_pool(temp_dir, cache_dir):
+    images = [
+        make_image(temp_dir / f"image_{i}.png", size=(300, 300), color=(i * 40, 0, 0))
+        for i in range(4)
+    ]
+    results = preprocess_images(images + images[:1], cache_dir, max_dimension=60, max_workers=2)
+    assert set(results) == {str(image) for image in images}
+    for output_path, media_type in results.values():
+        assert media_type == 'image/png'
+        with Image.open(output_path) as output:
+            assert output.size == (60, 60)
+
+
+def test_add_image_data_with_preprocessing(temp_dir, cache_dir):
+    image_handlers._memory_cache.clear()
+    image = make_image(temp_dir / "photo.png", size=(400, 200), image_format='JPEG')
+    conversation = [{'role': 'user', 'content': [{'type': 'image', 'source': 'photo.png'}]}]
+    preprocess = {'cache_dir': cache_dir, 'max_dimension': 100, 'image_format': None, 'quality': 85}
+    result = add_image_data_to_conversation(conversation, temp_dir, preprocess=preprocess)
+    source = result[0]['content'][0]['source']
+    assert source['media_type'] == 'image/jpeg'
+    processed = temp_dir / "processed.jpg"
+    processed.write_bytes(base64.b64decode(source['data']))
+    with Image.open(processed) as output:
+        assert output.size == (100, 50)
+
+
+def test_preprocess_applies_exif_orientation(temp_dir, cache_dir):
+    image = temp_dir / "portrait.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    Image.new('RGB', (40, 20), (200, 30, 30)).save(image, format='JPEG', exif=exif)
+
+    output_path, media_type = preprocess_images([image], cache_dir, max_dimension=100)[str(image)]
+    assert media_type == 'image/jpeg'
+    with Image.open(output_path) as output:
+        assert output.size == (20, 40)
+        assert output.getexif().get(0x0112, 1) == 1
+
+
+def test_preprocess_treats_mpo_as_jpeg(temp_dir, cache_dir):
+    image = temp_dir / "phone.jpg"
+    frames = [Image.new('RGB', (400, 200), color) for color in [(200, 30, 30), (30, 200, 30)]]
+    frames[0].save(image, format='MPO', save_all=True, append_images=frames[1:])
+    with Image.open(image) as opened:
+        assert opened.format == 'MPO'
+
+    output_path, media_type = preprocess_images([image], cache_dir, max_dimension=100)[str(image)]
+    assert media_type == 'image/jpeg'
+    assert sniff_media_type(output_path) == 'image/jpeg'
+
+
+def test_preprocess_cache_is_evicted(temp_dir, cache_dir):
+    images = [make_image(temp_dir / f"image{i}.png", size=(400, 200), color=(i, 0, 0)) for i in range(3)]
+    for image in images:
+        preprocess_images([image], cache_dir, max_dimension=100, max_cache_mb=0)
+    # Only the output in use is kept
+    [kept] = cache_dir.iterdir()
+    assert preprocess_images([images[-1]], cache_dir, max_dimension=100, max_cache_mb=0)[str(images[-1])][0] == str(kept)
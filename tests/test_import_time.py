@@ -0,0 +1,66 @@
+"""Startup regressions: heavy imports and side effects must stay off the import path."""
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+import pytest
+
+# Cumulative import time allowed for llm_tool.__main__, in microseconds.
+# Importing anthropic or llm alone takes several times this.
+STARTUP_BUDGET_US = 300_000
+
+HEAVY_MODULES = {'anthropic', 'llm', 'dotenv', 'openai', 'httpx'}
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname)
+
+
+def run_python(code: str, cwd: Path, config_dir: Path, *flags: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, llmd_config_dir=str(config_dir))
+    return subprocess.run(
+        [sys.executable, *flags, '-c', code],
+        cwd=cwd, env=env, capture_output=True, text=True, check=True,
+    )
+
+
+def parse_importtime(stderr: str) -> dict[str, int]:
+    """Map module name to cumulative import time in microseconds"""
+    cumulative = dict()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, module = line[len('import time:'):].split('|')
+        cumulative[module.strip()] = int(cumulative_us)
+    return cumulative
+
+
+def test_import_main_within_budget(temp_dir):
+    result = run_python('import llm_tool.__main__', temp_dir, temp_dir / 'config', '-X', 'importtime')
+    imports = parse_importtime(result.stderr)
+
+    assert 'llm_tool.__main__' in imports
+    assert HEAVY_MODULES.isdisjoint(imports)
+    assert imports['llm_tool.__main__'] < STARTUP_BUDGET_US
+
+
+def test_import_has_no_side_effects(temp_dir):
+    config_dir = temp_dir / 'config'
+    run_python('import llm_tool.__main__', temp_dir, config_dir)
+    assert not config_dir.exists()
+
+
+def test_new_file_does_not_import_sdks(temp_dir):
+    (temp_dir / 'llmd_config.yaml').write_text('editor_cmd: null\n')
+    code = (
+        'import sys\n'
+        'from llm_tool.__main__ import main\n'
+        'main("new_chat.md")\n'
+        'print(sorted(m for m in sys.modules if m.split(".")[0] in %r))\n' % (HEAVY_MODULES,)
+    )
+    result = run_python(code, temp_dir, temp_dir / 'config')
+    assert (temp_dir / 'new_chat.md').read_text().startswith('---\n')
+    assert result.stdout.strip().endswith('[]')
@@ -0,0 +1,171 @@
+import pytest
+import tempfile
+from pathlib import Path
+import llm_tool.incremental_parser as incremental_parser
+from llm_tool.incremental_parser import parse_conversation_incremental, sidecar_index_path
+from llm_tool.parser import parse_conversation
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname)
+
+
+@pytest.fixture
+def count_parses(monkeypatch):
+    """The text of each turn parsed by parse_conversation_incremental"""
+    calls = []
+    parse_turn = incremental_parser._parse_scanned_turn
+
+    def counting_parse_turn(turn, **kwargs):
+        calls.append(turn['text'])
+        return parse_turn(turn, **kwargs)
+
+    def counting_parse(file_contents, **kwargs):
+        calls.append(file_contents)
+        return parse_conversation(file_contents, **kwargs)
+
+    monkeypatch.setattr(incremental_parser, '_parse_scanned_turn', counting_parse_turn)
+    monkeypatch.setattr(incremental_parser, 'parse_conversation', counting_parse)
+    return calls
+
+
+def make_transcript(n_turns):
+    return ''.join(
+        f"# %User\nQuestion {i}\n\n# %Assistant\nAnswer {i}\n\n" for i in range(n_turns)
+    )
+
+
+@pytest.mark.parametrize("content", [
+    "",
+    "preamble only",
+    "# %User\nHello\n# %Assistant\nHi there\n# %User\nBye",
+    "intro text\n# %User\nHello\n\n<!--llm # %Assistant\nhidden llm-->\n# %Assistant\nHi",
+    "# %User\nHello <!--llm unterminated\n# %Assistant\nHi",
+    "# %User\nHello\n# %Userx not a header\n# %Assistant\nHi",
+    make_transcript(20),
+])
+def test_matches_parse_conversation(temp_dir, content):
+    index_path = temp_dir / "index.json"
+    expected = parse_conversation(content, ignore_links=True)
+    assert parse_conversation_incremental(content, index_path, ignore_links=True) == expected
+    # Second run from the index
+    assert parse_conversation_incremental(content, index_path, ignore_links=True) == expected
+
+
+def test_appended_turns_only_parse_the_tail(temp_dir, count_parses):
+    index_path = temp_dir / "index.json"
+    content = make_transcript(50)
+    parse_conversation_incremental(content, index_path)
+    count_parses.clear()
+
+    content += "# %User\nNew question\n"
+    result = parse_conversation_incremental(content, index_path)
+    assert result == parse_conversation(content)
+    # The last indexed turn is re-scanned but not parsed; the new turn is parsed
+    assert count_parses == ["New question\n"]
+
+
+def test_earlier_edit_is_detected(temp_dir, count_parses):
+    index_path = temp_dir / "index.json"
+    content = make_transcript(10)
+    parse_conversation_incremental(content, index_path)
+    count_parses.clear()
+
+    edited = content.replace("Answer 3\n", "Edited answer\n")
+    result = parse_conversation_incremental(edited, index_path)
+    assert result == parse_conversation(edited)
+    assert count_parses == ["Edited answer\n\n"]
+
+
+def test_last_header_removed(temp_dir):
+    index_path = temp_dir / "index.json"
+    content = "# %User\nHello\n# %Assistant\nHi\n"
+    parse_conversation_incremental(content, index_path)
+    edited = "# %User\nHello\n Hi\n"
+    assert parse_conversation_incremental(edited, index_path) == parse_conversation(edited)
+
+
+def test_closing_a_stray_comment(temp_dir):
+    index_path = temp_dir / "index.json"
+    content = "# %User\nHello <!--llm\n# %Assistant\nHi\n"
+    parse_conversation_incremental(content, index_path)
+    edited = content + "llm-->\n# %User\nAgain\n"
+    assert parse_conversation_incremental(edited, index_path) == parse_conversation(edited)
+
+
+def test_reused_turns_are_independent_copies(temp_dir):
+    index_path = temp_dir / "index.json"
+    content = "# %User\nSame\n# %Assistant\nOk\n# %User\nSame\n"
+    result = parse_conversation_incremental(content, index_path)
+    result['conversation'][0]['content'][0]['text'] = 'changed'
+    assert result['conversation'][2]['content'][0]['text'] == 'Same'
+
+
+def test_options_change_invalidates_index(temp_dir):
+    index_path = temp_dir / "index.json"
+    (temp_dir / "file.txt").write_text("contents")
+    content = "# %User\nSee [file](file.txt)\n"
+    parse_conversation_incremental(content, index_path, base_path=temp_dir, ignore_links=True)
+    result = parse_conversation_incremental(content, index_path, base_path=temp_dir)
+    assert result == parse_conversation(content, base_path=temp_dir)
+
+
+def test_sidecar_index_path():
+    assert sidecar_index_path(Path("/notes/chat.md")) == Path("/notes/.chat.md.llmd-index.json")
+
+
+def test_index_holds_only_boundaries_and_hashes(temp_dir, count_parses, monkeypatch):
+    index_path = temp_dir / "index.json"
+    content = make_transcript(50).replace("\n\n# %User", "\n" + "x" * 1000 + "\n\n# %User")
+    parse_conversation_incremental(content, index_path)
+    assert "Question" not in index_path.read_text()
+    assert index_path.stat().st_size < len(content) / 5
+
+    # The parsed turns are on disk, so the next run, in a new process,
+    # only scans and parses the tail
+    scans = []
+    scan = incremental_parser.scan_conversation
+    monkeypatch.setattr(incremental_parser, 'scan_conversation', lambda body: scans.append(len(body)) or scan(body))
+    count_parses.clear()
+    content += "# %User\nNew question\n"
+    assert parse_conversation_incremental(content, index_path) == parse_conversation(content)
+    assert scans == [len(content) - content.index("# %Assistant\nAnswer 49")]
+    assert count_parses == ["New question\n"]
+
+
+def test_turn_file_is_appended_to_and_compacted(temp_dir):
+    index_path = temp_dir / "index.json"
+    turns_path = incremental_parser._turns_path(index_path)
+    content = make_transcript(5)
+    parse_conversation_incremental(content, index_path)
+    lines = turns_path.read_text().splitlines()
+    assert len(lines) == 1 + 10
+
+    content += "# %User\nNew question\n"
+    parse_conversation_incremental(content, index_path)
+    assert turns_path.read_text().splitlines()[:len(lines)] == lines
+    assert len(turns_path.read_text().splitlines()) == 1 + 11
+
+    # Every turn edited: appended while at most half the file is stale,
+    # then rewritten with only the turns in use
+    for edit in ["Edited", "Edited again"]:
+        edited = content.replace("Question", f"{edit} question").replace("Answer", f"{edit} answer")
+        assert parse_conversation_incremental(edited, index_path) == parse_conversation(edited)
+        assert len(turns_path.read_text().splitlines()) == (1 + 21 if edit == "Edited" else 1 + 11)
+
+
+@pytest.mark.parametrize("damage", ["", "not json\n", "cut short"])
+def test_damaged_turn_file_is_rebuilt(temp_dir, damage):
+    index_path = temp_dir / "index.json"
+    turns_path = incremental_parser._turns_path(index_path)
+    content = make_transcript(5)
+    parse_conversation_incremental(content, index_path)
+    if damage == "cut short":
+        turns_path.write_text(turns_path.read_text()[:-20])
+    else:
+        turns_path.write_text(damage)
+    assert parse_conversation_incremental(content, index_path) == parse_conversation(content)
+    assert len(turns_path.read_text().splitlines()) == 1 + 10
+    assert parse_conversation_incremental(content, index_path) == parse_conversation(content)
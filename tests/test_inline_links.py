@@ -2,7 +2,9 @@ import pytest
 import tempfile
 import os
 from pathlib import Path
-from llm_tool.inline_links import _convert_link_to_full_text, replace_links_with_file_contents
+from llm_tool.inline_links import _convert_link_to_full_text, replace_links_with_file_contents, read_text_capped, link_byte_limits
+from llm_tool import DEFAULT_CONFIG
+from llm_tool.hydration import hydrate_conversation
 
 @pytest.fixture
 def temp_dir():
@@ -99,3 +101,89 @@ def test_replace_links_with_file_contents_no_links(temp_dir):
     result = replace_links_with_file_contents(conversation, temp_dir)
     assert result == conversation
 
+
+
+@pytest.fixture
+def log_file(temp_dir):
+    path = Path(temp_dir) / "big.log"
+    path.write_text("".join(f"line {i}\n" for i in range(10_000)))
+    return path
+
+
+def test_read_text_capped_small_file(temp_dir):
+    assert read_text_capped(Path(temp_dir) / "file1.txt", max_bytes=100) == "hello"
+
+
+@pytest.mark.parametrize("excerpt", ['head', 'tail', 'head_tail'])
+def test_read_text_capped_respects_max_bytes(log_file, excerpt):
+    text = read_text_capped(log_file, max_bytes=1000, excerpt=excerpt)
+    assert "not included" in text
+    assert "big.log" in text
+    assert len(text) < 1200
+
+
+def test_read_text_capped_head(log_file):
+    text = read_text_capped(log_file, max_bytes=1000, excerpt='head')
+    assert text.startswith("line 0\n")
+    assert "line 9999" not in text
+    # Cut at the end of a line
+    assert text.split("\n\n[...")[0].endswith(tuple(f"line {i}" for i in range(200)))
+
+
+def test_read_text_capped_tail(log_file):
+    text = read_text_capped(log_file, max_bytes=1000, excerpt='tail')
+    assert text.startswith("[... first ")
+    assert text.endswith("line 9999")
+    assert "\nline 0\n" not in text
+
+
+def test_read_text_capped_head_tail(log_file):
+    text = read_text_capped(log_file, max_bytes=1000, excerpt='head_tail')
+    assert text.startswith("line 0\n")
+    assert text.endswith("line 9999")
+    assert "from the middle of big.log not included" in text
+
+
+def test_read_text_capped_split_character(temp_dir):
+    path = Path(temp_dir) / "accents.txt"
+    path.write_text("é" * 1000)
+    text = read_text_capped(path, max_bytes=101, excerpt='head')
+    assert "�" not in text
+    assert text.startswith("é" * 50)
+
+
+def test_read_text_capped_binary(temp_dir):
+    path = Path(temp_dir) / "data.bin"
+    path.write_bytes(b"\x00\x01\x02" * 100)
+    assert read_text_capped(path) is None
+    assert "binary file" in _convert_link_to_full_text({"type": "link", "link": str(path)})["text"]
+
+
+def test_read_text_capped_bad_excerpt(temp_dir):
+    with pytest.raises(ValueError):
+        read_text_capped(Path(temp_dir) / "file1.txt", excerpt='middle')
+
+
+def test_link_byte_limits():
+    assert link_byte_limits(None) == (None, None)
+    assert link_byte_limits({'max_bytes': 10_000, 'max_tokens': 1000}) == (4000, None)
+    assert link_byte_limits({'max_bytes': 1000, 'max_tokens': 1000, 'max_total_tokens': 100}) == (1000, 400)
+
+
+def test_default_link_budget_includes_files_in_full(temp_dir):
+    big = Path(temp_dir) / "big.txt"
+    big.write_text("x" * 1_000_000)
+    conversation = [{"role": "user", "content": [{"type": "link", "link": str(big)}]}]
+    result = hydrate_conversation(conversation, temp_dir, link_budget=DEFAULT_CONFIG['link_budget'])
+    assert result[0]["content"][0]["text"] == "x" * 1_000_000
+
+
+def test_conversation_link_budget_goes_to_recent_links(temp_dir, log_file):
+    conversation = [
+        {"role": "user", "content": [{"type": "link", "link": str(Path(temp_dir) / "file1.txt")}]},
+        {"role": "assistant", "content": "Ok"},
+        {"role": "user", "content": [{"type": "link", "link": str(log_file)}]},
+    ]
+    result = hydrate_conversation(conversation, temp_dir, link_budget={'max_bytes': 1000, 'max_total_bytes': 1000})
+    assert "line 0" in result[2]["content"][0]["text"]
+    assert result[0]["content"][0]["text"] == "[... file1.txt not included: the link budget for this conversation is used up ...]"
@@ -0,0 +1,159 @@
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.context_window import estimate_turn_tokens
+from llm_tool.mapped_reader import (
+    map_file, parse_mapped_conversation, parse_mapped_header, read_mapped_turns, sha256_of,
+)
+from llm_tool.parser import parse_conversation
+from llm_tool.scanner import scan_boundaries, scan_conversation
+
+BODY = (
+    "intro\n# %User\nHéllo ☃\n<!--llm # %Assistant\nhidden llm-->\n"
+    "```\n# %Assistant\n```\n"
+    "# %Assistant\nHi\n# %Userx\n# %User\nSee [notes](notes.txt)\n"
+)
+
+
+@pytest.mark.parametrize('body', [
+    BODY, BODY.replace('\n', '\r\n'), "", "no turns", "# %User\nA <!--llm B\n# %Assistant\nHi",
+])
+def test_scan_boundaries_matches_scan_conversation(body):
+    scanned = scan_conversation(body)
+    expected = (scanned['boundaries'], scanned['has_stray_comment'])
+    assert scan_boundaries(body) == expected
+
+    prefix = "---\nmodel: x\n---\n"
+    encoded = (prefix + body).encode('utf-8')
+    boundaries, stray = scan_boundaries(encoded, len(prefix))
+    assert stray == expected[1]
+    assert [encoded[:b].decode('utf-8') for b in boundaries] == [prefix + body[:b] for b in expected[0]]
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+@pytest.mark.parametrize('ignore_links', [True, False])
+def test_parse_mapped_conversation_matches_parse_conversation(tmp_path, ignore_links, newline):
+    (tmp_path / 'notes.txt').write_text("Notes")
+    path = tmp_path / 'chat.md'
+    path.write_bytes(("---\nmodel: x\n---\n" + BODY).replace('\n', newline).encode('utf-8'))
+    expected = parse_conversation(BODY, base_path=tmp_path, ignore_links=ignore_links)
+    with map_file(path) as data:
+        header, body_start = parse_mapped_header(data)
+        parsed = parse_mapped_conversation(data, body_start, base_path=tmp_path, ignore_links=ignore_links)
+        assert not any('content' in turn for turn in parsed['conversation'])
+        assert [turn['tokens'] for turn in parsed['conversation']] == [
+            estimate_turn_tokens(turn) for turn in expected['conversation']
+            ]
+        read = read_mapped_turns(data, parsed['conversation'], base_path=tmp_path, ignore_links=ignore_links)
+    assert header == {'model': 'x'}
+    assert parsed['metadata'] == expected['metadata']
+    assert read == expected['conversation']
+
+
+def test_parse_mapped_header_without_a_header():
+    assert parse_mapped_header(b"# %User\nHi\n") == ({}, 0)
+    assert parse_mapped_header(b"---\n: [\n---\n# %User\n") == ({}, 0)
+
+
+def test_map_file_empty(tmp_path):
+    path = tmp_path / 'empty.md'
+    path.write_text('')
+    with map_file(path) as data:
+        assert data == b''
+        assert parse_mapped_conversation(data)['conversation'] == []
+
+
+def test_sha256_of_a_map(tmp_path, monkeypatch):
+    monkeypatch.setattr('llm_tool.mapped_reader._HASH_CHUNK', 4096)
+    content = bytes(range(256)) * 100
+    path = tmp_path / 'data'
+    path.write_bytes(content)
+    with map_file(path) as data:
+        assert sha256_of(data).hexdigest() == sha256_of(content).hexdigest()
+        assert sha256_of(data, 5000).hexdigest() == sha256_of(content[:5000]).hexdigest()
+        # Released pages are read again from the file
+        assert data[:10] == content[:10]
+
+
+class Echo(llm.Model):
+    """Answers with the last prompt, optionally editing the file first"""
+    model_id = 'echo'
+    edit = None
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        if self.edit:
+            self.edit()
+        yield f"echo: {prompt.prompt}"
+
+
+@pytest.fixture
+def mapped(monkeypatch, tmp_path):
+    """A chat that llmd reads through a memory map"""
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'llmd_config.yaml').write_text("mmap_min_mb: 0\n")
+    monkeypatch.setattr(llm, 'get_model', lambda name: Echo())
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    read_mapped = llmd_main._read_mapped_file
+    calls = []
+    monkeypatch.setattr(llmd_main, '_read_mapped_file', lambda *args: calls.append(args) or read_mapped(*args))
+    yield tmp_path / 'chat.md', calls
+
+
+@pytest.mark.parametrize('stream', ['true', 'false'])
+def test_mapped_file_is_answered(mapped, stream):
+    chat, calls = mapped
+    content = f"---\nmodel: echo\nstream: {stream}\npersist_conversation: true\n---\n# %User\nHéllo\n"
+    chat.write_text(content, encoding='utf-8')
+    llmd_main.read_and_write_response(chat)
+    assert calls
+
+    answered = chat.read_text(encoding='utf-8')
+    assert answered.startswith("---\nmodel: echo\nstream: " + stream + "\npersist_conversation: true\nllm_conversation_id: ")
+    assert answered.endswith("---\n# %User\nHéllo\n\n\n# %Assistant\n\necho: Héllo")
+
+
+def test_mapped_file_with_windows_newlines_is_answered(mapped):
+    chat, calls = mapped
+    chat.write_bytes(b"---\r\nmodel: echo\r\nstream: false\r\n---\r\n# %User\r\nHello\r\n")
+    llmd_main.read_and_write_response(chat)
+    assert calls
+    assert chat.read_bytes().endswith(b"# %User\r\nHello\r\n\n\n# %Assistant\n\necho: Hello")
+
+
+def test_mapped_conflict_writes_only_the_answer(mapped, monkeypatch):
+    chat, _ = mapped
+    chat.write_text("---\nmodel: echo\nstream: false\n---\n# %User\nHello\n")
+    monkeypatch.setattr(Echo, 'edit', staticmethod(lambda: chat.write_text("Replaced\n")))
+    llmd_main.read_and_write_response(chat)
+
+    assert chat.read_text() == "Replaced\n"
+    [side_file] = chat.parent.glob('chat.llmd-conflict-*.md')
+    assert side_file.read_text() == "\n\n# %Assistant\n\necho: Hello"
+
+
+def test_only_the_turns_sent_are_read(mapped, monkeypatch):
+    chat, _ = mapped
+    exchanges = "".join(f"# %User\nQuestion {i} {'x' * 400}\n# %Assistant\nAnswer {i} {'y' * 400}\n" for i in range(5))
+    chat.write_text(
+        "---\nmodel: echo\nstream: false\ncontext_window:\n  max_tokens: 500\n---\n" + exchanges + "# %User\nLast\n"
+        )
+    import llm_tool.mapped_reader as mapped_reader
+
+    read_spans = []
+    read_mapped_turns = mapped_reader.read_mapped_turns
+
+    def counting_read(data, conversation, **kwargs):
+        read_spans.extend(turn['span'] for turn in conversation)
+        return read_mapped_turns(data, conversation, **kwargs)
+
+    monkeypatch.setattr(mapped_reader, 'read_mapped_turns', counting_read)
+    llmd_main.read_and_write_response(chat)
+
+    assert len(read_spans) == 3
+    assert chat.read_text().endswith("# %User\nLast\n\n\n# %Assistant\n\necho: Last")
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.claude_vision as claude_vision
+import llm_tool.mock_models as mock_models
+from llm_tool.mock_models import (
+    MockAPIError, MockAnthropicClient, MockAsyncAnthropicClient,
+    mock_response_text, mock_settings, mock_stream,
+)
+
+FAST = {'ttft': 0, 'chunks_per_second': 0}
+
+
+def test_mock_response_text():
+    assert mock_response_text('What is 2 + 2?\nThanks', 14) == 'Mock answer to: What is 2 + 2?'
+    assert len(mock_response_text('Hi', 1000)) == 1000
+
+
+def test_mock_stream_chunks():
+    settings = mock_settings(dict(FAST, chunk_bytes=10, response_bytes=95))
+    chunks = list(mock_stream('Hi', settings))
+    assert len(chunks) == 10
+    assert ''.join(chunks) == mock_response_text('Hi', 95)
+
+
+def test_mock_stream_pacing():
+    settings = mock_settings({'ttft': 0.05, 'chunks_per_second': 100, 'chunk_bytes': 10, 'response_bytes': 50})
+    start = time.perf_counter()
+    stream = mock_stream('Hi', settings)
+    next(stream)
+    assert time.perf_counter() - start >= 0.05
+    list(stream)
+    # Four more chunks at 100 a second
+    assert time.perf_counter() - start >= 0.09
+
+
+def test_error_injection_is_repeatable():
+    def outcomes(seed):
+        results = []
+        for _ in range(20):
+            try:
+                list(mock_stream('Hi', mock_settings(dict(FAST, error_rate=0.5, seed=seed))))
+                results.append(True)
+            except MockAPIError:
+                results.append(False)
+        return results
+
+    first = outcomes(seed=7)
+    assert True in first and False in first
+    mock_models._rngs.clear()
+    assert outcomes(seed=7) == first
+
+
+def test_mock_anthropic_client():
+    client = MockAnthropicClient()
+    request = dict(
+        model='mock', max_tokens=100, system='Be brief',
+        messages=[{'role': 'user', 'content': [{'type': 'text', 'text': 'Hello there'}]}],
+        response_bytes=40, **FAST,
+    )
+    message = client.messages.create(**request)
+    assert message.content[0].text == mock_response_text('Hello there', 40)
+    assert message.usage.output_tokens == 10
+
+    with client.messages.stream(**request) as stream:
+        text = ''.join(stream.text_stream)
+        assert stream.get_final_message().content[0].text == text == message.content[0].text
+
+    with pytest.raises(MockAPIError):
+        client.messages.create(**dict(request, error_rate=1))
+
+
+def test_mock_async_anthropic_client():
+    client = MockAsyncAnthropicClient()
+    message = asyncio.run(client.messages.create(
+        model='mock', max_tokens=100, messages=[{'role': 'user', 'content': 'Hi'}], **FAST,
+    ))
+    assert message.content[0].text.startswith('Mock answer to: Hi')
+
+
+def test_get_client_for_mock_model():
+    assert isinstance(claude_vision.get_client({'model_name': 'mock'}), MockAnthropicClient)
+
+
+@pytest.fixture
+def workdir(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+
+
+def write_chat(path, prompt, stream=True, **options):
+    options = dict(FAST, response_bytes=30, **options)
+    lines = '\n'.join(f"  {key}: {value}" for key, value in options.items())
+    path.write_text(
+        f"---\nmodel: mock\nstream: {str(stream).lower()}\nimage_preprocess: null\n"
+        f"options:\n{lines}\n---\n# %User\n{prompt}\n"
+    )
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_read_and_write_response_with_mock_llm_model(workdir, stream):
+    chat = workdir / 'chat.md'
+    write_chat(chat, 'Hello', stream=stream)
+    llmd_main.read_and_write_response(chat)
+    assert chat.read_text().endswith("# %Assistant\n\n" + mock_response_text('Hello', 30))
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_mock_llm_model_errors(workdir, stream):
+    chat = workdir / 'chat.md'
+    write_chat(chat, 'Hello', stream=stream, error_rate=1)
+    before = chat.read_text()
+    with pytest.raises(llm.ModelError):
+        llmd_main.read_and_write_response(chat)
+    # The prompt is left unanswered, to be asked again
+    assert chat.read_text() == before
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_read_and_write_response_with_mock_anthropic_client(workdir, stream):
+    (workdir / 'cat.png').write_bytes(b'\x89PNG\r\n\x1a\n')
+    chat = workdir / 'chat.md'
+    write_chat(chat, 'Describe ![cat](cat.png)', stream=stream)
+    llmd_main.read_and_write_response(chat)
+    assert chat.read_text().endswith("# %Assistant\n\n" + mock_response_text('Describe', 30))
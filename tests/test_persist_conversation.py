@@ -0,0 +1,153 @@
+import llm
+import pytest
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.llm_conversation import llm_conversation, llm_conversation_stream
+from llm_tool.parser import parse_conversation, parse_markdown_with_yaml, set_yaml_header_value
+
+
+class Echo(llm.Model):
+    model_id = 'echo'
+    can_stream = True
+
+    def __init__(self):
+        self.sent = []
+
+    def execute(self, prompt, stream, response, conversation):
+        # The messages the model would be sent, as (role, text) pairs
+        self.sent.append([
+            (message.role, ''.join(getattr(part, 'text', None) or '' for part in message.parts))
+            for message in prompt.messages
+            ])
+        yield f"echo: {prompt.prompt}"
+
+
+@pytest.fixture
+def echo(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path))
+    model = Echo()
+    monkeypatch.setattr(llm, 'get_model', lambda name: model)
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    if not llm_conversation_module._supports_message_chains():
+        pytest.skip("this version of llm doesn't take a list of messages")
+    return model
+
+
+def make_config(persist=True, conversation_id=None):
+    return {
+        'model_name': 'echo', 'system_msg': 'Be brief', 'model_options': {},
+        'prompt_cache': False, 'persist_conversation': persist,
+        'llm_conversation_id': conversation_id,
+    }
+
+
+def history(sent):
+    return [turn for turn in sent if turn[0] != 'system']
+
+
+CONVERSATION = "# %User\nHello\n# %Assistant\nHi there\n# %User\nHow are you?\n"
+
+
+def test_history_is_sent_as_messages(echo):
+    response = llm_conversation(parse_conversation(CONVERSATION), make_config(persist=False))
+    assert response == "\n# %Assistant\n\necho: How are you?"
+    assert history(echo.sent[-1]) == [
+        ('user', 'Hello'), ('assistant', 'Hi there'), ('user', 'How are you?'),
+    ]
+
+
+def test_new_conversation_id_is_recorded(echo):
+    recorded = []
+    llm_conversation(parse_conversation(CONVERSATION), make_config(), on_new_conversation=recorded.append)
+    assert len(recorded) == 1
+    assert llm.cli.load_conversation(recorded[0]) is not None
+
+
+def test_persisted_conversation_is_reused(echo, capsys):
+    recorded = []
+    first = llm_conversation(parse_conversation(CONVERSATION), make_config(), on_new_conversation=recorded.append)
+    markdown = CONVERSATION + first + "\n# %User\nAnd now?\n"
+
+    chunks = llm_conversation_stream(
+        parse_conversation(markdown), make_config(conversation_id=recorded[0]),
+        on_new_conversation=recorded.append,
+        )
+    assert ''.join(chunks) == "\n# %Assistant\n\necho: And now?"
+    assert len(recorded) == 1
+    assert "Re-syncing" not in capsys.readouterr().out
+    assert history(echo.sent[-1]) == [
+        ('user', 'Hello'), ('assistant', 'Hi there'), ('user', 'How are you?'),
+        ('assistant', 'echo: How are you?'), ('user', 'And now?'),
+    ]
+
+
+def test_edited_turns_are_resynced(echo, capsys):
+    recorded = []
+    first = llm_conversation(parse_conversation(CONVERSATION), make_config(), on_new_conversation=recorded.append)
+    edited = CONVERSATION.replace('Hi there', 'Hi!') + first + "\n# %User\nAnd now?\n"
+
+    llm_conversation(parse_conversation(edited), make_config(conversation_id=recorded[0]))
+    assert "Re-syncing 2 turns with the llm log" in capsys.readouterr().out
+    assert history(echo.sent[-1]) == [
+        ('user', 'Hello'), ('assistant', 'Hi!'), ('user', 'How are you?'),
+        ('assistant', 'echo: How are you?'), ('user', 'And now?'),
+    ]
+
+
+def test_missing_conversation_starts_a_new_one(echo, capsys):
+    recorded = []
+    llm_conversation(
+        parse_conversation(CONVERSATION), make_config(conversation_id='not-logged'),
+        on_new_conversation=recorded.append,
+        )
+    assert "isn't in the llm logs" in capsys.readouterr().out
+    assert len(recorded) == 1
+
+
+def test_changed_model_is_used(echo, monkeypatch, capsys):
+    recorded = []
+    first = llm_conversation(parse_conversation(CONVERSATION), make_config(), on_new_conversation=recorded.append)
+    markdown = CONVERSATION + first + "\n# %User\nAnd now?\n"
+
+    other = Echo()
+    other.model_id = 'other'
+    monkeypatch.setattr(llm, 'get_model', lambda name: {'echo': echo, 'other': other}[name])
+    config = dict(make_config(conversation_id=recorded[0]), model_name='other')
+    llm_conversation(parse_conversation(markdown), config, on_new_conversation=recorded.append)
+    assert "Re-syncing" not in capsys.readouterr().out
+    assert len(echo.sent) == 1
+    assert history(other.sent[-1])[-2:] == [('assistant', 'echo: How are you?'), ('user', 'And now?')]
+    assert len(recorded) == 1
+
+
+class Failing(Echo):
+    model_id = 'failing'
+
+    def execute(self, prompt, stream, response, conversation):
+        raise llm.ModelError("Overloaded")
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_failed_request_records_no_conversation(echo, monkeypatch, stream):
+    monkeypatch.setattr(llm, 'get_model', lambda name: Failing())
+    recorded = []
+    ask = llm_conversation_stream if stream else llm_conversation
+    with pytest.raises(llm.ModelError):
+        result = ask(parse_conversation(CONVERSATION), make_config(), on_new_conversation=recorded.append)
+        if stream:
+            list(result)
+    assert recorded == []
+
+
+def test_set_yaml_header_value():
+    markdown = "---\nmodel: gpt-4o\n---\n# %User\nHi\n"
+    updated = set_yaml_header_value(markdown, 'llm_conversation_id', '01abc')
+    assert parse_markdown_with_yaml(updated) == ({'model': 'gpt-4o', 'llm_conversation_id': '01abc'}, "# %User\nHi\n")
+
+    replaced = set_yaml_header_value(updated, 'llm_conversation_id', '02def')
+    assert replaced == "---\nmodel: gpt-4o\nllm_conversation_id: 02def\n---\n# %User\nHi\n"
+
+
+def test_set_yaml_header_value_adds_header():
+    assert set_yaml_header_value("# %User\nHi\n", 'llm_conversation_id', 'abc') == (
+        "---\nllm_conversation_id: abc\n---\n# %User\nHi\n"
+    )
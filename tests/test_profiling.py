@@ -0,0 +1,101 @@
+import json
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.profiling import is_profiling, profiling, record, span
+
+
+class Echo(llm.Model):
+    model_id = 'echo'
+    can_stream = True
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        yield "echo: "
+        yield prompt.prompt
+        response.set_usage(input=12, output=3)
+
+
+def test_span_is_a_no_op_without_a_profile():
+    assert not is_profiling()
+    assert span('parse') is span('request')
+    with span('parse'):
+        record(bytes_sent=10)
+
+
+def test_profiling_collects_spans_and_metrics(capsys):
+    with profiling('chat.md', table=True) as profile:
+        assert is_profiling()
+        with span('parse'):
+            pass
+        with span('request'):
+            with span('write_file'):
+                pass
+        with span('parse'):
+            pass
+        record(bytes_sent=100, input_tokens=None)
+        record(bytes_sent=20)
+    assert not is_profiling()
+    assert list(profile.spans) == ['parse', 'request', 'write_file']
+    assert profile.metrics == {'bytes_sent': 120, 'input_tokens': None}
+    assert profile.total >= sum(profile.spans.values()) - profile.spans['write_file']
+
+    table = capsys.readouterr().err
+    assert table.startswith("Profile: chat.md\n  parse ")
+    assert "  bytes_sent                 120" in table
+    assert 'input_tokens' not in table
+
+
+def test_profiling_writes_json_lines(tmp_path, capsys):
+    json_path = tmp_path / 'profile.jsonl'
+    for label in ['a.md', 'b.md']:
+        with profiling(label, table=False, json_path=str(json_path)):
+            with span('parse'):
+                pass
+    assert capsys.readouterr().err == ''
+    lines = [json.loads(line) for line in json_path.read_text().splitlines()]
+    assert [line['label'] for line in lines] == ['a.md', 'b.md']
+    assert set(lines[0]) == {'label', 'total', 'spans'}
+    assert list(lines[0]['spans']) == ['parse']
+
+
+def test_profile_is_reported_when_the_run_fails(tmp_path):
+    json_path = tmp_path / 'profile.jsonl'
+    with pytest.raises(RuntimeError):
+        with profiling('chat.md', table=False, json_path=str(json_path)):
+            raise RuntimeError
+    assert json.loads(json_path.read_text())['label'] == 'chat.md'
+
+
+@pytest.fixture
+def echo(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm, 'get_model', lambda name: Echo())
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    yield
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_read_and_write_response_profile(echo, tmp_path, stream):
+    chat = tmp_path / 'chat.md'
+    chat.write_text(f"---\nmodel: echo\nsystem: Be brief\nstream: {str(stream).lower()}\n---\n# %User\nHello\n")
+    json_path = tmp_path / 'profile.jsonl'
+
+    llmd_main.read_and_write_response(chat, profile_json=str(json_path))
+
+    assert chat.read_text().endswith("# %Assistant\n\necho: Hello")
+    profile = json.loads(json_path.read_text())
+    assert profile['label'] == str(chat)
+    assert {'read_file', 'config', 'parse', 'hydrate', 'load_model', 'write_file'} <= set(profile['spans'])
+    assert profile['bytes_sent'] == len('Be brief') + len('Hello')
+    assert (profile['input_tokens'], profile['output_tokens']) == (12, 3)
+    if stream:
+        assert profile['time_to_first_token'] > 0
+        assert {'prepare_request', 'stream_response'} <= set(profile['spans'])
+    else:
+        assert 'request' in profile['spans']
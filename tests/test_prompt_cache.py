@@ -0,0 +1,154 @@
+import pytest
+from types import SimpleNamespace
+import llm_tool.claude_vision as claude_vision
+from llm_tool.claude_vision import claude_vision_conversation, claude_vision_conversation_stream
+from llm_tool.prompt_cache import add_cache_breakpoints, format_cache_usage, llm_cache_options
+
+EPHEMERAL = {'type': 'ephemeral'}
+
+
+def make_usage(read=0, written=0, uncached=10):
+    return SimpleNamespace(
+        input_tokens=uncached, output_tokens=5,
+        cache_read_input_tokens=read, cache_creation_input_tokens=written,
+    )
+
+
+class StubStream:
+    def __init__(self, message):
+        self.message = message
+        self.text_stream = iter(["Hi", " there"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def get_final_message(self):
+        return self.message
+
+
+class StubClient:
+    """Records the request payloads instead of calling the API"""
+
+    def __init__(self, usage):
+        self.requests = []
+        self.message = SimpleNamespace(content=[SimpleNamespace(text="Hi there")], usage=usage)
+        self.messages = self
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.message
+
+    def stream(self, **kwargs):
+        self.requests.append(kwargs)
+        return StubStream(self.message)
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    client = StubClient(make_usage(read=2048, written=100))
+    monkeypatch.setattr(claude_vision, 'get_client', lambda config=None: client)
+    return client
+
+
+def make_parsed():
+    return {'conversation': [
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'First question'}]},
+        {'role': 'assistant', 'content': 'First answer'},
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'Second question'}]},
+    ]}
+
+
+def make_config(prompt_cache=True):
+    return {
+        'model_name': 'claude-test', 'system_msg': 'A long system prompt',
+        'model_options': {'max_tokens': 100}, 'prompt_cache': prompt_cache,
+        'image_cache': False, 'image_preprocess': None,
+    }
+
+
+def test_request_has_cache_breakpoints(stub_client, capsys):
+    response = claude_vision_conversation(make_parsed(), '.', make_config())
+    assert response == "\n# %Assistant\n\nHi there"
+    [request] = stub_client.requests
+    assert request['system'] == [{'type': 'text', 'text': 'A long system prompt', 'cache_control': EPHEMERAL}]
+    assert request['messages'] == [
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'First question'}]},
+        {'role': 'assistant', 'content': [{'type': 'text', 'text': 'First answer', 'cache_control': EPHEMERAL}]},
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'Second question'}]},
+    ]
+    assert request['max_tokens'] == 100
+    assert "Prompt cache: 2048 tokens read, 100 written, 10 uncached" in capsys.readouterr().out
+
+
+def test_streamed_request_has_cache_breakpoints(stub_client, capsys):
+    chunks = list(claude_vision_conversation_stream(make_parsed(), '.', make_config()))
+    assert chunks == ["\n# %Assistant\n\n", "Hi", " there"]
+    [request] = stub_client.requests
+    assert request['system'][0]['cache_control'] == EPHEMERAL
+    assert request['messages'][1]['content'][0]['cache_control'] == EPHEMERAL
+    assert "Prompt cache: 2048 tokens read" in capsys.readouterr().out
+
+
+def test_prompt_cache_off(stub_client):
+    parsed = make_parsed()
+    claude_vision_conversation(parsed, '.', make_config(prompt_cache=False))
+    [request] = stub_client.requests
+    assert request['system'] == 'A long system prompt'
+    assert request['messages'] == parsed['conversation']
+
+
+def test_add_cache_breakpoints_does_not_modify_request():
+    request = {'system': 'S', 'messages': make_parsed()['conversation']}
+    add_cache_breakpoints(request)
+    assert request == {'system': 'S', 'messages': make_parsed()['conversation']}
+
+
+def test_add_cache_breakpoints_single_turn_and_empty_system():
+    request = {'system': '', 'messages': [{'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}]}]}
+    assert add_cache_breakpoints(request) == request
+
+
+def test_add_cache_breakpoints_marks_last_block_of_user_turn():
+    image = {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': 'Y2F0cw=='}}
+    messages = [
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'Look'}, image]},
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'And again'}]},
+    ]
+    cached = add_cache_breakpoints({'system': 'S', 'messages': messages})
+    assert cached['messages'][0]['content'][1] == {**image, 'cache_control': EPHEMERAL}
+    assert 'cache_control' not in cached['messages'][0]['content'][0]
+
+
+def test_format_cache_usage():
+    assert format_cache_usage(make_usage()) is None
+    assert format_cache_usage(None) is None
+    assert format_cache_usage({'cache_read_input_tokens': 5, 'input_tokens': 1}) == "Prompt cache: 5 tokens read, 0 written, 1 uncached"
+
+
+class ModelWithCache:
+    class Options:
+        model_fields = {'max_tokens': None, 'cache': None}
+
+
+class ModelWithoutCache:
+    class Options:
+        model_fields = {'max_tokens': None}
+
+
+def test_llm_cache_options():
+    config = {'prompt_cache': True, 'model_options': {}}
+    assert llm_cache_options(ModelWithCache(), config) == {'cache': True}
+    assert llm_cache_options(ModelWithoutCache(), config) == {}
+    assert llm_cache_options(ModelWithCache(), {'prompt_cache': False, 'model_options': {}}) == {}
+    assert llm_cache_options(ModelWithCache(), {'prompt_cache': True, 'model_options': {'cache': False}}) == {}
+
+
+def test_prompt_cache_defaults_to_on_without_the_default_config():
+    from llm_tool import DEFAULT_CONFIG
+    from llm_tool.config_and_system import get_config
+
+    config = {'model': 'claude-3-5-sonnet-latest', 'system': '', 'options': {}}
+    assert get_config([config])['prompt_cache'] is DEFAULT_CONFIG['prompt_cache'] is True
@@ -0,0 +1,244 @@
+import threading
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.mock_models import MockAPIError, MockNotFoundError
+from llm_tool.request_executor import (
+    LatencyHistory, call_with_policy, is_retryable, retry_after, stream_with_policy,
+)
+
+HEADER = "\n# %Assistant\n\n"
+FAST = {'backoff': 0, 'max_backoff': 0}
+
+
+def config(**policy):
+    return {'model_name': 'm', 'request_policy': dict(FAST, **policy)}
+
+
+class Flaky:
+    """Fails with the given errors, then answers"""
+
+    def __init__(self, *errors, answer="Hi"):
+        self.errors = list(errors)
+        self.answer = answer
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.answer
+
+
+def test_is_retryable():
+    assert is_retryable(MockAPIError("Overloaded"))
+    assert is_retryable(ConnectionResetError())
+    assert not is_retryable(MockNotFoundError("Model not found"))
+    # Through llm's wrapping of plugin errors
+    try:
+        raise llm.ModelError("Overloaded") from MockAPIError("Overloaded")
+    except llm.ModelError as e:
+        assert is_retryable(e)
+
+
+def test_retry_after():
+    class Response:
+        headers = {'retry-after': '2'}
+
+    error = MockAPIError("Overloaded")
+    error.response = Response()
+    assert retry_after(error) == 2
+    assert retry_after(MockAPIError("Overloaded")) is None
+
+    # A wrapping error with headers of its own but no retry-after
+    class NoRetryAfter:
+        headers = {'content-type': 'application/json'}
+
+    wrapper = llm.ModelError("Overloaded")
+    wrapper.response = NoRetryAfter()
+    wrapper.__cause__ = error
+    assert retry_after(wrapper) == 2
+
+
+def test_retryable_errors_are_retried(capsys):
+    call = Flaky(MockAPIError("Overloaded"), MockAPIError("Overloaded"))
+    assert call_with_policy(call, config(), LatencyHistory()) == "Hi"
+    assert call.calls == 3
+    assert capsys.readouterr().out.count("retrying in") == 2
+
+
+def test_attempts_run_out():
+    call = Flaky(*[MockAPIError(f"Overloaded {i}") for i in range(3)])
+    with pytest.raises(MockAPIError, match="Overloaded 1"):
+        call_with_policy(call, config(max_attempts=2), LatencyHistory())
+    assert call.calls == 2
+
+
+def test_other_errors_are_raised_at_once():
+    call = Flaky(MockNotFoundError("Model not found"))
+    with pytest.raises(MockNotFoundError):
+        call_with_policy(call, config(), LatencyHistory())
+    assert call.calls == 1
+
+
+def test_deadline():
+    stalled = threading.Event()
+    with pytest.raises(TimeoutError, match="within 0.1s"):
+        call_with_policy(lambda: stalled.wait(5), config(deadline=0.1), LatencyHistory())
+    stalled.set()
+
+
+def test_stalled_stream():
+    stalled = threading.Event()
+
+    def stream():
+        yield HEADER
+        yield "Hi"
+        stalled.wait(5)
+        yield " there"
+
+    received = []
+    with pytest.raises(TimeoutError, match="sent nothing"):
+        for chunk in stream_with_policy(stream, config(stall_timeout=0.1), LatencyHistory()):
+            received.append(chunk)
+    assert received == [HEADER, "Hi"]
+    stalled.set()
+
+
+def test_streams_are_retried_before_any_text():
+    attempts = []
+
+    def stream():
+        attempts.append(1)
+        yield HEADER
+        if len(attempts) == 1:
+            raise MockAPIError("Overloaded")
+        yield "Hi"
+
+    assert list(stream_with_policy(stream, config(), LatencyHistory())) == [HEADER, "Hi"]
+    assert len(attempts) == 2
+
+
+def test_streams_are_not_retried_after_text():
+    def stream():
+        yield HEADER
+        yield "Hi"
+        raise MockAPIError("Overloaded")
+
+    received = []
+    with pytest.raises(MockAPIError):
+        for chunk in stream_with_policy(stream, config(), LatencyHistory()):
+            received.append(chunk)
+    assert received == [HEADER, "Hi"]
+
+
+def slow_then_fast(released):
+    """A stream whose first request stalls and whose later ones answer at once"""
+    attempts = []
+
+    def stream():
+        attempts.append(1)
+        yield HEADER
+        if len(attempts) == 1:
+            released.wait(5)
+            yield "Slow"
+        yield "Fast"
+
+    return stream, attempts
+
+
+def test_slow_requests_are_hedged(capsys):
+    history = LatencyHistory()
+    for _ in range(5):
+        history.add('m', 'first_token', 0.05)
+    released = threading.Event()
+    stream, attempts = slow_then_fast(released)
+
+    chunks = list(stream_with_policy(stream, config(hedge=True, hedge_min_samples=5), history))
+    released.set()
+    assert chunks == [HEADER, "Fast"]
+    assert len(attempts) == 2
+    assert "sending the request again" in capsys.readouterr().out
+    assert len(history.samples('m', 'first_token')) == 6
+
+
+@pytest.mark.parametrize('settings', [
+    {'hedge': True, 'hedge_min_samples': 10},
+    {'hedge': True, 'hedge_min_samples': 5, 'persist_conversation': True},
+    {'hedge': False, 'hedge_min_samples': 5},
+])
+def test_requests_are_not_hedged(settings):
+    history = LatencyHistory()
+    for _ in range(5):
+        history.add('m', 'first_token', 0.01)
+    released = threading.Event()
+    stream, attempts = slow_then_fast(released)
+    threading.Timer(0.2, released.set).start()
+
+    persist = settings.pop('persist_conversation', False)
+    chunks = list(stream_with_policy(stream, dict(config(**settings), persist_conversation=persist), history))
+    assert chunks == [HEADER, "Slow", "Fast"]
+    assert len(attempts) == 1
+
+
+def test_latency_history_is_kept(tmp_path):
+    history = LatencyHistory(tmp_path / 'latency.json', max_samples=3)
+    for seconds in [1, 2, 3, 4]:
+        history.add('m', 'response', seconds)
+    history.add('m', 'first_token', 0.5)
+
+    again = LatencyHistory(tmp_path / 'latency.json', max_samples=3)
+    assert again.samples('m', 'response') == [2, 3, 4]
+    assert again.samples('m', 'first_token') == [0.5]
+    assert again.percentile('m', 'response', 50) == 3
+    assert again.percentile('other', 'response', 50) is None
+
+
+def test_failed_save_leaves_no_temp_file(tmp_path, monkeypatch, capsys):
+    def failing_replace(src, dst):
+        raise OSError("Disk full")
+
+    monkeypatch.setattr('llm_tool.request_executor.os.replace', failing_replace)
+    history = LatencyHistory(tmp_path / 'latency.json')
+    history.add('m', 'response', 1)
+    assert "Couldn't save the latency history: Disk full" in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
+
+
+class Overloaded(llm.Model):
+    """Overloaded on its first request"""
+    model_id = 'overloaded'
+    calls = 0
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        type(self).calls += 1
+        if self.calls == 1:
+            raise llm.ModelError("Overloaded") from MockAPIError("Overloaded")
+        yield f"answer to: {prompt.prompt}"
+
+
+@pytest.fixture
+def overloaded(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm, 'get_model', lambda name: Overloaded())
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    monkeypatch.setattr(Overloaded, 'calls', 0)
+    yield tmp_path
+
+
+@pytest.mark.parametrize('stream', ['true', 'false'])
+def test_overloaded_model_is_retried(overloaded, stream):
+    chat = overloaded / 'chat.md'
+    chat.write_text(
+        f"---\nmodel: overloaded\nstream: {stream}\nrequest_policy:\n  backoff: 0\n---\n# %User\nHello\n"
+    )
+    llmd_main.read_and_write_response(chat)
+    assert chat.read_text().endswith("# %User\nHello\n\n\n# %Assistant\n\nanswer to: Hello")
+    assert Overloaded.calls == 2
+    assert list((overloaded / 'config' / 'cache' / 'latency').glob('latency.json'))
@@ -0,0 +1,91 @@
+import os
+import pytest
+import tempfile
+import time
+from pathlib import Path
+from llm_tool.response_cache import ResponseCache, make_cache_key, store_streamed_response
+
+CONFIG = {'model_name': 'model-a', 'system_msg': 'Be brief', 'model_options': {'max_tokens': 100}}
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname)
+
+
+def make_parsed(*chunks):
+    return {'conversation': [{'role': 'user', 'content': list(chunks)}]}
+
+
+def test_make_cache_key_is_stable():
+    parsed = make_parsed({'type': 'text', 'text': 'Hello'})
+    assert make_cache_key(parsed, CONFIG) == make_cache_key(make_parsed({'type': 'text', 'text': 'Hello'}), dict(CONFIG))
+
+
+@pytest.mark.parametrize("changed_config", [
+    dict(CONFIG, model_name='model-b'),
+    dict(CONFIG, system_msg='Be verbose'),
+    dict(CONFIG, model_options={'max_tokens': 200}),
+])
+def test_make_cache_key_depends_on_config(changed_config):
+    parsed = make_parsed({'type': 'text', 'text': 'Hello'})
+    assert make_cache_key(parsed, CONFIG) != make_cache_key(parsed, changed_config)
+
+
+def test_make_cache_key_depends_on_image_bytes(temp_dir):
+    image = temp_dir / "cat.png"
+    image.write_bytes(b"first")
+    parsed = make_parsed({'type': 'image', 'source': str(image)})
+    first_key = make_cache_key(parsed, CONFIG)
+    image.write_bytes(b"second")
+    assert make_cache_key(parsed, CONFIG) != first_key
+
+
+def test_get_and_put(temp_dir):
+    cache = ResponseCache(temp_dir)
+    assert cache.get('abc') is None
+    cache.put('abc', "\n# %Assistant\n\nHi")
+    assert cache.get('abc') == "\n# %Assistant\n\nHi"
+
+
+def test_expired_entries_are_dropped(temp_dir):
+    cache = ResponseCache(temp_dir, max_age_days=1)
+    cache.put('old', "response")
+    two_days_ago = time.time() - 2 * 24 * 60 * 60
+    os.utime(temp_dir / 'old.md', (two_days_ago, two_days_ago))
+    assert cache.get('old') is None
+    assert not (temp_dir / 'old.md').exists()
+
+
+def test_least_recently_used_entries_are_evicted(temp_dir):
+    cache = ResponseCache(temp_dir, max_bytes=25)
+    an_hour_ago = time.time() - 60 * 60
+    for i, key in enumerate(['a', 'b']):
+        cache.put(key, "x" * 10)
+        os.utime(temp_dir / f'{key}.md', (an_hour_ago + i, an_hour_ago + i))
+    # Reading 'a' makes 'b' the least recently used entry
+    assert cache.get('a') is not None
+    cache.put('c', "x" * 10)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+
+def test_store_streamed_response(temp_dir):
+    cache = ResponseCache(temp_dir)
+    chunks = list(store_streamed_response(iter(["\n# %Assistant\n\n", "Hi", "!"]), cache, 'key'))
+    assert chunks == ["\n# %Assistant\n\n", "Hi", "!"]
+    assert cache.get('key') == "\n# %Assistant\n\nHi!"
+
+
+def test_interrupted_stream_is_not_stored(temp_dir):
+    cache = ResponseCache(temp_dir)
+
+    def chunks():
+        yield "\n# %Assistant\n\n"
+        raise ConnectionError("dropped")
+
+    with pytest.raises(ConnectionError):
+        list(store_streamed_response(chunks(), cache, 'key'))
+    assert cache.get('key') is None
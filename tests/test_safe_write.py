@@ -0,0 +1,179 @@
+import threading
+import time
+import llm
+import pytest
+import llm_tool.__main__ as llmd_main
+import llm_tool.llm_conversation as llm_conversation_module
+from llm_tool.__main__ import record_conversation_id, write_streamed_response
+from llm_tool.safe_write import file_lock, lock_path, read_with_snapshot, write_answer
+
+PROMPT = "---\nmodel: test\n---\n# %User\nHello\n"
+ANSWER = "\n# %Assistant\n\nHi"
+
+
+@pytest.fixture
+def chat(tmp_path):
+    path = tmp_path / 'chat.md'
+    path.write_text(PROMPT)
+    return path
+
+
+def side_files(chat):
+    return sorted(chat.parent.glob('chat.llmd-conflict-*.md'))
+
+
+def test_unchanged_file_is_appended_to(chat):
+    _, snapshot = read_with_snapshot(chat)
+    assert write_answer(chat, ANSWER, snapshot) == chat
+    assert chat.read_text() == PROMPT + ANSWER
+    assert write_answer(chat, ANSWER, snapshot) == chat
+    assert chat.read_text() == PROMPT + ANSWER + ANSWER
+
+
+def test_same_content_with_a_new_mtime_is_appended_to(chat):
+    _, snapshot = read_with_snapshot(chat)
+    chat.write_text(PROMPT + "\n\n")
+    write_answer(chat, ANSWER, snapshot)
+    assert chat.read_text() == PROMPT + "\n\n" + ANSWER
+
+
+def test_answer_is_reanchored_before_a_new_prompt(chat):
+    _, snapshot = read_with_snapshot(chat)
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nAnd another thing\n")
+
+    write_answer(chat, ANSWER, snapshot)
+    write_answer(chat, ANSWER.replace('Hi', 'Hey'), snapshot)
+    assert chat.read_text() == PROMPT + ANSWER + ANSWER.replace('Hi', 'Hey') + "\n\n# %User\nAnd another thing\n"
+    assert side_files(chat) == []
+
+
+def test_conflicting_edit_goes_to_a_side_file(chat):
+    _, snapshot = read_with_snapshot(chat)
+    chat.write_text(PROMPT.replace('Hello', 'Hello there'))
+
+    side_file = write_answer(chat, ANSWER, snapshot)
+    write_answer(chat, ANSWER, snapshot)
+    assert side_files(chat) == [side_file]
+    assert side_file.read_text() == PROMPT + ANSWER + ANSWER
+    assert chat.read_text() == PROMPT.replace('Hello', 'Hello there')
+
+
+def test_on_conflict_settings(chat):
+    _, snapshot = read_with_snapshot(chat)
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nMore\n")
+    assert write_answer(chat, ANSWER, snapshot, on_conflict='side_file') != chat
+
+    _, snapshot = read_with_snapshot(chat)
+    chat.write_text('Replaced')
+    assert write_answer(chat, ANSWER, snapshot, on_conflict='append') == chat
+    assert chat.read_text() == 'Replaced' + ANSWER
+
+    with pytest.raises(ValueError):
+        write_answer(chat, ANSWER, snapshot, on_conflict='merge')
+
+
+def test_deleted_file_goes_to_a_side_file(chat):
+    _, snapshot = read_with_snapshot(chat)
+    chat.unlink()
+    assert write_answer(chat, ANSWER, snapshot).read_text() == PROMPT + ANSWER
+
+
+def test_record_conversation_id_moves_the_snapshot(chat):
+    _, snapshot = read_with_snapshot(chat)
+    record_conversation_id(chat, 'abc', snapshot=snapshot)
+    assert write_answer(chat, ANSWER, snapshot) == chat
+    assert chat.read_text() == PROMPT.replace('test\n', 'test\nllm_conversation_id: abc\n') + ANSWER
+
+
+def test_streamed_answer_is_reanchored_when_the_file_changed_first(chat):
+    _, snapshot = read_with_snapshot(chat)
+    with open(chat, 'a') as file:
+        file.write("\n# %User\nMore\n")
+
+    write_streamed_response(chat, ["\n# %Assistant\n\n", "H", "i"], snapshot)
+    assert chat.read_text() == PROMPT + "\n" + ANSWER + "\n\n# %User\nMore\n"
+
+
+def test_edit_while_streaming_goes_to_a_side_file(chat):
+    _, snapshot = read_with_snapshot(chat)
+
+    def chunks():
+        yield "\n# %Assistant\n\n"
+        yield "H"
+        # An editor saves its own copy of the file mid-stream
+        chat.write_text(PROMPT + "typing")
+        yield "i"
+
+    write_streamed_response(chat, chunks(), snapshot)
+    [side_file] = side_files(chat)
+    assert side_file.read_text() == PROMPT + "\n" + ANSWER
+
+
+def test_unchanged_stream_needs_no_side_file(chat):
+    _, snapshot = read_with_snapshot(chat)
+    write_streamed_response(chat, ["\n# %Assistant\n\n", "H", "i"], snapshot)
+    assert chat.read_text() == PROMPT + "\n" + ANSWER
+    assert side_files(chat) == []
+    assert snapshot.unchanged(chat)
+
+
+def test_file_lock_waits_for_the_holder(chat, capsys):
+    order = []
+
+    def second():
+        with file_lock(chat):
+            order.append('second')
+
+    with file_lock(chat):
+        thread = threading.Thread(target=second)
+        thread.start()
+        time.sleep(0.2)
+        order.append('first')
+    thread.join()
+
+    assert order == ['first', 'second']
+    assert lock_path(chat).exists()
+    assert 'Waiting for another llmd' in capsys.readouterr().out
+
+
+class Typist(llm.Model):
+    """Answers while the user adds a new prompt to the file"""
+    model_id = 'typist'
+    path = None
+
+    class Options(llm.Options):
+        max_tokens: int | None = None
+
+    def execute(self, prompt, stream, response, conversation):
+        with open(self.path, 'a') as file:
+            file.write("\n# %User\nWhile you were thinking\n")
+        yield "Done"
+
+
+@pytest.fixture
+def typist(monkeypatch, tmp_path):
+    monkeypatch.setenv('LLM_USER_PATH', str(tmp_path / 'llm'))
+    monkeypatch.setenv('llmd_config_dir', str(tmp_path / 'config'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(llm, 'get_model', lambda name: Typist())
+    monkeypatch.setattr(llm_conversation_module, 'load_env_file', lambda: None)
+    monkeypatch.setattr(Typist, 'path', tmp_path / 'chat.md')
+    yield Typist.path
+
+
+def test_read_and_write_response_reanchors(typist):
+    header = "---\nmodel: typist\nstream: false\n---\n"
+    typist.write_text(header + "# %User\nHello\n")
+    llmd_main.read_and_write_response(typist)
+    assert typist.read_text() == header + "# %User\nHello\n\n\n# %Assistant\n\nDone\n\n# %User\nWhile you were thinking\n"
+
+
+def test_read_and_write_response_edit_while_streaming(typist):
+    # The header is written before the request, so the new prompt lands in the answer
+    header = "---\nmodel: typist\nstream: true\n---\n"
+    typist.write_text(header + "# %User\nHello\n")
+    llmd_main.read_and_write_response(typist)
+    [side_file] = side_files(typist)
+    assert side_file.read_text() == header + "# %User\nHello\n\n\n# %Assistant\n\nDone"
@@ -0,0 +1,132 @@
+import random
+import re
+import pytest
+import llm_tool.parser as parser
+from llm_tool.scanner import scan_conversation
+from llm_tool.parser import parse_conversation, _parse_user_content_types
+
+
+def test_scan_turns():
+    result = scan_conversation("intro\n# %User\nHello\n# %Assistant\nHi")
+    assert [(turn['role'], turn['start'], turn['text']) for turn in result['turns']] == [
+        ('user', 6, 'Hello\n'),
+        ('assistant', 20, 'Hi'),
+    ]
+    assert result['boundaries'] == [6, 20]
+    assert not result['has_stray_comment']
+
+
+def test_scan_removes_comments():
+    result = scan_conversation("# %User\nA<!--llm # %Assistant\nhidden llm-->B")
+    assert [turn['text'] for turn in result['turns']] == ['AB']
+
+
+def test_scan_header_without_newline_ends_turn():
+    result = scan_conversation("# %User\nHello\n# %Userx\n# %Assistant\nHi")
+    assert [turn['text'] for turn in result['turns']] == ['Hello\n', 'Hi']
+    assert len(result['boundaries']) == 3
+
+
+def test_scan_stray_comment_is_text():
+    result = scan_conversation("# %User\nA <!--llm B\n# %Assistant\nHi")
+    assert [turn['text'] for turn in result['turns']] == ['A <!--llm B\n', 'Hi']
+    assert result['has_stray_comment']
+
+
+def test_scan_link_spans_skip_comments():
+    result = scan_conversation("# %User\nSee [a<!--llm x llm-->](b.txt) now")
+    turn = result['turns'][0]
+    assert turn['text'] == 'See [a](b.txt) now'
+    kind, start, path_start, path_end, end = turn['spans'][0]
+    assert kind == 'link'
+    assert turn['text'][start:end] == '[a](b.txt)'
+    assert turn['text'][path_start:path_end] == 'b.txt'
+
+
+def test_fenced_code_is_not_structure():
+    content = (
+        "# %User\nFix this:\n```markdown\n# %User\n[x](y)\n<!--llm kept llm-->\n```\n"
+        "# %Assistant\nDone"
+    )
+    result = parse_conversation(content)
+    assert result['conversation'] == [
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': 'Fix this:\n```markdown\n# %User\n[x](y)\n<!--llm kept llm-->\n```'},
+        ]},
+        {'role': 'assistant', 'content': 'Done'},
+    ]
+
+
+def test_tilde_fence_and_longer_closing_fence():
+    content = "# %User\n~~~\n# %Assistant\n~~~~\n# %Assistant\nHi"
+    result = parse_conversation(content)
+    assert [turn['role'] for turn in result['conversation']] == ['user', 'assistant']
+
+
+def test_unclosed_fence_runs_to_end():
+    content = "# %User\n```\n# %Assistant\nnot a turn"
+    result = parse_conversation(content)
+    assert len(result['conversation']) == 1
+
+
+def test_links_after_fence_are_found(tmp_path):
+    (tmp_path / 'd.txt').write_text("d")
+    content = "```\n[a](b)\n```\n[c](d.txt)"
+    assert _parse_user_content_types(content, base_path=tmp_path) == [
+        {'type': 'text', 'text': '```\n[a](b)\n```'},
+        {'type': 'link', 'link': str(tmp_path / 'd.txt')},
+    ]
+
+
+def _regex_parse(file_contents):
+    """The regex parser the scanner replaced, with paths left unresolved"""
+    pruned = re.sub(r'<!--llm.*?llm-->', '', file_contents, flags=re.DOTALL)
+    turn_pattern = r'# %(User|Assistant)\n(.*?)(?=# %User|# %Assistant|$)'
+    chunk_pattern = (
+        r'(?P<text>.*?)(?:(?P<link>(?<!!)\[.*?\]\((?P<linkpath>.*?)\))'
+        r'|(?P<image>!\[.*?\]\((?P<imagepath>.*?)\))|$)'
+    )
+    conversation = []
+    for role, content in re.findall(turn_pattern, pruned, re.DOTALL):
+        if role == 'Assistant':
+            conversation.append({'role': 'assistant', 'content': content.strip()})
+            continue
+        chunks = []
+        for match in re.finditer(chunk_pattern, content, re.DOTALL):
+            if match.group('text').strip():
+                chunks.append({'type': 'text', 'text': match.group('text').strip()})
+            if match.group('link'):
+                chunks.append({'type': 'link', 'link': match.group('linkpath')})
+            if match.group('image'):
+                chunks.append({'type': 'image', 'source': match.group('imagepath')})
+        conversation.append({'role': 'user', 'content': chunks})
+    return conversation
+
+
+# No fences, whose contents the regex parser treated as structure, and no
+# '!' apart from '![', as a comment between the two now makes a link
+_TOKENS = [
+    '# %User\n', '# %Assistant\n', '# %User', '# ', '<!--llm', 'llm-->', '<!--llm note llm-->',
+    '[', ']', '(', ')', '](', '![', 'a', 'b.txt', ' ', '\n',
+]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_scanner_matches_regex_parser(seed, monkeypatch):
+    monkeypatch.setattr(parser, 'resolve_existing_filepath', lambda path, base_path='.': path)
+    rng = random.Random(seed)
+    for _ in range(500):
+        content = ''.join(rng.choice(_TOKENS) for _ in range(rng.randint(0, 40)))
+        assert parse_conversation(content)['conversation'] == _regex_parse(content), content
+
+
+@pytest.mark.parametrize("content", [
+    "[" * 20000,
+    "[a](" * 20000,
+    "x" * 200000,
+    "# %User\n" + "[a](b) " * 20000,
+])
+def test_pathological_inputs_scan_quickly(content):
+    # These inputs are quadratic for a backtracking regex
+    result = scan_conversation("# %User\n" + content)
+    assert len(result['turns']) >= 1
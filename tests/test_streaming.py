@@ -0,0 +1,53 @@
+import pytest
+import tempfile
+from pathlib import Path
+from llm_tool.__main__ import write_streamed_response
+
+
+@pytest.fixture
+def markdown_file():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "chat.md"
+        path.write_text("# %User\nHello\n")
+        yield path
+
+
+def test_write_streamed_response(markdown_file):
+    chunks = ["\n# %Assistant\n\n", "Hi", " there"]
+    time_to_first_token = write_streamed_response(markdown_file, chunks)
+    assert markdown_file.read_text() == "# %User\nHello\n\n\n# %Assistant\n\nHi there"
+    assert time_to_first_token is not None
+    assert time_to_first_token >= 0
+
+
+def test_write_streamed_response_flushes_header_first(markdown_file):
+    def chunks():
+        yield "\n# %Assistant\n\n"
+        # The header is on disk before the model produces any text
+        assert markdown_file.read_text().endswith("# %Assistant\n\n")
+        yield "Hi"
+
+    write_streamed_response(markdown_file, chunks())
+    assert markdown_file.read_text().endswith("# %Assistant\n\nHi")
+
+
+def test_write_streamed_response_no_new_prompt(markdown_file):
+    assert write_streamed_response(markdown_file, iter([])) is None
+    assert markdown_file.read_text() == "# %User\nHello\n"
+
+
+def test_write_streamed_response_header_only(markdown_file):
+    assert write_streamed_response(markdown_file, ["\n# %Assistant\n\n"]) is None
+    assert markdown_file.read_text().endswith("# %Assistant\n\n")
+
+
+@pytest.mark.parametrize('text', [[], ["Hi"]])
+def test_write_streamed_response_failure_writes_nothing(markdown_file, text):
+    def chunks():
+        yield "\n# %Assistant\n\n"
+        yield from text
+        raise RuntimeError("Overloaded")
+
+    with pytest.raises(RuntimeError):
+        write_streamed_response(markdown_file, chunks())
+    assert markdown_file.read_text() == "# %User\nHello\n"
@@ -0,0 +1,99 @@
+import pytest
+import sys
+import tempfile
+import time
+from pathlib import Path
+from llm_tool.watch import InotifyWatcher, PollingWatcher, watch
+
+BASE_CONFIG = {'model': 'default-model'}
+
+
+@pytest.fixture
+def temp_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield Path(tmpdirname).resolve()
+
+
+class FakeWatcher:
+    """Replays a scripted list of change events, one list per poll"""
+
+    def __init__(self, events):
+        self.events = list(events)
+
+    def poll(self, timeout):
+        if self.events:
+            return set(self.events.pop(0))
+        time.sleep(timeout)
+        return set()
+
+
+def append_answer(filepath):
+    with open(filepath, 'a') as f:
+        f.write("\n# %Assistant\nHi\n")
+
+
+def test_watch_answers_pending_file(temp_dir):
+    path = temp_dir / "chat.md"
+    path.write_text("# %User\nHello\n")
+    answered = []
+
+    def respond(filepath):
+        answered.append(filepath)
+        append_answer(filepath)
+
+    watch(FakeWatcher([[path]]), BASE_CONFIG, respond, debounce=0, max_iterations=3)
+    assert answered == [path]
+
+
+def test_watch_debounces_rapid_saves(temp_dir):
+    path = temp_dir / "chat.md"
+    path.write_text("# %User\nHello\n")
+    answered = []
+
+    def respond(filepath):
+        answered.append(filepath)
+        append_answer(filepath)
+
+    watch(FakeWatcher([[path], [path], [path]]), BASE_CONFIG, respond, debounce=0.05, max_iterations=10)
+    assert answered == [path]
+
+
+def test_watch_ignores_own_appends_and_answered_files(temp_dir):
+    pending = temp_dir / "pending.md"
+    pending.write_text("# %User\nHello\n")
+    answered_file = temp_dir / "answered.md"
+    answered_file.write_text("# %User\nHello\n# %Assistant\nHi\n")
+    answered = []
+
+    def respond(filepath):
+        answered.append(filepath)
+        # Leave the prompt unanswered so only the signature check stops a repeat
+        with open(filepath, 'a') as f:
+            f.write("\nmore")
+
+    events = [[pending, answered_file], [], [pending], []]
+    watch(FakeWatcher(events), BASE_CONFIG, respond, debounce=0, max_iterations=4)
+    assert answered == [pending]
+
+
+def test_polling_watcher_detects_changes(temp_dir):
+    path = temp_dir / "chat.md"
+    path.write_text("# %User\nHello\n")
+    watcher = PollingWatcher(temp_dir, interval=0.01)
+    assert watcher.poll(timeout=0.01) == set()
+    path.write_text("# %User\nHello again\n")
+    assert watcher.poll(timeout=0.01) == {path}
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux only")
+def test_inotify_watcher_detects_saves(temp_dir):
+    watcher = InotifyWatcher(temp_dir)
+    try:
+        (temp_dir / "notes.txt").write_text("ignored")
+        (temp_dir / "sub").mkdir()
+        watcher.poll(timeout=0.1)
+        path = temp_dir / "sub" / "chat.md"
+        path.write_text("# %User\nHello\n")
+        assert watcher.poll(timeout=1.0) == {path}
+    finally:
+        watcher.close()